@@ -0,0 +1 @@
+""" Benchmarks for the relay. Run them from the repository root, eg. python -m benchmarks.relay_bench --help """
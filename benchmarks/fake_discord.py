@@ -0,0 +1,313 @@
+""" A minimal local stand-in for the Discord gateway, REST API and webhooks, for benchmarks.
+It speaks just enough of the protocol for a DiscordBot to log in, receive one guild and send messages. """
+
+import asyncio
+import itertools
+import json
+import time
+from datetime import datetime, timezone
+
+from aiohttp import web
+
+GUILD_ID = 300000000000000000
+BOT_USER_ID = 310000000000000000
+FIRST_CHANNEL_ID = 320000000000000000
+FIRST_WEBHOOK_ID = 330000000000000000
+FIRST_USER_ID = 340000000000000000
+WEBHOOK_TOKEN = 'b' * 64
+#webhook ids are handed out in blocks of this many per channel
+MAX_WEBHOOKS_PER_CHANNEL = 100
+
+
+def _user(user_id, name):
+    return {'id': str(user_id), 'username': name, 'discriminator': '0001', 'avatar': None}
+
+
+def _json(data):
+    """ Returns a JSON response. discord.py wants the content type without a charset. """
+    return web.Response(body=json.dumps(data).encode(), headers={'Content-Type': 'application/json'})
+
+
+def channel_id(index):
+    """ Returns the id of the index'th channel of the fake guild. """
+    return FIRST_CHANNEL_ID + index
+
+
+def webhook_url(index, number=0):
+    """ Returns the URL of the number'th webhook of the index'th channel. It's in the format discord.py expects and is
+    redirected to the fake server along with the rest of the API, see FakeDiscord.patch_discord(). """
+    webhook_id = FIRST_WEBHOOK_ID + index * MAX_WEBHOOKS_PER_CHANNEL + number
+    return f'https://discordapp.com/api/webhooks/{webhook_id}/{WEBHOOK_TOKEN}'
+
+
+class FakeDiscord():
+    """
+    The fake Discord. on_message is called as on_message(channel_id, username, content, timestamp) for every message
+    the bot posts, either through the REST API or through a webhook.
+    """
+
+    def __init__(self, channel_count, on_message, user_count=100, user_names=None, webhook_limit=None):
+        """ The users are named benchuserN, or after user_names if it's given. If webhook_limit is given as
+        (requests, seconds), every webhook is rate limited to that many requests per that many seconds, with the
+        rate limit headers and 429s Discord uses. """
+        self.channel_count = channel_count
+        self.on_message = on_message
+        self.webhook_limit = webhook_limit
+        self._webhook_windows = {}  #webhook id -> [loop time the rate limit window ends, requests in it]
+        self.rate_limited = 0  #webhook posts answered with a 429
+        if user_names is None:
+            user_names = [f'benchuser{i}' for i in range(user_count)]
+        self.users = [_user(FIRST_USER_ID + i, name) for i, name in enumerate(user_names)]
+        self._ids = itertools.count(350000000000000000)
+        self._sequence = itertools.count(1)
+        self._sockets = set()
+        self._runner = None
+        self.port = None
+        self.app = web.Application()
+        self.app.router.add_get('/api/v7/gateway', self._get_gateway)
+        self.app.router.add_get('/api/v7/gateway/bot', self._get_gateway)
+        self.app.router.add_get('/api/v7/users/@me', self._get_me)
+        self.app.router.add_post('/api/v7/channels/{channel_id}/messages', self._post_message)
+        self.app.router.add_post('/api/v7/webhooks/{webhook_id}/{token}', self._post_webhook)
+        self.app.router.add_get('/gateway', self._gateway)
+
+    @property
+    def base_url(self):
+        """ The base URL of the fake REST API. """
+        return f'http://127.0.0.1:{self.port}/api/v7'
+
+    def patch_discord(self):
+        """ Points discord.py at this server instead of the real Discord. """
+        import discord.http
+        import discord.webhook
+        discord.http.Route.BASE = self.base_url
+        for name in dir(discord.webhook):
+            adapter = getattr(discord.webhook, name)
+            if isinstance(adapter, type) and hasattr(adapter, 'BASE'):
+                adapter.BASE = self.base_url
+
+    async def start(self):
+        """ Starts listening on a free local port. """
+        self._runner = web.AppRunner(self.app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, '127.0.0.1', 0)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]  #pylint:disable=protected-access
+
+    async def stop(self):
+        """ Closes all connections and stops the server. """
+        for socket in list(self._sockets):
+            await socket.close()
+        await self._runner.cleanup()
+
+    def ready(self):
+        """ Returns True if a bot is connected to the gateway. """
+        return bool(self._sockets)
+
+    async def say(self, channel_index, user_index, content):
+        """ Dispatches a MESSAGE_CREATE to the connected bot as if the user said content in the channel. """
+        await self._dispatch_all('MESSAGE_CREATE', self.message_data(channel_index, user_index, content))
+
+    def message_data(self, channel_index, user_index, content):
+        """ Returns the data of a message the user said in the channel, as the gateway sends it. """
+        user = self.users[user_index % len(self.users)]
+        return {
+            'id': str(next(self._ids)),
+            'channel_id': str(channel_id(channel_index)),
+            'guild_id': str(GUILD_ID),
+            'author': user,
+            'member': self._member(user),
+            'content': content,
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'edited_timestamp': None,
+            'tts': False,
+            'mention_everyone': False,
+            'mentions': [],
+            'mention_roles': [],
+            'attachments': [],
+            'embeds': [],
+            'pinned': False,
+            'type': 0,
+        }
+
+    def guild_data(self):
+        """ Returns the data of the fake guild, as the gateway sends it. """
+        channels = [{
+            'id': str(channel_id(i)),
+            'guild_id': str(GUILD_ID),
+            'type': 0,
+            'name': f'bench{i}',
+            'position': i,
+            'permission_overwrites': [],
+            'nsfw': False,
+            'topic': None,
+            'parent_id': None,
+        } for i in range(self.channel_count)]
+        everyone = {
+            'id': str(GUILD_ID),
+            'name': '@everyone',
+            'color': 0,
+            'hoist': False,
+            'position': 0,
+            'permissions': 104324161,
+            'managed': False,
+            'mentionable': False
+        }
+        bot = _user(BOT_USER_ID, 'benchbot')
+        members = [self._member(user) for user in self.users + [bot]]
+        return {
+            'id': str(GUILD_ID),
+            'name': 'bench',
+            'icon': None,
+            'splash': None,
+            'owner_id': str(BOT_USER_ID),
+            'region': 'us-west',
+            'afk_channel_id': None,
+            'afk_timeout': 300,
+            'verification_level': 0,
+            'default_message_notifications': 0,
+            'explicit_content_filter': 0,
+            'roles': [everyone],
+            'emojis': [],
+            'features': [],
+            'mfa_level': 0,
+            'application_id': None,
+            'joined_at': '2018-01-01T00:00:00+00:00',
+            'large': False,
+            'unavailable': False,
+            'member_count': len(members),
+            'voice_states': [],
+            'members': members,
+            'channels': channels,
+            'presences': [],
+        }
+
+    ##########
+    #Handlers#
+    ##########
+
+    async def _get_gateway(self, request):
+        return _json({'url': f'ws://127.0.0.1:{self.port}/gateway', 'shards': 1})
+
+    async def _get_me(self, request):
+        user = _user(BOT_USER_ID, 'benchbot')
+        user['bot'] = True
+        return _json(user)
+
+    async def _post_message(self, request):
+        received = time.perf_counter()
+        payload = await request.json()
+        channel = int(request.match_info['channel_id'])
+        self.on_message(channel, None, payload.get('content', ''), received)
+        data = {
+            'id': str(next(self._ids)),
+            'channel_id': str(channel),
+            'author': _user(BOT_USER_ID, 'benchbot'),
+            'content': payload.get('content', ''),
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'edited_timestamp': None,
+            'tts': False,
+            'mention_everyone': False,
+            'mentions': [],
+            'mention_roles': [],
+            'attachments': [],
+            'embeds': [],
+            'pinned': False,
+            'type': 0,
+        }
+        return _json(data)
+
+    async def _post_webhook(self, request):
+        received = time.perf_counter()
+        webhook_id = int(request.match_info['webhook_id'])
+        headers = self._take_webhook_request(webhook_id)
+        if headers is not None and headers['X-RateLimit-Remaining'] == '-1':
+            self.rate_limited += 1
+            headers['X-RateLimit-Remaining'] = '0'
+            retry_after = float(headers['X-RateLimit-Reset-After'])
+            return web.Response(status=429,
+                                body=json.dumps({'message': 'You are being rate limited.', 'retry_after':
+                                                 int(retry_after * 1000), 'global': False}).encode(),
+                                headers=dict(headers, **{'Content-Type': 'application/json', 'Via': '1.1 google'}))
+        if request.content_type.startswith('multipart/'):
+            reader = await request.multipart()
+            payload = {}
+            async for part in reader:
+                if part.name == 'payload_json':
+                    payload = await part.json()
+        else:
+            payload = await request.json()
+        channel = FIRST_CHANNEL_ID + (webhook_id - FIRST_WEBHOOK_ID) // MAX_WEBHOOKS_PER_CHANNEL
+        self.on_message(channel, payload.get('username'), payload.get('content', ''), received)
+        return web.Response(status=204, headers=headers)
+
+    async def _gateway(self, request):
+        socket = web.WebSocketResponse()
+        await socket.prepare(request)
+        self._sockets.add(socket)
+        try:
+            await socket.send_json({'op': 10, 'd': {'heartbeat_interval': 41250, '_trace': ['bench']}})
+            async for message in socket:
+                payload = json.loads(message.data)
+                if payload['op'] == 1:  #heartbeat
+                    await socket.send_json({'op': 11})
+                elif payload['op'] == 2:  #identify
+                    await self._identified(socket)
+        finally:
+            self._sockets.discard(socket)
+        return socket
+
+    ##########
+    #Internal#
+    ##########
+
+    def _take_webhook_request(self, webhook_id):
+        """ Counts a request to a webhook against its rate limit. Returns the rate limit headers of the response,
+        with X-RateLimit-Remaining being -1 if the request is over the limit, or None if there's no limit. """
+        if self.webhook_limit is None:
+            return None
+        requests, seconds = self.webhook_limit
+        now = asyncio.get_running_loop().time()
+        window = self._webhook_windows.get(webhook_id)
+        if window is None or now >= window[0]:
+            window = self._webhook_windows[webhook_id] = [now + seconds, 0]
+        window[1] += 1
+        return {
+            'X-RateLimit-Limit': str(requests),
+            'X-RateLimit-Remaining': str(max(-1, requests - window[1])),
+            'X-RateLimit-Reset-After': f'{window[0] - now:.3f}'
+        }
+
+    def _member(self, user):
+        return {
+            'user': user,
+            'roles': [],
+            'nick': None,
+            'joined_at': '2018-01-01T00:00:00+00:00',
+            'deaf': False,
+            'mute': False
+        }
+
+    async def _identified(self, socket):
+        bot = _user(BOT_USER_ID, 'benchbot')
+        bot['bot'] = True
+        ready = {
+            'v': 6,
+            'user': bot,
+            'guilds': [{
+                'id': str(GUILD_ID),
+                'unavailable': True
+            }],
+            'session_id': 'bench',
+            'private_channels': [],
+            'relationships': [],
+            '_trace': ['bench'],
+        }
+        await self._dispatch(socket, 'READY', ready)
+        await self._dispatch(socket, 'GUILD_CREATE', self.guild_data())
+
+    async def _dispatch(self, socket, event, data):
+        await socket.send_json({'op': 0, 't': event, 's': next(self._sequence), 'd': data})
+
+    async def _dispatch_all(self, event, data):
+        await asyncio.gather(*(self._dispatch(socket, event, data) for socket in self._sockets))
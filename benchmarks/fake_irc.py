@@ -0,0 +1,87 @@
+""" A minimal local IRC server for benchmarks. It speaks just enough IRC for IRCBots to sign on and join channels,
+lets the benchmark inject channel messages and records the messages the bots send. """
+
+import time
+
+from twisted.internet import protocol
+from twisted.words.protocols import irc
+
+SERVER_NAME = 'bench.irc'
+
+
+class FakeIRCClientConnection(irc.IRC):
+    """ The server side of a single client connection. """
+
+    hostname = SERVER_NAME
+
+    def connectionMade(self):
+        super().connectionMade()
+        self.nick = None
+        self.joined = set()
+
+    def connectionLost(self, reason):
+        if self in self.factory.clients:
+            self.factory.clients.remove(self)
+
+    def irc_NICK(self, prefix, params):
+        self.nick = params[0]
+
+    def irc_USER(self, prefix, params):
+        self.sendLine(f':{SERVER_NAME} 001 {self.nick} :Welcome to the benchmark network {self.nick}!bench@bench')
+        self.sendLine(f':{SERVER_NAME} 005 {self.nick} CASEMAPPING=rfc1459 NICKLEN=30 :are supported by this server')
+        self.factory.clients.append(self)
+
+    def irc_JOIN(self, prefix, params):
+        for channel in params[0].split(','):
+            self.joined.add(channel)
+            self.sendLine(f':{self.nick}!bench@bench JOIN {channel}')
+            self.sendLine(f':{SERVER_NAME} 353 {self.nick} = {channel} :{self.nick}')
+            self.sendLine(f':{SERVER_NAME} 366 {self.nick} {channel} :End of /NAMES list.')
+
+    def irc_PART(self, prefix, params):
+        for channel in params[0].split(','):
+            self.joined.discard(channel)
+
+    def irc_PING(self, prefix, params):
+        self.sendLine(f':{SERVER_NAME} PONG {SERVER_NAME} :{params[-1]}')
+
+    def irc_PRIVMSG(self, prefix, params):
+        if params[0].startswith('#') and params[0] not in self.joined:
+            #like a real server, don't let clients talk in channels they aren't on
+            self.sendLine(f':{SERVER_NAME} 404 {self.nick} {params[0]} :Cannot send to channel')
+            return
+        self.factory.on_privmsg(params[0], params[-1], time.perf_counter())
+
+    def irc_QUIT(self, prefix, params):
+        self.transport.loseConnection()
+
+    def irc_unknown(self, prefix, command, params):
+        pass
+
+
+class FakeIRCServer(protocol.ServerFactory):
+    """ A fake IRC network. on_privmsg is called as on_privmsg(target, text, timestamp) for every PRIVMSG the
+    connected bots send. """
+
+    protocol = FakeIRCClientConnection
+
+    def __init__(self, network_name, on_privmsg):
+        self.network_name = network_name
+        self.on_privmsg = on_privmsg
+        self.clients = []  #the connections of the bots that have signed on
+
+    def ready(self, channels, connections=1):
+        """ Returns True if the given number of bots have signed on and between them joined all the given channels. """
+        joined = set().union(*(client.joined for client in self.clients))
+        return len(self.clients) >= connections and joined.issuperset(channels)
+
+    def say(self, nick, channel, text):
+        """ Sends a channel message to the bots in the channel as if nick (or a full nick!user@host) said it. Returns
+        True if a bot was there to hear it. """
+        prefix = nick if '!' in nick else f'{nick}!user@bench.host'
+        heard = False
+        for client in self.clients:
+            if channel in client.joined:
+                client.sendLine(f':{prefix} PRIVMSG {channel} :{text}')
+                heard = True
+        return heard
@@ -0,0 +1,102 @@
+"""
+Measures how long the content filter takes per message as the number of words and regexes in its rules grows.
+
+For each count in --counts and each kind of rule, builds a filter with a rule of that many random words, regexes with
+a literal part (looked for through the Aho-Corasick automaton) or regexes without one (run as one combined regex),
+runs it over --messages generated chat lines that match none of them, and reports the microseconds per message. The
+results are written as one JSON object per line. Regexes without a literal part are only measured up to
+filters.MAX_UNINDEXED_PATTERNS, the most a channel may have.
+
+Words and regexes with a literal part must cost about the same however many there are, rather than a thousand times
+as much for a thousand times as many: if the largest count takes more than --max-slowdown times as long per message as
+the smallest one, the benchmark says so and exits with status 1.
+
+Example:
+    python -m benchmarks.filter_bench --counts 1,100,10000 --length 80
+"""
+
+import argparse
+import json
+import random
+import string
+import sys
+import time
+
+
+def _word(rng, length=8):
+    return ''.join(rng.choice(string.ascii_lowercase) for _ in range(length))
+
+
+def main():
+    """ Runs the measurements. """
+    parser = argparse.ArgumentParser(description='Measures the per-message cost of the content filter.')
+    parser.add_argument('--counts', default='1,10,100,1000,10000', help='comma-separated numbers of words and regexes')
+    parser.add_argument('--messages', type=int, default=2000, help='messages to filter per measurement')
+    parser.add_argument('--length', type=int, default=80, help='characters per message')
+    parser.add_argument('--seed', type=int, default=1, help='random seed')
+    parser.add_argument('--max-slowdown', type=float, default=10.0,
+                        help='how many times slower than the smallest count the largest may be per message')
+    args = parser.parse_args()
+
+    from pydircbot import filters
+    from pydircbot.adapters import Envelope, IMessage
+
+    class BenchMessage(Envelope):
+        """ A received message without a connection behind it. """
+        __slots__ = ()
+        protocol = IMessage.Protocol.IRC
+
+        @property
+        def message(self):
+            return self._content
+
+    rng = random.Random(args.seed)
+    messages = []
+    for index in range(args.messages):
+        text = ' '.join(_word(rng, rng.randint(2, 9)) for _ in range(args.length // 5))[:args.length]
+        messages.append(BenchMessage(None, 'bench', '#bench', ('bench', '#bench'), f'user{index % 50}', text))
+
+    #kind of rule -> (the argument of filters.Rule its words or regexes go in, makes one of them, the most there may be)
+    kinds = {
+        'words': ('words', lambda: _word(rng, 10), None),
+        'regexes': ('patterns', lambda: rf'{_word(rng, 6)}-\d+', None),
+        'regexes_without_literals': ('patterns', lambda: rf'\b[{_word(rng, 3)}]\d{{3}}[{_word(rng, 3)}]\b',
+                                     filters.MAX_UNINDEXED_PATTERNS),
+    }
+    #kind -> [(count, microseconds per message)]
+    timings = {kind: [] for kind in kinds}
+    for count in sorted(int(count) for count in args.counts.split(',')):
+        for kind, (argument, make, most) in kinds.items():
+            if most is not None and count > most:
+                continue
+            items = [make() for _ in range(count)]
+            start = time.perf_counter()
+            content_filter = filters.ContentFilter([filters.Rule(kind, 'drop', **{argument: items})])
+            build = time.perf_counter() - start
+            start = time.perf_counter()
+            dropped = sum(content_filter.apply(message)[0] is None for message in messages)
+            elapsed = time.perf_counter() - start
+            timings[kind].append((count, elapsed / args.messages * 1e6))
+            print(json.dumps({
+                'kind': kind,
+                'count': count,
+                'messages': args.messages,
+                'length': args.length,
+                'build_seconds': round(build, 3),
+                'us_per_message': round(elapsed / args.messages * 1e6, 1),
+                'dropped': dropped,
+            }), flush=True)
+
+    failed = False
+    for kind in ('words', 'regexes'):
+        (smallest, fastest), (largest, slowest) = timings[kind][0], timings[kind][-1]
+        if slowest > fastest * args.max_slowdown:
+            print(f"{kind}: {largest} take {slowest / fastest:.1f} times as long per message as {smallest}, more than "
+                  f"{args.max_slowdown:g} times", file=sys.stderr)
+            failed = True
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+"""
+Measures how much memory received messages take while they're queued, with tracemalloc.
+
+Builds --count messages of each protocol the way the bot does when it receives them and keeps them in a queue, like
+the relays waiting on a rate limit or the listeners waiting for a worker do, then reports the bytes that stay
+allocated per queued message. For Discord it also measures the discord.py message objects the messages are built
+from, which the queued messages don't keep alive. The results are written as one JSON object per line.
+
+Example:
+    python -m benchmarks.message_memory --count 100000 --length 80
+"""
+
+import argparse
+import asyncio
+import gc
+import json
+import sys
+import tracemalloc
+from collections import deque
+
+from . import fake_discord
+
+
+def measure(build, count):
+    """ Returns the bytes per object that stay allocated while the objects returned by build(0..count-1) are
+    queued. """
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    queue = deque(build(index) for index in range(count))
+    gc.collect()
+    queued = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    sample = queue[0]
+    del queue
+    return queued / count, sample
+
+
+def main():
+    """ Runs the measurements. """
+    parser = argparse.ArgumentParser(description='Measures the memory taken by queued messages.')
+    parser.add_argument('--count', type=int, default=100000, help='messages to queue per measurement')
+    parser.add_argument('--length', type=int, default=80, help='characters per message')
+    args = parser.parse_args()
+
+    import discord
+    from discord.state import ConnectionState
+    from pydircbot.disc import DiscordMessage
+    from pydircbot.irc import IRCMessage
+    from pydircbot.shard import RemoteNetwork
+
+    text = 'x' * max(0, args.length - 12)
+    #the messages' own text, to tell it apart from the overhead
+    text_bytes = sys.getsizeof(f'bench-{args.count:06d} {text}')
+
+    #the IRC connection (and the Discord bot below) are shared by all the messages, any stand-in does
+    network = RemoteNetwork(None, 0, 'bench', 'benchbot', None)
+
+    def irc_message(index):
+        return IRCMessage(network, f'user{index % 50}!user@bench.host', '#bench0', f'bench-{index:06d} {text}')
+
+    loop = asyncio.new_event_loop()
+    fake = fake_discord.FakeDiscord(1, None)
+    state = ConnectionState(dispatch=lambda *args: None, handlers={}, hooks={}, syncer=None, http=None, loop=loop)
+    guild = discord.Guild(data=fake.guild_data(), state=state)
+    channel = guild.get_channel(fake_discord.channel_id(0))
+
+    def discord_original(index):
+        return discord.Message(state=state, channel=channel,
+                               data=fake.message_data(0, index, f'bench-{index:06d} {text}'))
+
+    def discord_message(index):
+        return DiscordMessage(None, discord_original(index))
+
+    for kind, build in (('irc', irc_message), ('discord', discord_message), ('discord.py', discord_original)):
+        per_message, sample = measure(build, args.count)
+        print(json.dumps({
+            'kind': kind,
+            'count': args.count,
+            'length': args.length,
+            'bytes_per_message': round(per_message, 1),
+            'overhead_bytes': round(per_message - text_bytes, 1),
+            'shallow_bytes': sys.getsizeof(sample),
+            'has_dict': hasattr(sample, '__dict__'),
+        }), flush=True)
+    loop.close()
+
+
+if __name__ == '__main__':
+    main()
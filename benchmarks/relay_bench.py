@@ -0,0 +1,313 @@
+"""
+End-to-end relay benchmark.
+
+Starts local stand-ins for IRC networks (fake_irc) and Discord (fake_discord), points a real PyDIRCBot at them and
+measures relay throughput and latency in both directions. The bot runs in single-loop mode, in the default threaded
+mode or (by default) once in each, so the two can be compared. Every scenario runs in its own process because the
+Twisted reactor can't be restarted. Results are written as one JSON object per line.
+
+Example:
+    python -m benchmarks.relay_bench --rates 10,100,1000 --channels 1,10 --networks 1,4 --output results.jsonl
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import re
+import subprocess
+import sys
+import time
+from types import SimpleNamespace
+
+from . import fake_discord
+
+#relayed benchmark messages carry their id in this form, possibly several per post if they were coalesced
+_MESSAGE_ID = re.compile(r'bench-(\d+)')
+
+DIRECTIONS = ('irc2discord', 'discord2irc')
+#the ways the bot can run its event loops: everything on one asyncio loop, or IRC, Discord and the core in threads
+MODES = ('single', 'threaded')
+
+
+def percentile(sorted_values, fraction):
+    """ Returns the given percentile (0.0-1.0) of a sorted list using the nearest-rank method. """
+    if not sorted_values:
+        return None
+    rank = max(0, min(len(sorted_values) - 1, int(round(fraction * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[rank]
+
+
+class Recorder():
+    """ Keeps track of the send and receive times of the benchmark messages. """
+
+    def __init__(self):
+        self._ids = itertools.count()
+        self.sent = {}  #message id -> send time
+        self.latencies = []
+        self.first_sent = None
+        self.last_received = None
+
+    def new_message(self):
+        """ Records a message as sent and returns its text. """
+        message_id = next(self._ids)
+        now = time.perf_counter()
+        self.sent[message_id] = now
+        if self.first_sent is None:
+            self.first_sent = now
+        return f'bench-{message_id}'
+
+    def received(self, text, timestamp):
+        """ Records the benchmark messages contained in text as received at timestamp. """
+        for match in _MESSAGE_ID.finditer(text):
+            sent = self.sent.pop(int(match.group(1)), None)
+            if sent is not None:
+                self.latencies.append(timestamp - sent)
+                self.last_received = timestamp
+
+    def result(self, **scenario):
+        """ Returns the results as a dict, including the given scenario parameters. """
+        latencies = sorted(self.latencies)
+        received = len(latencies)
+        elapsed = (self.last_received - self.first_sent) if received else None
+        to_ms = lambda value: None if value is None else round(value * 1000, 3)
+        return dict(scenario,
+                    sent=received + len(self.sent),
+                    received=received,
+                    lost=len(self.sent),
+                    throughput=round(received / elapsed, 2) if elapsed else None,
+                    p50_ms=to_ms(percentile(latencies, 0.50)),
+                    p99_ms=to_ms(percentile(latencies, 0.99)),
+                    max_ms=to_ms(latencies[-1] if latencies else None))
+
+
+def make_config(args, irc_ports):
+    """ Builds the bot config for a scenario. """
+    servers = {}
+    mappings = []
+    webhooks = {}
+    for network, port in enumerate(irc_ports):
+        channels = [f'#bench{i}' for i in range(args.channels)]
+        servers[f'net{network}'] = {'host': '127.0.0.1', 'port': port, 'channels': channels}
+        for i, channel in enumerate(channels):
+            index = network * args.channels + i
+            mappings.append({
+                'irc_network': f'net{network}',
+                'irc_channel': channel,
+                'discord_channel': fake_discord.channel_id(index)
+            })
+            if not args.no_webhooks:
+                urls = [fake_discord.webhook_url(index, number) for number in range(args.webhooks_per_channel)]
+                webhooks[fake_discord.channel_id(index)] = urls[0] if len(urls) == 1 else urls
+    return {
+        'core': {
+            'single_loop': args.mode == 'single',
+            'uvloop': args.uvloop,
+            'irc_shards': args.irc_shards
+        },
+        'irc': {
+            'nick': 'benchbot',
+            'ident': 'benchbot',
+            'realname': 'benchbot',
+            'quitmessage': 'Bye.',
+            'flood': {
+                'rate': args.irc_rate,
+                'burst': args.irc_rate,
+                'max_queue': 1000000
+            },
+            'connections': args.irc_connections,
+            'servers': servers
+        },
+        'spool': {
+            'directory': None
+        },
+        'history': {
+            'enabled': False
+        },
+        'discord': {
+            'token': 'bench',
+            'coalesce': {
+                'window': args.coalesce_window,
+                'max_delay': args.coalesce_max_delay
+            },
+            'webhooks': webhooks
+        },
+        'channel_mapping': mappings,
+    }
+
+
+async def _produce(rate, duration, send):
+    """ Calls send(n) rate times per second for duration seconds. send may return an awaitable. """
+    loop = asyncio.get_event_loop()
+    start = loop.time()
+    sent = 0
+    while True:
+        elapsed = loop.time() - start
+        if elapsed >= duration:
+            break
+        due = min(int(elapsed * rate) + 1, int(duration * rate))
+        pending = []
+        while sent < due:
+            result = send(sent)
+            if result is not None:
+                pending.append(result)
+            sent += 1
+        if pending:
+            await asyncio.gather(*pending)
+        await asyncio.sleep(min(1 / rate, 0.01))
+
+
+async def _drive(args, bot, irc_servers, discord, recorders):
+    """ Waits for everything to connect, runs the benchmark and stops the bot. """
+    from twisted.internet import reactor
+    try:
+        deadline = time.monotonic() + args.connect_timeout
+        channels = [f'#bench{i}' for i in range(args.channels)]
+        while not (discord.ready() and bot.discordbot.is_ready()
+                   and all(route.channel is not None for route in bot.routing.discord_routes.values())
+                   and all(server.ready(channels, args.irc_connections) for server in irc_servers)):
+            if time.monotonic() > deadline:
+                raise RuntimeError('Timed out waiting for the bot to connect.')
+            await asyncio.sleep(0.05)
+
+        sources = [(network, channel) for network in range(len(irc_servers)) for channel in range(args.channels)]
+        scenario = dict(mode=args.mode,
+                        rate=args.rate,
+                        channels=args.channels,
+                        networks=args.networks,
+                        duration=args.duration)
+        if args.webhook_limit is not None:
+            scenario.update(webhooks_per_channel=args.webhooks_per_channel, webhook_limit=args.webhook_limit)
+        for direction in args.directions:
+            recorder = recorders[direction]
+            if direction == 'irc2discord':
+
+                def send(n, recorder=recorder):
+                    network, channel = sources[n % len(sources)]
+                    #in threaded mode the fake networks live in the reactor's thread
+                    reactor.callFromThread(irc_servers[network].say, f'user{n % 50}', f'#bench{channel}',
+                                           recorder.new_message())
+            else:
+
+                def send(n, recorder=recorder):
+                    network, channel = sources[n % len(sources)]
+                    return discord.say(network * args.channels + channel, n % 50, recorder.new_message())
+
+            await _produce(args.rate, args.duration, send)
+            drain_deadline = time.monotonic() + args.drain
+            while recorder.sent and time.monotonic() < drain_deadline:
+                await asyncio.sleep(0.05)
+            result = recorder.result(direction=direction, **scenario)
+            if args.webhook_limit is not None:
+                result['rate_limited'] = discord.rate_limited
+            print(json.dumps(result), flush=True)
+    except Exception:  #pylint:disable=broad-except
+        logging.exception('Benchmark failed.')
+    finally:
+        bot.stop()
+
+
+def run_scenario(args):
+    """ Runs a single scenario in this process. Prints one JSON line per direction. """
+    #the event loop must be set up before anything imports the reactor
+    from pydircbot import eventloop
+    loop = eventloop.install(single_loop=args.mode == 'single', use_uvloop=args.uvloop)
+    from twisted.internet import reactor
+    from pydircbot.bot import PyDIRCBot
+    from . import fake_irc
+
+    recorders = {direction: Recorder() for direction in DIRECTIONS}
+    discord = fake_discord.FakeDiscord(args.networks * args.channels,
+                                       lambda channel, username, content, t: recorders['irc2discord'].received(
+                                           content, t),
+                                       webhook_limit=_webhook_limit(args.webhook_limit))
+    loop.run_until_complete(discord.start())
+    discord.patch_discord()
+
+    irc_servers = []
+    irc_ports = []
+    for network in range(args.networks):
+        server = fake_irc.FakeIRCServer(f'net{network}',
+                                        lambda target, text, t: recorders['discord2irc'].received(text, t))
+        irc_ports.append(reactor.listenTCP(0, server, interface='127.0.0.1').getHost().port)
+        irc_servers.append(server)
+
+    bot = PyDIRCBot(SimpleNamespace(config=make_config(args, irc_ports)), headless=True)
+    loop.create_task(_drive(args, bot, irc_servers, discord, recorders))
+    bot.start()
+
+
+def _webhook_limit(value):
+    """ Parses a --webhook-limit like '5/2' into (requests, seconds). """
+    if value is None:
+        return None
+    requests, seconds = value.split('/')
+    return int(requests), float(seconds)
+
+
+def main():
+    """ Runs the requested scenario matrix, each scenario in a subprocess. """
+    parser = argparse.ArgumentParser(description='End-to-end relay benchmark.')
+    parser.add_argument('--rates', default='10,100,1000', help='comma-separated message rates (messages/s)')
+    parser.add_argument('--channels', default='1,10', help='comma-separated bridged channel counts per network')
+    parser.add_argument('--networks', default='1,4', help='comma-separated IRC network counts')
+    parser.add_argument('--directions', default=','.join(DIRECTIONS), help='comma-separated directions to measure')
+    parser.add_argument('--duration', type=float, default=10, help='seconds to send for in each direction')
+    parser.add_argument('--drain', type=float, default=10, help='seconds to wait for stragglers after sending')
+    parser.add_argument('--connect-timeout', type=float, default=30)
+    parser.add_argument('--irc-rate', type=float, default=100000, help='IRC flood control rate (lines/s)')
+    parser.add_argument('--coalesce-window', type=float, default=0.5)
+    parser.add_argument('--coalesce-max-delay', type=float, default=1.5)
+    parser.add_argument('--no-webhooks', action='store_true', help='relay to Discord without webhooks')
+    parser.add_argument('--webhooks-per-channel', type=int, default=1, help='webhooks in the pool of every channel')
+    parser.add_argument('--webhook-limit', help="rate limit the fake webhooks like Discord does, eg. '5/2' for 5 "
+                        'requests per 2 seconds')
+    parser.add_argument('--mode', choices=(*MODES, 'both'), default='both',
+                        help='run the bot on a single event loop, in threads (the default of the bot) or both in turn')
+    parser.add_argument('--uvloop', action='store_true')
+    parser.add_argument('--irc-shards', type=int, default=0, help='run IRC in this many worker processes')
+    parser.add_argument('--irc-connections', type=int, default=1, help='IRC connections per network')
+    parser.add_argument('--output', help='file to append the results to (default: stdout)')
+    parser.add_argument('--scenario', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--rate', type=float, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    args.directions = args.directions.split(',')
+
+    if args.scenario:
+        args.channels = int(args.channels)
+        args.networks = int(args.networks)
+        logging.basicConfig(level=logging.WARNING)
+        run_scenario(args)
+        return
+
+    passthrough = ['--directions', ','.join(args.directions), '--duration', str(args.duration), '--drain',
+                   str(args.drain), '--connect-timeout', str(args.connect_timeout), '--irc-rate', str(args.irc_rate),
+                   '--coalesce-window', str(args.coalesce_window), '--coalesce-max-delay', str(args.coalesce_max_delay),
+                   '--irc-shards', str(args.irc_shards), '--irc-connections', str(args.irc_connections),
+                   '--webhooks-per-channel', str(args.webhooks_per_channel)]
+    if args.webhook_limit is not None:
+        passthrough += ['--webhook-limit', args.webhook_limit]
+    passthrough += [flag for flag, enabled in (('--no-webhooks', args.no_webhooks), ('--uvloop', args.uvloop)) if enabled]
+    output = open(args.output, 'a') if args.output else sys.stdout
+    try:
+        modes = MODES if args.mode == 'both' else (args.mode, )
+        for rate, channels, networks, mode in itertools.product(args.rates.split(','), args.channels.split(','),
+                                                                args.networks.split(','), modes):
+            command = [sys.executable, '-m', 'benchmarks.relay_bench', '--scenario', '--rate', rate,
+                       '--channels', channels, '--networks', networks, '--mode', mode] + passthrough
+            completed = subprocess.run(command, stdout=subprocess.PIPE, universal_newlines=True, check=False)
+            for line in completed.stdout.splitlines():
+                if line.startswith('{'):
+                    output.write(line + '\n')
+                    output.flush()
+            if completed.returncode != 0:
+                print(f'Scenario rate={rate} channels={channels} networks={networks} mode={mode} failed.',
+                      file=sys.stderr)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,275 @@
+"""
+Replays a traffic capture (see pydircbot.capture) against local stand-ins for IRC and Discord.
+
+The captured messages are fed back in their original order and timing, sped up by --speed (or as fast as possible
+with --speed max), through fake_irc and fake_discord to a real PyDIRCBot in single-loop mode, so spam waves, netsplit
+storms and the like can be reproduced with the traffic shapes they really had. Every captured IRC channel and Discord
+channel gets a stand-in. They're bridged like in the channel_mapping of --config if it's given; otherwise every
+captured channel is bridged to a stand-in of its own on the other side. The results are written as one JSON object.
+
+Example:
+    python -m benchmarks.replay capture.jsonl --speed 10 --config config.yaml
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import sys
+import time
+from collections import Counter
+from types import SimpleNamespace
+
+from pydircbot.capture import read_capture
+
+from . import fake_discord
+
+#the network the stand-ins for captured Discord channels are put on when there's no channel mapping to follow
+REPLAY_NETWORK = 'replay'
+
+
+class Topology():
+    """ The stand-in channels for a capture and how they're bridged. """
+
+    def __init__(self, messages, channel_mapping=None):
+        self.irc_channels = {}  #network -> [channel]
+        self.discord_indices = {}  #captured channel id -> index of its stand-in in fake_discord
+        self.mappings = []  #(network, IRC channel, Discord stand-in index)
+        for message in messages:
+            if message.protocol == 'irc':
+                self._add_irc(message.network, message.channel)
+            else:
+                self._add_discord(message.channel)
+        if channel_mapping is not None:
+            for mapping in channel_mapping:
+                network, channel = mapping['irc_network'], mapping['irc_channel']
+                if network in self.irc_channels or mapping['discord_channel'] in self.discord_indices:
+                    self._add_irc(network, channel)
+                    self.mappings.append((network, channel, self._add_discord(mapping['discord_channel'])))
+            return
+        for network, channels in list(self.irc_channels.items()):
+            for channel in channels:
+                self.mappings.append((network, channel, self._add_discord(('stand-in', network, channel))))
+        for channel_id, index in list(self.discord_indices.items()):
+            if not isinstance(channel_id, tuple):
+                self._add_irc(REPLAY_NETWORK, f'#discord{index}')
+                self.mappings.append((REPLAY_NETWORK, f'#discord{index}', index))
+
+    def _add_irc(self, network, channel):
+        channels = self.irc_channels.setdefault(network, [])
+        if channel not in channels:
+            channels.append(channel)
+
+    def _add_discord(self, channel_id):
+        return self.discord_indices.setdefault(channel_id, len(self.discord_indices))
+
+
+def make_config(args, topology, irc_ports):
+    """ Builds the bot config for the replay. """
+    servers = {
+        network: {
+            'host': '127.0.0.1',
+            'port': irc_ports[network],
+            'channels': channels
+        }
+        for network, channels in topology.irc_channels.items()
+    }
+    mappings = [{
+        'irc_network': network,
+        'irc_channel': channel,
+        'discord_channel': fake_discord.channel_id(index)
+    } for network, channel, index in topology.mappings]
+    webhooks = {} if args.no_webhooks else {
+        fake_discord.channel_id(index): fake_discord.webhook_url(index)
+        for index in topology.discord_indices.values()
+    }
+    return {
+        'core': {
+            'single_loop': True,
+            'uvloop': args.uvloop,
+            'irc_shards': args.irc_shards
+        },
+        'irc': {
+            'nick': 'replaybot',
+            'ident': 'replaybot',
+            'realname': 'replaybot',
+            'quitmessage': 'Bye.',
+            'flood': {
+                'rate': args.irc_rate,
+                'burst': args.irc_rate,
+                'max_queue': 1000000
+            },
+            'connections': args.irc_connections,
+            'servers': servers
+        },
+        'spool': {
+            'directory': None
+        },
+        'history': {
+            'enabled': False
+        },
+        'discord': {
+            'token': 'replay',
+            'webhooks': webhooks
+        },
+        'channel_mapping': mappings,
+    }
+
+
+class Sinks():
+    """ Counts what the bot relays to the stand-ins. """
+
+    def __init__(self):
+        self.irc_lines = Counter()  #network -> lines
+        self.discord_posts = 0
+        self.last_received = None
+
+    def irc_received(self, network, timestamp):
+        """ Records a line the bot sent to a stand-in IRC network. """
+        self.irc_lines[network] += 1
+        self.last_received = timestamp
+
+    def discord_received(self, timestamp):
+        """ Records a message the bot posted to a stand-in Discord channel. """
+        self.discord_posts += 1
+        self.last_received = timestamp
+
+
+async def _replay(args, messages, topology, bot, irc_servers, discord, sinks):
+    """ Waits for everything to connect, feeds the messages in and stops the bot once the relays have died down. """
+    loop = asyncio.get_event_loop()
+    try:
+        deadline = time.monotonic() + args.connect_timeout
+        while not (discord.ready() and bot.discordbot.is_ready()
+                   and all(route.channel is not None for route in bot.routing.discord_routes.values())
+                   and all(irc_servers[network].ready(channels, args.irc_connections)
+                           for network, channels in topology.irc_channels.items())):
+            if time.monotonic() > deadline:
+                raise RuntimeError('Timed out waiting for the bot to connect.')
+            await asyncio.sleep(0.05)
+
+        senders = {}  #Discord display name -> index of the fake user
+        for message in messages:
+            if message.protocol == 'discord':
+                senders.setdefault(message.sender, len(senders))
+        base = messages[0].time if messages else 0.0
+        start = loop.time()
+        started = time.perf_counter()
+        lag = 0.0
+        skipped = 0
+        for count, message in enumerate(messages, 1):
+            if args.speed:
+                delay = start + (message.time - base) / args.speed - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                else:
+                    lag = max(lag, -delay)
+            elif count % 100 == 0:
+                #let the bot keep up instead of buffering the whole capture in the sockets
+                await asyncio.sleep(0)
+            if message.protocol == 'irc':
+                if not irc_servers[message.network].say(message.sender, message.channel, message.text):
+                    skipped += 1
+            else:
+                await discord.say(topology.discord_indices[message.channel], senders[message.sender], message.text)
+        fed = time.perf_counter()
+
+        #wait until nothing has been relayed for a while
+        drain_deadline = time.monotonic() + args.drain
+        while time.monotonic() < drain_deadline:
+            await asyncio.sleep(0.05)
+            if time.perf_counter() - max(fed, sinks.last_received or fed) >= args.quiet:
+                break
+        finished = max(fed, sinks.last_received or fed)
+        to_ms = lambda value: round(value * 1000, 3)
+        result = {
+            'capture': args.capture,
+            'speed': args.speed or 'max',
+            'messages': len(messages),
+            'skipped': skipped,
+            'capture_seconds': round(messages[-1].time - base, 3) if messages else 0.0,
+            'feed_seconds': round(fed - started, 3),
+            'max_lag_ms': to_ms(lag) if args.speed else None,
+            'drain_ms': to_ms(finished - fed),
+            'throughput': round(len(messages) / (finished - started), 2) if finished > started else None,
+            'irc_lines': dict(sinks.irc_lines),
+            'discord_posts': sinks.discord_posts,
+        }
+        print(json.dumps(result), flush=True)
+    except Exception:  #pylint:disable=broad-except
+        logging.exception('Replay failed.')
+    finally:
+        bot.stop()
+
+
+def run(args, messages, topology):
+    """ Runs the replay in this process. """
+    #the event loop must be set up before anything imports the reactor
+    from pydircbot import eventloop
+    loop = eventloop.install(single_loop=True, use_uvloop=args.uvloop)
+    from twisted.internet import reactor
+    from pydircbot.bot import PyDIRCBot
+    from . import fake_irc
+
+    sinks = Sinks()
+    names = list(dict.fromkeys(message.sender for message in messages if message.protocol == 'discord'))
+    discord = fake_discord.FakeDiscord(len(topology.discord_indices),
+                                       lambda channel, username, content, t: sinks.discord_received(t),
+                                       user_names=names or None)
+    loop.run_until_complete(discord.start())
+    discord.patch_discord()
+
+    irc_servers = {}
+    irc_ports = {}
+    for network in topology.irc_channels:
+        server = fake_irc.FakeIRCServer(network,
+                                        lambda target, text, t, network=network: sinks.irc_received(network, t))
+        irc_ports[network] = reactor.listenTCP(0, server, interface='127.0.0.1').getHost().port
+        irc_servers[network] = server
+
+    bot = PyDIRCBot(SimpleNamespace(config=make_config(args, topology, irc_ports)), headless=True)
+    loop.create_task(_replay(args, messages, topology, bot, irc_servers, discord, sinks))
+    bot.start()
+
+
+def _speed(value):
+    return 0.0 if value == 'max' else float(value)
+
+
+def main():
+    """ Loads the capture and replays it. """
+    parser = argparse.ArgumentParser(description='Replays a traffic capture against local stand-ins.')
+    parser.add_argument('capture', help='the capture file to replay')
+    parser.add_argument('--speed', type=_speed, default=1.0, help="speed-up factor, eg. 1, 10 or 100, or 'max'")
+    parser.add_argument('--config', help="bridge the stand-ins like in this config file's channel_mapping")
+    parser.add_argument('--start', type=float, default=0, help='skip this many seconds from the start of the capture')
+    parser.add_argument('--duration', type=float, help='replay at most this many seconds of the capture')
+    parser.add_argument('--drain', type=float, default=30, help='most seconds to wait for relays after feeding')
+    parser.add_argument('--quiet', type=float, default=2, help='stop once nothing has been relayed for this long')
+    parser.add_argument('--connect-timeout', type=float, default=30)
+    parser.add_argument('--irc-rate', type=float, default=100000, help='IRC flood control rate (lines/s)')
+    parser.add_argument('--no-webhooks', action='store_true', help='relay to Discord without webhooks')
+    parser.add_argument('--uvloop', action='store_true')
+    parser.add_argument('--irc-shards', type=int, default=0, help='run IRC in this many worker processes')
+    parser.add_argument('--irc-connections', type=int, default=1, help='IRC connections per network')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    messages = sorted(read_capture(args.capture), key=lambda message: message.time)
+    if messages:
+        first = messages[0].time + args.start
+        last = first + args.duration if args.duration is not None else float('inf')
+        messages = [message for message in messages if first <= message.time < last]
+    if not messages:
+        print('Nothing to replay.', file=sys.stderr)
+        sys.exit(1)
+    channel_mapping = None
+    if args.config:
+        from pydircbot.config import parse_config
+        with open(args.config, encoding='utf-8') as config:
+            channel_mapping = parse_config(config.read()).get('channel_mapping', [])
+    run(args, messages, Topology(messages, channel_mapping))
+
+
+if __name__ == '__main__':
+    main()
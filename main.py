@@ -1,13 +1,29 @@
+import argparse
 import logging
 
-from pydircbot.bot import PyDIRCBot
+from pydircbot import eventloop
 from pydircbot.config import ConfigManager
+from pydircbot.startup import StartupProfiler
 
 
 def main():
+    parser = argparse.ArgumentParser(description='An IRC-Discord relay bot.')
+    parser.add_argument('--headless', action='store_true', help="run without the command prompt (see core.headless)")
+    parser.add_argument('--profile-startup', action='store_true',
+                        help='log how long each phase of startup takes, including imports')
+    args = parser.parse_args()
     logging.basicConfig(level=logging.DEBUG)
+    profiler = StartupProfiler(enabled=args.profile_startup)
+    profiler.phase('config')
     config = ConfigManager()
-    bot = PyDIRCBot(config)
+    core = config.config.get('core', {})
+    profiler.phase('event loop')
+    eventloop.install(single_loop=core.get('single_loop', False), use_uvloop=core.get('uvloop', False))
+    profiler.phase('import bot')
+    #the bot imports the Twisted reactor, so it may only be imported once the event loop has been set up
+    from pydircbot.bot import PyDIRCBot
+    bot = PyDIRCBot(config, headless=args.headless, profiler=profiler)
+    profiler.finish()
     bot.start()
 
 
@@ -8,11 +8,17 @@ class IMessage():
     """
     from enum import Enum
 
+    #subclasses can do without a __dict__
+    __slots__ = ()
+
     class Protocol(Enum):
         """ This is used to identify the protocol the message is from. """
         IRC = 1
         DISCORD = 2
 
+    #the time.perf_counter() time the message was received at, if known
+    received_at = None
+
     def reply(self, message_text):
         """ Sends the given message as a reply. The message may be a string or whatever type
         is necessary for the protocol (but a string must always work). """
@@ -35,6 +41,23 @@ class IMessage():
         """ Returns the source (eg. channel) of this message in a format appropriate for the protocol. """
         raise NotImplementedError
 
+    @property
+    def network(self):
+        """ Returns the network this message is from: the name of the IRC network or the id of the Discord guild
+        (None if it isn't from a guild). """
+        raise NotImplementedError
+
+    @property
+    def channel(self):
+        """ Returns the channel this message is from: the name of the IRC channel (or our nick for private messages)
+        or the id of the Discord channel. """
+        raise NotImplementedError
+
+    @property
+    def route_key(self):
+        """ Returns the key the source of this message has in the routing table (see routing.RoutingTable). """
+        raise NotImplementedError
+
     @property
     def sender(self):
         """ Returns the sender of this message in a format appropriate for the protocol. """
@@ -45,13 +68,97 @@ class IMessage():
         """ Returns the sender in a simple no-frills form (eg. just their nickname and nothing else.) """
         raise NotImplementedError
 
+    @property
+    def from_bot(self):
+        """ Returns True if the message was sent by a bot (or eg. a webhook), as far as we can tell. """
+        return False
+
     @property
     def message(self):
         """ This should return a printable string representation of the message's contents, stripped of any special
         control characters and such. """
         raise NotImplementedError
 
+    def message_as(self, protocol):
+        """ Returns the message's contents with its formatting translated for the given protocol (eg. IRC control
+        codes to Discord markdown). """
+        return self.message
+
     def __str__(self):
         """ This should return a printable string representation of the message's contents, stripped of any special
         control characters and such. """
         raise NotImplementedError
+
+
+class Envelope(IMessage):
+    """
+    The compact form received messages are passed around in: built once when the message is received, it only holds
+    strings (and ids), the receive time and the long-lived object it came through (eg. the IRC connection), never
+    the library's own message object. Envelopes have no __dict__ and can't be changed, so queuing or caching lots of
+    them is cheap and they can be shared between threads. Subclasses give lazy access to the heavy objects behind
+    the message (see original) and set their own slots through Envelope.__init__().
+    """
+
+    __slots__ = ('_origin', '_network', '_channel', '_route_key', '_simple_sender', '_content', 'received_at')
+
+    def __init__(self, origin, network, channel, route_key, simple_sender, content, received_at=None, **slots):
+        """ content is the message as received, with the formatting of its protocol. The keyword arguments set
+        the slots of subclasses. """
+        for name, value in (('_origin', origin), ('_network', network), ('_channel', channel),
+                            ('_route_key', route_key), ('_simple_sender', simple_sender), ('_content', content),
+                            ('received_at', received_at), *slots.items()):
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{self.__class__.__name__} is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError(f"{self.__class__.__name__} is immutable")
+
+    @property
+    def network(self):
+        return self._network
+
+    @property
+    def channel(self):
+        return self._channel
+
+    @property
+    def route_key(self):
+        return self._route_key
+
+    @property
+    def simple_sender(self):
+        return self._simple_sender
+
+    @property
+    def content(self):
+        """ Returns the message as it was received, with the formatting of its protocol. """
+        return self._content
+
+    @property
+    def original(self):
+        """ Returns the library's own object for the message if there is one and it's still around, otherwise None.
+        It's looked up when asked for, the envelope doesn't keep it alive. """
+        return None
+
+    def message_as(self, protocol):
+        if protocol is self.protocol:
+            return self._content
+        return self.message
+
+    def with_text(self, text):
+        """ Returns a copy of the envelope whose contents are replaced by plain text (eg. the message with parts of it
+        redacted). """
+        return self._replace(_content=text)
+
+    def _replace(self, **changes):
+        """ Returns a copy of the envelope with the given slots changed. """
+        copy = object.__new__(self.__class__)
+        for cls in self.__class__.__mro__:
+            for name in getattr(cls, '__slots__', ()):
+                object.__setattr__(copy, name, changes[name] if name in changes else getattr(self, name))
+        return copy
+
+    def __str__(self):
+        return self.message
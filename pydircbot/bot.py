@@ -3,113 +3,289 @@
 from threading import Thread
 import logging
 import asyncio
-from collections import namedtuple
 import sys
 import signal
+import time
+import os
+import tempfile
 
-import aioconsole
 from twisted.internet import reactor
-from twisted.internet.threads import blockingCallFromThread
 import discord
 
 from . import irc
+from . import capture
+from . import coalesce
+from . import commands
 from . import disc
+from . import echo
+from . import eventloop
+from . import events
+from . import filters
+from . import flood
+from . import formatting
+from . import history
+from . import linesplit
+from . import membership
+from . import metrics
+from . import routing
+from . import spool
+from . import startup
+from .config import get_location
 
 
 class PyDIRCBot():
     """ The main bot class. """
 
-    def __init__(self, config_manager):
-        """ Creates a new bot from the given ConfigManager object. """
+    def __init__(self, config_manager, headless=False, profiler=None):
+        """ Creates a new bot from the given ConfigManager object. A headless bot has no command prompt. The phases of
+        the setup are measured with the given startup.StartupProfiler, if any. """
         self.config_manager = config_manager
         config = config_manager.config
+        self.profiler = profiler if profiler is not None else startup.StartupProfiler(enabled=False)
 
         #set up our event loop
+        #in single-loop mode eventloop.install() must have been called before the reactor was imported
+        self.profiler.phase('core')
         self.loop = asyncio.get_event_loop()
-        self.loop.create_task(self.user_input())
+        core = config.get('core', {})
+        self.headless = headless or core.get('headless', False)
+        self.shutdown_timeout = core.get('shutdown_timeout', 10.0)
+        self._stopping = False
+        if not self.headless:
+            self.loop.create_task(self.user_input())
+        self.single_loop = core.get('single_loop', False)
+        if self.single_loop and not eventloop.is_single_loop():
+            raise RuntimeError('Single-loop mode requires the asyncio reactor, call eventloop.install() first.')
+        self.events = events.EventDispatcher(self.loop,
+                                             max_workers=core.get('listener_workers', 4),
+                                             default_timeout=core.get('listener_timeout', 10.0))
+        ccfg = config.get('commands', {})
+        self.commands = commands.CommandRouter(prefixes=ccfg.get('prefixes', ['!']),
+                                               user_limit=tuple(ccfg.get('user_rate', (5, 10.0))),
+                                               channel_limit=tuple(ccfg.get('channel_rate', (20, 10.0))),
+                                               run_in_worker=self.events.run_in_worker)
 
         #Handle IRC part of config
+        self.profiler.phase('irc')
         self._twisted_thread = None  #this will contain a handle to the reactor.run() thread later
         icfg = config['irc']
-        IRCBotTuple = namedtuple('IRCBotTuple', ('connector', 'factory'))
         self.ircbots = {}
-        bot_info = irc.IRCBotInfo(nickname=icfg['nick'], ident=icfg['ident'], realname=icfg['realname'])
-        for server, server_info in icfg['servers'].items():
-            factory = irc.IRCBotFactory(bot_info, server_info['channels'], server, self)
-            #the bots won't *actually* connect until reactor.run()
-            connector = reactor.connectTCP(server_info['host'], server_info['port'], factory)
-            self.ircbots[server] = IRCBotTuple(connector, factory)
+        #network name -> the irc.IRCNetwork of the network, or the shard.RemoteNetwork standing in for it
+        self.irc_networks = {}
+        self.shard_hub = None
+        irc_shards = core.get('irc_shards', 0)
+        if irc_shards > 0:
+            #the IRC connections are run by worker processes, see shard.py
+            from . import shard
+            socket_path = core.get('shard_socket') or os.path.join(tempfile.gettempdir(),
+                                                                   f"pydircbot-{os.getpid()}.sock")
+            self.shard_hub = shard.ShardHub(self.loop,
+                                            icfg,
+                                            irc_shards,
+                                            socket_path,
+                                            self,
+                                            shutdown_timeout=self.shutdown_timeout)
+            self.irc_networks.update(self.shard_hub.networks)
+        else:
+            for server, server_info in icfg['servers'].items():
+                #the bots won't *actually* connect until reactor.run()
+                self._connect_irc(icfg, server, server_info)
 
         #Handle Discord part of config
         #token is done in start()
+        self.profiler.phase('discord')
         self._discord_thread = None
-        discordloop = asyncio.new_event_loop()
-        self.discordbot = disc.DiscordBot(adapter=self, loop=discordloop)
-        for channel, url in config['discord']['webhooks'].items():
-            self.discordbot.add_webhook(url, channel)
+        if self.single_loop:
+            discordloop = self.loop
+        else:
+            discordloop = asyncio.new_event_loop()
+        coalesce_config = config['discord'].get('coalesce', {})
+        self.discordbot = disc.DiscordBot(adapter=self,
+                                          loop=discordloop,
+                                          coalesce_window=coalesce_config.get('window', 0),
+                                          coalesce_max_delay=coalesce_config.get('max_delay', 0))
+        for channel, urls in config['discord']['webhooks'].items():
+            self.discordbot.add_webhook(urls, channel)
 
         #Set up the IRC-Discord relay mapping
-        #each entry in our channel_mapping has a list of recipients that messages in that channel are forwarded to
-        self.channel_mapping = cmap = {}
-        for mapping in config['channel_mapping']:
-            irc_channel = (mapping['irc_network'], mapping['irc_channel'])
-            discord_channel = mapping['discord_channel']
-            irc_recipients = cmap.setdefault(irc_channel, list())
-            irc_recipients.append(discord_channel)
-            discord_recipients = cmap.setdefault(discord_channel, list())
-            discord_recipients.append(irc_channel)
+        #every channel in the channel_mapping gets a list of routes that messages in that channel are relayed to
+        #messages to destinations that are unavailable are spooled and replayed when they come back
+        self.profiler.phase('routing')
+        scfg = config.get('spool', {})
+        spool_directory = scfg.get('directory', 'spool')
+        if spool_directory is not None:
+            spool_directory = os.path.join(get_location(), spool_directory)
+        self.spooler = spool.Spooler(spool_directory,
+                                     max_memory=scfg.get('max_memory', 500),
+                                     ttl=scfg.get('ttl', 3600.0),
+                                     replay_interval=scfg.get('replay_interval', 0.25))
+        self.routing = routing.RoutingTable(config['channel_mapping'], self.spooler, self.loop)
+        self.routing.bind_discord(self.discordbot)
+        for server, network in self.irc_networks.items():
+            self.routing.bind_irc(server, network)
+
+        #Set up echo suppression, for when other relays share our channels
+        self.echo = None
+        ecfg = config.get('echo', {})
+        if ecfg.get('enabled', True):
+            self.echo = echo.EchoSuppressor(window=ecfg.get('window', 30.0),
+                                            max_hops=ecfg.get('max_hops', 2),
+                                            hop_markers=ecfg.get('hop_markers', echo.DEFAULT_HOP_MARKERS),
+                                            max_entries=ecfg.get('max_entries', 10000))
 
+        #Set up the content filter, which decides what's relayed before anything else sees the message
+        self.content_filter = filters.content_filter(config.get('filters'))
+
+        #Set up the scrollback
+        self.profiler.phase('history')
+        self.history = None
+        hcfg = config.get('history', {})
+        if hcfg.get('enabled', True):
+            self.history = history.HistoryStore(os.path.join(get_location(), hcfg.get('directory', 'history')),
+                                                segment_size=hcfg.get('segment_size', 4 * 1024 * 1024),
+                                                max_segments=hcfg.get('max_segments', 16),
+                                                max_age=hcfg.get('max_age_days', 30) * 24 * 3600,
+                                                flush_interval=hcfg.get('flush_interval', 1.0),
+                                                loop=self.loop)
+            self._backlog_lines = hcfg.get('backlog_lines', 10)
+            self._backlog_max = hcfg.get('backlog_max', 25)
+            self.commands.register('backlog',
+                                   self._backlog_command,
+                                   max_args=1,
+                                   usage='[lines]',
+                                   help_text='Shows the last messages in this channel and the ones bridged to it.')
+
+        #Set up the traffic capture
+        self.capture = None
+        ccfg = config.get('capture', {})
+        if ccfg.get('enabled', False):
+            self.capture = capture.CaptureWriter(os.path.join(get_location(), ccfg.get('path', 'capture.jsonl')),
+                                                 flush_interval=ccfg.get('flush_interval', 1.0),
+                                                 loop=self.loop)
+
+        #Set up metrics
+        self.profiler.phase('metrics')
+        metrics.IRC_QUEUE_DEPTH.callback = self._irc_queue_depth_metric
+        metrics.install_discord_rate_limit_handler()
+        mcfg = config.get('metrics', {})
+        if mcfg.get('enabled', False):
+            #like the IRC connections, this doesn't actually start listening until the reactor runs
+            metrics.listen(mcfg.get('host', '127.0.0.1'), mcfg.get('port', 9464))
+        self.profiler.end_phase()
 
     def start(self):
         """ Starts the bot, connecting to IRC and Discord and whatnot.
         Also runs the command line. Blocking. """
         logging.info('Starting bot.')
+        windows = sys.platform == 'win32'
+        if not windows:
+            self.loop.add_signal_handler(signal.SIGINT, self.stop)
+            self.loop.add_signal_handler(signal.SIGTERM, self.stop)
+            self.loop.add_signal_handler(signal.SIGHUP, self.reload_config)
+
+        if self.shard_hub is not None:
+            self.loop.create_task(self.shard_hub.start())
+
+        token = self.config_manager.config['discord']['token']
+        if self.single_loop:
+            #everything runs on our loop: discord.py as a task and Twisted through the asyncio reactor,
+            #whose run() runs the loop until the reactor is stopped
+            self.loop.create_task(self.discordbot.start(token))
+            reactor.run(installSignalHandlers=False)
+            return
+
         #reactor.run() is blocking so we run it in a separate thread
         #if we want the reactor to do something we must use thread-safe methods
         #such as reactor.callFromThread()
-        self._twisted_thread = Thread(target=lambda: reactor.run(installSignalHandlers=False), name="twistedthread")
+        #the threads are daemonic so that one that hangs on shutdown can't keep the process alive
+        self._twisted_thread = Thread(target=lambda: reactor.run(installSignalHandlers=False),
+                                      name="twistedthread",
+                                      daemon=True)
         self._twisted_thread.start()
 
         #unlike twisted, discord.py uses the common asyncio stuff and can (should) be ran as a task
         #but we'll run it in a thread anyway because it means we need to override discord.py less
-        token = self.config_manager.config['discord']['token']
-        self._discord_thread = Thread(target=lambda: self.discordbot.run(token), name="discordthread")
+        self._discord_thread = Thread(target=lambda: self.discordbot.run(token), name="discordthread", daemon=True)
         self._discord_thread.start()
 
         #run our event loop
-        windows = sys.platform == 'win32'
-        if not windows:
-            self.loop.add_signal_handler(signal.SIGINT, self.stop)
-            self.loop.add_signal_handler(signal.SIGTERM, self.stop)
         self.loop.run_forever()
 
     def stop(self):
-        """ Cleanly stops all the bots. """
+        """ Starts shutting the bot down, see _shutdown(). """
+        if self._stopping:
+            logging.info('Already stopping.')
+            return
+        self._stopping = True
         logging.info('Received command to stop.')
-        for server, ircbottuple in self.ircbots.items():
-            connector, factory = ircbottuple
-            logging.debug('Quitting from IRC server %s', server)
-            quitmessage = self.config_manager.config['irc']['quitmessage']
-            blockingCallFromThread(reactor, factory.bot.quit, (quitmessage, ))
-            logging.debug('Disconnecting IRC connector for %s.', server)
-            connector.disconnect()
-        logging.debug('Finished disconnecting IRC connectors. Stopping reactor.')
-        reactor.stop()
-        logging.debug('Stopped reactor.')
-        logging.debug('Stopping Discord bot.')
-        self.discordbot.stop()
-        logging.info('Waiting for Twisted thread to terminate.')
-        #wait for threads to terminate... hopefully this will happen.
-        self._twisted_thread.join()
-        logging.info('Waiting for Discord thread to terminate.')
-        self._discord_thread.join()
-        logging.debug('Threads have terminated, stopping event loop.')
-
-        #stop our event loop
+        self.loop.create_task(self._shutdown())
+
+    async def _shutdown(self):
+        """
+        Shuts everything down within core.shutdown_timeout seconds. The IRC networks, the IRC shards and Discord are
+        shut down at the same time: what's queued for them is sent until the deadline approaches, and then we quit from
+        all the IRC networks at once and log out of Discord. What didn't make it is logged.
+        """
+        started = self.loop.time()
+        timeout = self.shutdown_timeout
+        #every step has to be done by the same deadline, a bit before the timeout, so that what overran it can be
+        #killed and cleaned up before the timeout cuts the step off
+        margin = min(0.5, timeout / 10)
+        deadline = started + timeout - margin
+        #the last bit of the time is left for the QUITs to go out and the connections to close
+        quit_timeout = min(1.0, timeout / 4)
+        drain_timeout = max(0.0, timeout - margin - quit_timeout)
+        quitmessage = self.config_manager.config['irc']['quitmessage']
+        logging.info('Shutting down, giving queued messages up to %.1f seconds to go out.', drain_timeout)
+        steps = {
+            'IRC': irc.shutdown(list(self.ircbots.values()), quitmessage, drain_timeout, quit_timeout),
+            'Discord': eventloop.run_in_loop(self.discordbot.shutdown(drain_timeout), self.discordbot.loop)
+        }
+        if self.shard_hub is not None:
+            steps['IRC shards'] = self.shard_hub.stop(deadline)
+        results = await asyncio.gather(*(asyncio.wait_for(step, timeout) for step in steps.values()),
+                                       return_exceptions=True)
+        dropped = {}
+        for name, result in zip(steps, results):
+            if isinstance(result, asyncio.TimeoutError):
+                logging.warning('%s did not shut down in time.', name)
+            elif isinstance(result, Exception):
+                logging.error('Shutting down %s failed: %r', name, result)
+            elif name == 'IRC':
+                dropped.update((f"lines to {network}", lines) for network, lines in result.items())
+            elif name == 'Discord':
+                dropped['lines to Discord'] = result
+            else:
+                dropped['messages to IRC shards that were down'] = result
+
+        self.events.close()
+        dropped['spooled messages (memory only)'] = self.spooler.close()
+        if self.history is not None:
+            self.history.close()
+        if self.capture is not None:
+            self.capture.close()
+        dropped = {what: count for what, count in dropped.items() if count}
+        if dropped:
+            logging.warning('Shut down in %.1f seconds, dropping %s.', self.loop.time() - started,
+                            ', '.join(f"{count} {what}" for what, count in dropped.items()))
+        else:
+            logging.info('Shut down in %.1f seconds, nothing was dropped.', self.loop.time() - started)
+
+        if self.single_loop:
+            #stopping the reactor also stops the shared event loop
+            reactor.stop()
+            return
+        reactor.callFromThread(reactor.stop)
+        for thread in (self._twisted_thread, self._discord_thread):
+            thread.join(max(0.0, started + timeout - self.loop.time()))
+            if thread.is_alive():
+                logging.warning('Thread %s did not terminate in time, leaving it behind.', thread.name)
         self.loop.stop()
 
     async def user_input(self):
         """ Simple command prompt. """
+        #only imported here so that headless bots don't pay for it
+        import aioconsole
         while self.loop.is_running():
             try:
                 cmd = await aioconsole.ainput("Enter 'quit' to close.\n")
@@ -124,39 +300,126 @@ class PyDIRCBot():
             if cmd == 'quit':
                 self.stop()
                 break
+            if cmd == 'reload':
+                self.reload_config()
+
+    def _connect_irc(self, icfg, server, server_info):
+        """ Creates the IRCNetwork of an IRC server and starts connecting to it. Must be called from the reactor thread
+        (or before the reactor runs). """
+        network = irc.make_network(icfg, server, server_info, self)
+        network.connect(server_info['host'], server_info['port'])
+        self.ircbots[server] = network
+        self.irc_networks[server] = network
+        return network
+
+    def _disconnect_irc(self, server, quitmessage):
+        """ Quits from an IRC server and forgets it. Must be called from the reactor thread. """
+        self.irc_networks.pop(server, None)
+        self.ircbots.pop(server).disconnect(quitmessage)
+
+    def reload_config(self):
+        """
+        Re-reads the config file and applies the changes without restarting: IRC servers that were added or removed
+        (or whose host or port changed) are connected or disconnected, channels are joined or parted, and the flood,
+        line splitting and membership relay settings, webhooks, content filters and channel mapping are updated.
+        Connections that didn't change stay up. Changes to other settings take effect on the next restart. If the new
+        config is invalid, nothing is changed.
+        """
+        try:
+            old, (irc_settings, content_filter) = self.config_manager.reload(self._prepare_config)
+        except (ValueError, OSError) as ex:
+            logging.error('Not reloading the config: %s', ex)
+            return
+        new = self.config_manager.config
+        logging.info('Reloading the config.')
+        #routes in both the old and the new mapping keep their bindings and spools, new ones are bound below
+        added, removed = self.routing.update(new['channel_mapping'])
+        if added or removed:
+            logging.info('Channel mapping updated: %d routes added, %d removed.', len(added), len(removed))
+        if self.shard_hub is not None:
+            if any(old['irc'].get(key) != new['irc'].get(key) for key in ('servers', 'flood', 'split', 'membership')):
+                logging.warning('IRC server changes take effect on the next restart in sharded mode.')
+            for network, remote in self.irc_networks.items():
+                self.routing.bind_irc(network, remote)
+        else:
+            eventloop.call_in_reactor(self._apply_irc_changes, old['irc'], new['irc'], irc_settings)
+        eventloop.call_in_loop(self.discordbot.loop, self._apply_discord_changes, new['discord']['webhooks'])
+        if old.get('filters') != new.get('filters'):
+            self.content_filter = content_filter
+        for section in ('core', 'commands', 'spool', 'echo', 'history', 'capture', 'metrics'):
+            if old.get(section) != new.get(section):
+                logging.warning('Changes to the %s section take effect on the next restart.', section)
+        for key in ('nick', 'ident', 'realname'):
+            if old['irc'][key] != new['irc'][key]:
+                logging.warning('Changes to irc.%s take effect on the next restart.', key)
+
+    @staticmethod
+    def _prepare_config(config):
+        """ Builds the settings a reloaded config is applied with, so that a config with invalid values is rejected
+        before any of it is applied. Returns (server -> (flood, split, membership relay settings), content filter).
+        Raises a ValueError if any of them is invalid. """
+        icfg = config['irc']
+        irc_settings = {}
+        for server, server_info in icfg['servers'].items():
+            try:
+                irc_settings[server] = (flood.flood_settings(icfg.get('flood'), server_info.get('flood')),
+                                        linesplit.split_settings(icfg.get('split'), server_info.get('split')),
+                                        membership.membership_settings(icfg.get('membership'),
+                                                                       server_info.get('membership')))
+            except ValueError as ex:
+                raise ValueError(f"{server}: {ex}") from ex
+        return irc_settings, filters.content_filter(config.get('filters'))
+
+    def _apply_irc_changes(self, old, new, settings):
+        """ Applies the changes between two versions of the irc section of the config, with the settings of the
+        servers built by _prepare_config(). Runs in the reactor thread. """
+        old_servers, new_servers = old['servers'], new['servers']
+        for server, server_info in old_servers.items():
+            new_info = new_servers.get(server)
+            if new_info is None or irc.connection_settings(new, new_info) != irc.connection_settings(old, server_info):
+                logging.info('Disconnecting from %s.', server)
+                self._disconnect_irc(server, old['quitmessage'])
+                self.routing.bind_irc(server, None)
+        for server, server_info in new_servers.items():
+            network = self.irc_networks.get(server)
+            if network is None:
+                logging.info('Connecting to %s.', server)
+                self.routing.bind_irc(server, self._connect_irc(new, server, server_info))
+                continue
+            network.set_channels(server_info['channels'])
+            flood_settings, split_settings, membership_settings = settings[server]
+            if flood_settings != network.flood_settings:
+                network.set_flood_settings(flood_settings)
+            if split_settings != network.split_settings:
+                network.set_split_settings(split_settings)
+            if membership_settings != network.membership_settings:
+                network.set_membership_settings(membership_settings)
+            #binds the routes the new mapping added
+            self.routing.bind_irc(server, network)
+
+    def _apply_discord_changes(self, webhooks):
+        """ Switches to the given webhooks and (re)binds the Discord routes. Runs in the Discord thread. """
+        self.discordbot.set_webhooks(webhooks)
+        self.routing.bind_discord(self.discordbot)
 
     def relay_message(self, message):
         """
         Relays the message to all the recipients of the channel it was sent on.
         """
-        message_content = str(message)
-        i = 0
-        for recipient in self._get_recipient_list(message.source):
-            #this is a little bad, but it's the only way to figure out where the message is being relayed to
-            if isinstance(recipient, int):
-                #it's a Discord message so let's see if there's a webhook for this channel
-                webhook = self.discordbot.webhooks_by_channel.get(recipient)
-                if webhook is not None:
-                    #there's a webhook so we'll use that for nicer formatting
-                    logging.debug('Relaying Discord message via webhook.')
-                    #this seems to produce a pylint false positive
-                    #pylint:disable=assignment-from-no-return
-                    coro = self.discordbot.relay_via_webhook(recipient, message)
-                    asyncio.run_coroutine_threadsafe(coro, self.discordbot.loop)
-                else:
-                    #there's no webhook, fall back to regular message
-                    nick = f"**<{message.simple_sender}>** "
-                    self._really_send_message(recipient, nick + message_content)
-            # elif isinstance(recipient, tuple):
-            #     #it's an IRC message. This is commented out because we don't need any special IRC behaviour for now.
-            #     pass
-            else:
-                #it really shouldn't be anything else but this is a safe default
-                nick = f"<{message.simple_sender}> "
-                self._really_send_message(recipient, nick + message_content)
-            i += 1
-        if i > 0:
-            logging.debug('Relayed message to %d recipients.', i)
+        routes = self.routing.routes(message.route_key)
+        if not routes:
+            return
+        if self.echo is not None:
+            verdict = self.echo.check(message)
+            if verdict is not None:
+                logging.debug('Not relaying %s from %s, it looks like a relay %s.', message.route_key,
+                              message.simple_sender, verdict)
+                metrics.ECHOES_DROPPED.inc(reason=verdict)
+                return
+            self.echo.remember(message)
+        for route in routes:
+            route.relay(message)
+        logging.debug('Relayed message to %d recipients.', len(routes))
 
     ###############
     #"API" methods#
@@ -171,22 +434,21 @@ class PyDIRCBot():
 
         if isinstance(target, discord.abc.Messageable):
             logging.debug("send_message: sending Discord message via Messageable.")
-            coro = target.send(content=message)
-            asyncio.run_coroutine_threadsafe(coro, self.discordbot.loop)
+            coro = self.discordbot.send_to_channel(target, message)
+            eventloop.submit(coro, self.discordbot.loop)
         elif isinstance(target, int):
             logging.debug("send_message: sending Discord message via channel ID.")
             channel = self.discordbot.get_channel(target)
             if channel is None:
                 raise ValueError(f"Channel {target} not found.")
-            coro = channel.send(content=message)
-            asyncio.run_coroutine_threadsafe(coro, self.discordbot.loop)
+            coro = self.discordbot.send_to_channel(channel, message)
+            eventloop.submit(coro, self.discordbot.loop)
         elif isinstance(target, tuple):
             logging.debug("send_message: sending IRC message via ('server', 'target').")
             server, user = target
-            if not server in self.ircbots:
+            if not server in self.irc_networks:
                 raise ValueError(f"Server {server} not found.")
-            ircbot = self.ircbots[server].factory.bot
-            reactor.callFromThread(ircbot.msg, user, message)
+            self.irc_networks[server].send(user, message)
         else:
             raise ValueError("Invalid type for 'target'.")
 
@@ -196,16 +458,7 @@ class PyDIRCBot():
         instead of Messageable we only care about channels, not users, so we check for public channel types instead.
         Private channels aren't be supported (for now?).
         """
-        if isinstance(target, discord.TextChannel):
-            key = target.id
-        elif isinstance(target, int):
-            key = target
-        elif isinstance(target, tuple):
-            key = target
-        else:
-            key = None
-        recipients = self.channel_mapping.get(key, list()) #return an empty list by default
-        return recipients
+        return [route.target for route in self.routing.routes_for_target(target)]
 
     async def send_message(self, target, message):
         """
@@ -228,33 +481,164 @@ class PyDIRCBot():
         """
         self._really_send_message(target, message)
 
+    def irc_queue_depths(self):
+        """ Returns a dict of IRC server -> {target: number of lines waiting in the outbound queue}.
+        Should be called from the reactor thread. """
+        return {server: network.queue_depths() for server, network in self.ircbots.items()}
+
+    def _irc_queue_depth_metric(self):
+        """ Collects the values of the IRC queue depth gauge. """
+        return {(server, target): depth
+                for server, depths in self.irc_queue_depths().items()
+                for target, depth in depths.items()}
+
+    def irc_signed_on(self, network, factory):
+        """ Called by an IRCBot once it has signed on to its network. """
+        if self.irc_networks.get(network) is not factory:
+            #a connection to a server that a config reload removed
+            return
+        self.profiler.mark(f"{network} signed on")
+        self.routing.bind_irc(network, factory)
+
+    def irc_disconnected(self, network):
+        """ Called when the connection to an IRC network is lost. Routes notice on their own, this is for logging. """
+        logging.debug('Disconnected from %s.', network)
+
+    def irc_casemapping_changed(self, network, casemapping):
+        """ Called by an IRCBot when the server tells which CASEMAPPING it uses. """
+        logging.debug('%s uses CASEMAPPING %s.', network, casemapping)
+        self.routing.set_casemapping(network, casemapping)
+        eventloop.call_in_loop(self.loop, self.events.set_casemapping, network, casemapping)
+
+    def irc_membership(self, network, channel, text):
+        """ Called with a notice of the membership events (joins, parts, quits...) on an IRC channel, see
+        membership.MembershipRelay. """
+        eventloop.call_in_loop(self.loop, self._relay_membership, network, channel, text)
+
+    def _relay_membership(self, network, channel, text):
+        """ Relays a membership notice to the Discord channels bridged with the IRC channel, as sent by the
+        network. """
+        for route in self.routing.routes(self.routing.irc_key(network, channel)):
+            if isinstance(route, routing.DiscordRoute):
+                route.relay_text(network, formatting.escape_markdown(text))
+
+    def discord_ready(self):
+        """ Called by the DiscordBot whenever it has (re)connected and its channels may have changed. """
+        self.profiler.mark('Discord ready')
+        self.routing.bind_discord(self.discordbot)
+
+    def discord_send_failed(self, channel_id, sender, text):
+        """ Called by the DiscordBot when relaying to a channel failed because Discord couldn't be reached. """
+        route = self.routing.discord_routes.get(channel_id)
+        if route is not None:
+            route.respool(sender, text)
+
+    def discord_send_recovered(self, channel_id):
+        """ Called by the DiscordBot when relaying to a channel worked again after failing. """
+        route = self.routing.discord_routes.get(channel_id)
+        if route is not None:
+            route.recovered()
+
+    ############
+    #Scrollback#
+    ############
+
+    def backlog(self, target, count, bridged=True):
+        """
+        Returns the last count messages seen in target, oldest first, as history.HistoryEntry objects. target can be
+        anything send_message() supports. If bridged is True, the messages of the channels bridged with target are
+        included. Only bridged channels have a history. Must be called from the core event loop's thread.
+        """
+        return self.history.last(self._history_keys(target, bridged), count)
+
+    def history_between(self, target, start, end=None, bridged=True):
+        """ Like backlog(), but returns the messages from start to end (UNIX timestamps, end exclusive, None for now)
+        instead of the last count. """
+        return self.history.between(self._history_keys(target, bridged), start, end)
+
+    def _history_keys(self, target, bridged):
+        if self.history is None:
+            raise ValueError("The history is disabled.")
+        key = self.routing.key_for_target(target)
+        return self.routing.bridged_keys(key) if bridged else [key]
+
+    async def _backlog_command(self, message, lines=None):
+        """ The backlog command. """
+        try:
+            count = self._backlog_lines if lines is None else int(lines)
+        except ValueError:
+            return f"Usage: {self.commands.default_prefix}backlog [lines]"
+        count = max(1, min(count, self._backlog_max))
+        entries = self.history.last(self.routing.bridged_keys(message.route_key), count + 1)
+        #the command itself is already in the history, as the content filter left it, but messages may have come in
+        #after it
+        recorded = message
+        if self.content_filter is not None:
+            recorded = self.content_filter.apply(message, count=False)[0] or message
+        own = (message.protocol.name.lower(), message.network, message.channel, message.simple_sender, recorded.message)
+        for position in range(len(entries) - 1, -1, -1):
+            if entries[position][1:] == own:
+                del entries[position]
+                break
+        entries = entries[-count:]
+        if not entries:
+            return "No history here."
+        lines = [f"[{time.strftime('%H:%M', time.localtime(entry.time))}] <{entry.sender}> {entry.text}"
+                 for entry in entries]
+        if message.protocol is message.Protocol.DISCORD:
+            #leave out the oldest lines that don't fit in a Discord message
+            length = 0
+            for first in range(len(lines) - 1, -1, -1):
+                length += len(lines[first]) + 1
+                if length > coalesce.MAX_MESSAGE_LENGTH:
+                    lines = lines[first + 1:]
+                    break
+        return '\n'.join(lines)
+
     ########
     #Events#
     ########
 
-    #Supported event types that can be registered for
-    event_listeners = {"MESSAGE_RECEIVED": set()}
+    def register_event(self, event_type, listener, protocol=None, network=None, channel=None, timeout=None):
+        """
+        Registers an event listener to listen to an event. The listener may be a regular function or a coroutine
+        function. Regular functions are called in a worker thread, so they must only use thread-safe methods
+        (like IMessage.reply). The listener can be limited to messages from a given protocol (IMessage.Protocol),
+        network (IRC network name or Discord guild id) and/or channel (IRC channel name or Discord channel id).
+        timeout is how many seconds the listener may take, by default core.listener_timeout from the config.
+        """
+        self.events.register(event_type, listener, protocol, network, channel, timeout)
 
-    def register_event(self, event_type, listener):
-        """ Registers an event listener to listen to an event. """
-        if event_type not in self.event_listeners:
-            raise ValueError("Invalid event type.")
-        self.event_listeners[event_type].add(listener)
+    def unregister_event(self, event_type, listener):
+        """ Unregisters an event listener from the given event. """
+        self.events.unregister(event_type, listener)
 
-    #We're not doing dynamic event registration yet (if ever),
-    #all events must be registered before running the bot.
-    # def unregister_event(self, event_type, listener):
-    #   """ Unregisters an event listener from the given event. """
-    #   if event_type not in self.event_listeners:
-    #     raise ValueError("Invalid event type.")
-    #   self.event_listeners[event_type].discard(listener)
+    def register_command(self, name, handler, **kwargs):
+        """ Registers a chat command. See commands.CommandRouter.register() and commands.Command. """
+        return self.commands.register(name, handler, **kwargs)
 
     #actual event callers
     async def message_received(self, message):
         """ Called when a message is received.
-        Fires all event listeners listening to the MESSAGE_RECEIVED event.
+        Runs the content filter, which decides what's relayed and kept in the history, then relays the message and fires
+        all event listeners listening to the MESSAGE_RECEIVED event (and FILTER_MATCHED, if filter rules matched).
+        Commands and listeners get the message as it was received; dropped messages don't run commands.
         message is an object inheriting from adapters.IMessage. """
-        self.relay_message(message)
-        logging.debug('Firing MESSAGE_RECEIVED listeners.')
-        for listener in self.event_listeners["MESSAGE_RECEIVED"]:
-            listener(message)
+        protocol = message.protocol.name.lower()
+        if message.received_at is not None:
+            metrics.DISPATCH_DELAY_SECONDS.observe(time.perf_counter() - message.received_at, protocol=protocol)
+        with metrics.DISPATCH_SECONDS.time(protocol=protocol):
+            relayed, matches = message, ()
+            if self.content_filter is not None:
+                relayed, matches = self.content_filter.apply(message)
+            if self.routing.routes(message.route_key):
+                if self.history is not None and relayed is not None:
+                    self.history.record(relayed)
+                if self.capture is not None:
+                    self.capture.record(message)
+            if relayed is not None:
+                self.relay_message(relayed)
+                self.commands.dispatch(message, self.loop)
+            if matches:
+                self.events.dispatch("FILTER_MATCHED", message, matches)
+            self.events.dispatch("MESSAGE_RECEIVED", message)
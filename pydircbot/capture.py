@@ -0,0 +1,72 @@
+""" Traffic capture: a record of the messages seen in bridged channels, for replaying them in load tests. """
+
+import json
+import logging
+import time
+from collections import namedtuple
+
+#a namedtuple holding a captured message. time is a UNIX timestamp, protocol is 'irc' or 'discord', network is the IRC
+#network or the Discord guild id, sender is nick!user@host on IRC and the display name on Discord, and text is the
+#message as it was received, with the IRC formatting or Discord markdown left in
+CapturedMessage = namedtuple('CapturedMessage', ['time', 'protocol', 'network', 'channel', 'sender', 'text'])
+
+
+class CaptureWriter():
+    """
+    Appends received messages to a capture file, one JSON array per line in the order of CapturedMessage's fields.
+    Writes are buffered and flushed `flush_interval` seconds after the first unflushed one, so capturing doesn't cost a
+    system call per message. Without a loop, writes are flushed when a message comes in at least `flush_interval`
+    seconds after the last flush. Must only be used from the core event loop's thread.
+    """
+
+    def __init__(self, path, flush_interval=1.0, loop=None):
+        self.path = path
+        self.flush_interval = flush_interval
+        self._file = open(path, 'a', encoding='utf-8')
+        self._loop = loop
+        self._flush_timer = None
+        self._last_flush = time.monotonic()
+        self.count = 0
+
+    def record(self, message):
+        """ Captures an IMessage. """
+        if message.protocol is message.Protocol.IRC:
+            sender = message.sender
+        else:
+            sender = message.simple_sender
+        entry = CapturedMessage(round(time.time(), 3), message.protocol.name.lower(), message.network, message.channel,
+                                sender, message.message_as(message.protocol))
+        self._file.write(json.dumps(entry, ensure_ascii=False, separators=(',', ':')) + '\n')
+        self.count += 1
+        if self._loop is not None:
+            if self._flush_timer is None:
+                self._flush_timer = self._loop.call_later(self.flush_interval, self.flush)
+        elif time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """ Writes out the buffered messages. """
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            self._flush_timer = None
+        self._file.flush()
+        self._last_flush = time.monotonic()
+
+    def close(self):
+        """ Flushes and closes the capture file. """
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            self._flush_timer = None
+        self._file.close()
+        logging.info('Captured %d messages to %s.', self.count, self.path)
+
+
+def read_capture(path):
+    """ Yields the CapturedMessages in a capture file, skipping lines that can't be parsed (eg. the last line of a
+    capture that was cut short). """
+    with open(path, encoding='utf-8') as capture:
+        for number, line in enumerate(capture, 1):
+            try:
+                yield CapturedMessage(*json.loads(line))
+            except (ValueError, TypeError):
+                logging.warning('Skipping unreadable line %d of %s.', number, path)
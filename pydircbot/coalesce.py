@@ -0,0 +1,135 @@
+""" Merges bursts of relayed lines into fewer, bigger messages. """
+
+import asyncio
+import logging
+
+#Discord's message length limit
+MAX_MESSAGE_LENGTH = 2000
+
+
+class _Batch():
+    """ Lines waiting to be sent together. """
+
+    def __init__(self, sender, extra, started):
+        self.sender = sender
+        self.extra = extra
+        self.lines = []
+        self.length = 0
+        self.started = started
+        self.timer = None
+
+
+class Coalescer():
+    """
+    Coalesces consecutive lines from the same sender to the same destination into a single message.
+
+    A line arriving when the destination has been quiet for at least `window` seconds is sent right away, so single
+    lines are never delayed. Lines arriving within `window` of the previous send are collected instead and sent
+    together once no new line has arrived for `window` seconds, but at most `max_delay` seconds after the first
+    collected line. A batch is also sent early if the sender changes or the next line wouldn't fit in `max_length`.
+
+    send is a coroutine function called as send(destination, sender, text, extra), where extra is whatever was
+    given to add() with the first line of the batch (eg. an avatar URL). Sends to a destination happen one after
+    another, in the order the lines were added. If order_key is given, it's called as order_key(destination, sender)
+    and only the sends with the same key are kept in order, the others may overlap. Must only be used from the event
+    loop's thread.
+    """
+
+    def __init__(self, send, window, max_delay, max_length=MAX_MESSAGE_LENGTH, loop=None, order_key=None):
+        self._send = send
+        self._order_key = order_key
+        self.window = window
+        self.max_delay = max(max_delay, window)
+        self.max_length = max_length
+        self._loop = loop
+        self._batches = {}  #destination -> _Batch
+        self._last_sent = {}  #destination -> loop time of the last send
+        self._locks = {}  #order key -> [asyncio.Lock, number of sends holding or waiting for it]
+        self._in_flight = {}  #send task -> number of lines it sends
+
+    @property
+    def loop(self):
+        """ The event loop the coalescer runs on. """
+        if self._loop is None:
+            self._loop = asyncio.get_event_loop()
+        return self._loop
+
+    def add(self, destination, sender, text, extra=None):
+        """ Adds a line to be sent to destination. """
+        now = self.loop.time()
+        batch = self._batches.get(destination)
+        if batch is not None and (batch.sender != sender or batch.length + 1 + len(text) > self.max_length):
+            self._flush_later(destination, 0)
+            batch = None
+
+        if batch is None:
+            if self.window <= 0 or now - self._last_sent.get(destination, -self.window) >= self.window:
+                #the destination has been quiet, don't delay the line
+                self._last_sent[destination] = now
+                self._spawn(self._really_send(destination, sender, text, extra), 1)
+                return
+            batch = self._batches[destination] = _Batch(sender, extra, now)
+
+        batch.lines.append(text)
+        batch.length += len(text) + (1 if len(batch.lines) > 1 else 0)
+        self._flush_later(destination, min(self.window, batch.started + self.max_delay - now))
+
+    def _flush_later(self, destination, delay):
+        batch = self._batches[destination]
+        if batch.timer is not None:
+            batch.timer.cancel()
+        if delay <= 0:
+            del self._batches[destination]
+            self._last_sent[destination] = self.loop.time()
+            #the send tasks take their lock before anything else, so they're sent in creation order
+            self._spawn(self._send_batch(destination, batch), len(batch.lines))
+        else:
+            batch.timer = self.loop.call_later(delay, self._flush_later, destination, 0)
+
+    def _spawn(self, coro, lines):
+        task = self.loop.create_task(coro)
+        self._in_flight[task] = lines
+        task.add_done_callback(lambda task: self._in_flight.pop(task, None))
+
+    async def flush(self, timeout=None):
+        """ Sends all pending batches right away and waits until everything has been sent, or for at most timeout
+        seconds. Sends that haven't finished by then are cancelled. Returns the number of lines that weren't sent. """
+        for destination, batch in self._batches.items():
+            if batch.timer is not None:
+                batch.timer.cancel()
+            self._spawn(self._send_batch(destination, batch), len(batch.lines))
+        self._batches.clear()
+        if not self._in_flight:
+            return 0
+        _, unfinished = await asyncio.wait(list(self._in_flight), timeout=timeout)
+        dropped = sum(self._in_flight.get(task, 0) for task in unfinished)
+        for task in unfinished:
+            task.cancel()
+        return dropped
+
+    def pending(self):
+        """ Returns the number of lines waiting to be sent or being sent. """
+        return sum(len(batch.lines) for batch in self._batches.values()) + sum(self._in_flight.values())
+
+    async def _send_batch(self, destination, batch):
+        if len(batch.lines) > 1:
+            logging.debug('Coalesced %d lines into one message.', len(batch.lines))
+        await self._really_send(destination, batch.sender, '\n'.join(batch.lines), batch.extra)
+
+    async def _really_send(self, destination, sender, text, extra):
+        key = self._order_key(destination, sender) if self._order_key is not None else destination
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                try:
+                    await self._send(destination, sender, text, extra)
+                except Exception:  #pylint:disable=broad-except
+                    logging.exception('Failed to send coalesced message to %s.', destination)
+        finally:
+            #there's a key per sender with order_key, forget them once they're idle
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
@@ -0,0 +1,202 @@
+""" Chat commands, eg. "!help". """
+
+import asyncio
+import logging
+import shlex
+import time
+
+
+class SlidingWindowCounter():
+    """
+    Rate limits events per key to `limit` events per `window` seconds.
+    Uses the sliding window counter approximation: the count of the previous fixed window, weighted by how much of it
+    still overlaps the sliding window, plus the count of the current fixed window. This needs O(1) memory per key.
+    """
+
+    def __init__(self, limit, window, clock=time.monotonic):
+        self.limit = limit
+        self.window = window
+        self._clock = clock
+        self._counts = {}  #key -> [start of the current fixed window, previous count, current count]
+
+    def allow(self, key):
+        """ Counts an event for key and returns True, unless key is over the limit, in which case returns False
+        (and the event isn't counted). """
+        now = self._clock()
+        counts = self._counts.get(key)
+        if counts is None:
+            if len(self._counts) > 10000:
+                self._prune(now)
+            counts = self._counts[key] = [now, 0, 0]
+        elapsed = now - counts[0]
+        if elapsed >= self.window:
+            #move to a new fixed window. If more than one window has passed, the previous one was empty
+            counts[1] = counts[2] if elapsed < 2 * self.window else 0
+            counts[2] = 0
+            counts[0] += self.window * int(elapsed // self.window)
+            elapsed = now - counts[0]
+        estimate = counts[1] * (1 - elapsed / self.window) + counts[2]
+        if estimate >= self.limit:
+            return False
+        counts[2] += 1
+        return True
+
+    def _prune(self, now):
+        """ Forgets keys that have been idle for long enough not to matter. """
+        self._counts = {key: counts for key, counts in self._counts.items() if now - counts[0] < 2 * self.window}
+
+
+class Command():
+    """
+    A chat command. handler is called as handler(message, *args), where message is the IMessage the command came in
+    and args are the parsed arguments. It can be a regular function (run in a worker thread) or a coroutine function.
+    If it returns a string, the string is sent as a reply.
+
+    Arguments are split like a shell would, so quoted arguments may contain spaces. If greedy is True, the last
+    argument takes the rest of the line as is instead.
+    """
+
+    def __init__(self, name, handler, min_args=0, max_args=None, greedy=False, usage='', help_text=''):
+        if greedy and max_args is None:
+            raise ValueError("Greedy commands must have a max_args.")
+        self.name = name
+        self.handler = handler
+        self.min_args = min_args
+        self.max_args = max_args
+        self.greedy = greedy
+        self.usage = usage
+        self.help_text = help_text
+
+    def parse_args(self, text):
+        """ Returns the arguments in text as a list, or None if they're invalid for this command. """
+        if self.greedy:
+            args = text.split(None, self.max_args - 1) if self.max_args > 0 else []
+        else:
+            try:
+                args = shlex.split(text)
+            except ValueError:  #eg. unbalanced quotes
+                args = text.split()
+        if len(args) < self.min_args or (self.max_args is not None and len(args) > self.max_args):
+            return None
+        return args
+
+
+class CommandRouter():
+    """
+    Finds and runs the commands in incoming messages.
+
+    Commands are indexed by the first character of their prefix, then the prefix, then the name, so telling whether
+    a message is a command at all takes a single set lookup of its first character. Commands are rate limited per
+    user and per channel.
+    """
+
+    def __init__(self, prefixes=('!', ), user_limit=(5, 10.0), channel_limit=(20, 10.0), run_in_worker=None):
+        """ The limits are (number of commands, per seconds). run_in_worker(func, *args) must return an awaitable
+        that runs func in a worker thread (see events.EventDispatcher.run_in_worker). """
+        self._tables = {}  #prefix -> {command name: Command}
+        self._prefixes_by_char = {}  #first character -> prefixes starting with it, longest first
+        self._run_in_worker = run_in_worker
+        self._user_limiter = SlidingWindowCounter(*user_limit)
+        self._channel_limiter = SlidingWindowCounter(*channel_limit)
+        self.default_prefix = prefixes[0]
+        for prefix in prefixes:
+            self.add_prefix(prefix)
+        self.register('help', self._help, max_args=1, usage='[command]', help_text='Lists commands or shows help.')
+
+    def add_prefix(self, prefix):
+        """ Adds a command prefix. Commands registered without a prefix are available with every prefix. """
+        if not prefix:
+            raise ValueError("The prefix must not be empty.")
+        if prefix in self._tables:
+            return
+        table = self._tables[prefix] = {}
+        #commands registered for all prefixes live in the default prefix's table, share them with the new one
+        if prefix != self.default_prefix and self.default_prefix in self._tables:
+            table.update(self._tables[self.default_prefix])
+        prefixes = self._prefixes_by_char.setdefault(prefix[0], [])
+        prefixes.append(prefix)
+        prefixes.sort(key=len, reverse=True)
+
+    def register(self, name, handler, prefix=None, **kwargs):
+        """ Registers a command. The keyword arguments are passed to Command. If prefix is None, the command is
+        available with all the prefixes. Returns the Command. """
+        command = Command(name.lower(), handler, **kwargs)
+        if prefix is None:
+            for table in self._tables.values():
+                table[command.name] = command
+        else:
+            self.add_prefix(prefix)
+            self._tables[prefix][command.name] = command
+        return command
+
+    def command(self, name, **kwargs):
+        """ Decorator version of register(). """
+
+        def decorator(handler):
+            self.register(name, handler, **kwargs)
+            return handler
+
+        return decorator
+
+    def match(self, text):
+        """ Returns (Command, argument text) if text is a command, otherwise None. """
+        if not text:
+            return None
+        prefixes = self._prefixes_by_char.get(text[0])
+        if prefixes is None:
+            return None
+        for prefix in prefixes:
+            if text.startswith(prefix):
+                name, _, rest = text[len(prefix):].partition(' ')
+                command = self._tables[prefix].get(name.lower())
+                if command is not None:
+                    return command, rest.strip()
+        return None
+
+    def dispatch(self, message, loop):
+        """ Runs the command in the message, if there is one, as a task on loop. Returns True if the message was
+        a command. Must be called from the loop's thread. """
+        text = message.message
+        if not text or text[0] not in self._prefixes_by_char:
+            return False
+        found = self.match(text)
+        if found is None:
+            return False
+        command, arg_text = found
+        if not self._user_limiter.allow((message.protocol, message.network, message.simple_sender)):
+            logging.debug('Rate limited command %s from %s.', command.name, message.simple_sender)
+            return True
+        if not self._channel_limiter.allow(message.route_key):
+            logging.debug('Rate limited command %s in %s.', command.name, message.route_key)
+            return True
+        loop.create_task(self._run(command, message, arg_text))
+        return True
+
+    async def _run(self, command, message, arg_text):
+        args = command.parse_args(arg_text)
+        if args is None:
+            message.reply(f"Usage: {self.default_prefix}{command.name} {command.usage}".rstrip())
+            return
+        try:
+            if asyncio.iscoroutinefunction(command.handler):
+                result = await command.handler(message, *args)
+            elif self._run_in_worker is not None:
+                result = await self._run_in_worker(command.handler, message, *args)
+            else:
+                result = command.handler(message, *args)
+        except Exception:  #pylint:disable=broad-except
+            logging.exception('Command %s raised an exception.', command.name)
+            return
+        if isinstance(result, str):
+            message.reply(result)
+
+    def _help(self, message, name=None):
+        """ The built-in help command. """
+        commands = self._tables[self.default_prefix]
+        if name is None:
+            return 'Commands: ' + ', '.join(self.default_prefix + name for name in sorted(commands))
+        command = commands.get(name.lstrip(self.default_prefix).lower())
+        if command is None:
+            return f"No such command: {name}"
+        usage = f"{self.default_prefix}{command.name} {command.usage}".rstrip()
+        return f"{usage} - {command.help_text}" if command.help_text else usage
@@ -1,24 +1,238 @@
 """ here be configs """
 
+import hashlib
+import logging
 import os
+import pickle
 import sys
-from ruamel.yaml import YAML
+
+
+_NUMBER = (int, float)
+_FLOOD = {'?rate': _NUMBER, '?burst': int, '?max_queue': int}
+_SPLIT = {'?max_lines': int, '?overflow': str, '?separator': str}
+_MEMBERSHIP = {
+    '?enabled': bool,
+    '?window': _NUMBER,
+    '?max_individual': int,
+    '?rejoin_window': _NUMBER,
+    '?max_tracked': int
+}
+
+#the expected shape of the config. A dict lists the keys of a mapping, with optional keys starting with '?', and a dict
+#with just the key '*' is a mapping with any keys. A list of one item is a list of such items. Anything else is a type
+#(or a tuple of types). Keys that aren't in here aren't checked, so plugins can have config sections of their own.
+CONFIG_SCHEMA = {
+    '?core': {
+        '?single_loop': bool,
+        '?uvloop': bool,
+        '?listener_workers': int,
+        '?listener_timeout': _NUMBER,
+        '?irc_shards': int,
+        '?shard_socket': str,
+        '?headless': bool,
+        '?shutdown_timeout': _NUMBER
+    },
+    'irc': {
+        'nick': str,
+        'ident': str,
+        'realname': str,
+        'quitmessage': str,
+        '?flood': _FLOOD,
+        '?split': _SPLIT,
+        '?membership': _MEMBERSHIP,
+        '?connections': int,
+        '?rebalance_interval': _NUMBER,
+        'servers': {
+            '*': {
+                'host': str,
+                'port': int,
+                'channels': [str],
+                '?flood': _FLOOD,
+                '?split': _SPLIT,
+                '?membership': _MEMBERSHIP,
+                '?connections': int
+            }
+        }
+    },
+    'discord': {
+        'token': str,
+        '?coalesce': {
+            '?window': _NUMBER,
+            '?max_delay': _NUMBER
+        },
+        'webhooks': {
+            '*': (str, list)
+        }
+    },
+    '?commands': {
+        '?prefixes': [str],
+        '?user_rate': [_NUMBER],
+        '?channel_rate': [_NUMBER]
+    },
+    '?spool': {
+        '?directory': str,
+        '?max_memory': int,
+        '?ttl': _NUMBER,
+        '?replay_interval': _NUMBER
+    },
+    '?echo': {
+        '?enabled': bool,
+        '?window': _NUMBER,
+        '?max_hops': int,
+        '?hop_markers': [str],
+        '?max_entries': int
+    },
+    '?history': {
+        '?enabled': bool,
+        '?directory': str,
+        '?segment_size': int,
+        '?max_segments': int,
+        '?max_age_days': _NUMBER,
+        '?flush_interval': _NUMBER,
+        '?backlog_lines': int,
+        '?backlog_max': int
+    },
+    '?capture': {
+        '?enabled': bool,
+        '?path': str,
+        '?flush_interval': _NUMBER
+    },
+    '?metrics': {
+        '?enabled': bool,
+        '?host': str,
+        '?port': int
+    },
+    '?filters': {
+        '?enabled': bool,
+        '?mask': str,
+        '?rules': [{
+            '?name': str,
+            'action': str,
+            '?words': [str],
+            '?patterns': [str],
+            '?senders': [str],
+            '?channels': [{
+                '?irc_network': str,
+                '?irc_channel': str,
+                '?discord_channel': int
+            }],
+            '?tag': str
+        }]
+    },
+    'channel_mapping': [{
+        'irc_network': str,
+        'irc_channel': str,
+        'discord_channel': int
+    }],
+}
+
+
+def _check(value, schema, path, errors):
+    """ Checks value against schema (see CONFIG_SCHEMA), adding the problems found to errors. """
+    if isinstance(schema, dict):
+        if not isinstance(value, dict):
+            errors.append(f"{path}: expected a mapping")
+        elif '*' in schema:
+            for key, item in value.items():
+                _check(item, schema['*'], f"{path}.{key}", errors)
+        else:
+            for key, item_schema in schema.items():
+                optional = key.startswith('?')
+                key = key.lstrip('?')
+                item_path = f"{path}.{key}" if path else key
+                if value.get(key) is None:
+                    if not optional:
+                        errors.append(f"{item_path}: missing")
+                    continue
+                _check(value[key], item_schema, item_path, errors)
+    elif isinstance(schema, list):
+        if not isinstance(value, list):
+            errors.append(f"{path}: expected a list")
+            return
+        for index, item in enumerate(value):
+            _check(item, schema[0], f"{path}[{index}]", errors)
+    elif not isinstance(value, schema):
+        expected = ' or '.join(t.__name__ for t in schema) if isinstance(schema, tuple) else schema.__name__
+        errors.append(f"{path}: expected {expected}, got {type(value).__name__}")
+
+
+def validate_config(config):
+    """ Checks that config has the shape of CONFIG_SCHEMA. Raises a ValueError listing the problems if it doesn't. """
+    errors = []
+    _check(config, CONFIG_SCHEMA, '', errors)
+    if errors:
+        raise ValueError("Invalid config:\n" + '\n'.join(' - ' + error for error in errors))
+
+
+#cached configs are only valid for the schema they were validated against
+_SCHEMA_DIGEST = hashlib.sha256(repr(CONFIG_SCHEMA).encode('utf-8')).hexdigest()
+
+
+def parse_config(text):
+    """ Parses the YAML config text into plain dicts and lists. Raises a ValueError if it isn't valid YAML. """
+    #ruamel.yaml takes a while to import and is only needed when the cache is stale
+    from ruamel.yaml import YAML, YAMLError
+    try:
+        return YAML(typ='safe').load(text)
+    except YAMLError as ex:
+        raise ValueError(f"Invalid config: {ex}") from ex
 
 
 class ConfigManager():
     """ I manage all the configuration. """
 
-    #for now this class is very sparse. I expect it might be more complicated in the future.
-
     def __init__(self, filename="config.yaml"):
         """ opens a configuration file and loads its contents into this object """
-        #TODO: sanity check the config file
-        filepath = os.path.join(get_location(), filename)
-        if not os.path.exists(filepath):
+        self.filepath = os.path.join(get_location(), filename)
+        #the parsed and validated config is cached here, see _load()
+        self.cache_path = os.path.join(get_location(), f".{filename}.cache")
+        if not os.path.exists(self.filepath):
             create_default_config(filename)
-        with open(filepath, "r") as cfgfile:
-            yaml = YAML()
-            self.config = yaml.load(cfgfile)
+        self.config = self._load()
+
+    def _load(self):
+        """ Loads and validates the config. Parsing YAML is slow, so the validated config is cached in a pickle that's
+        used for as long as the config file's mtime and hash stay the same. """
+        with open(self.filepath, "rb") as cfgfile:
+            mtime = os.fstat(cfgfile.fileno()).st_mtime_ns
+            text = cfgfile.read()
+        key = (_SCHEMA_DIGEST, mtime, hashlib.sha256(text).hexdigest())
+        config = self._load_cached(key)
+        if config is None:
+            config = parse_config(text)
+            validate_config(config)
+            self._store_cached(key, config)
+        return config
+
+    def _load_cached(self, key):
+        try:
+            with open(self.cache_path, "rb") as cachefile:
+                cached_key, config = pickle.load(cachefile)
+        except FileNotFoundError:
+            return None
+        except Exception as ex:  #pylint:disable=broad-except
+            logging.debug('Ignoring unreadable config cache %s: %s', self.cache_path, ex)
+            return None
+        return config if cached_key == key else None
+
+    def _store_cached(self, key, config):
+        temporary = self.cache_path + '.tmp'
+        try:
+            with open(temporary, "wb") as cachefile:
+                pickle.dump((key, config), cachefile, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temporary, self.cache_path)
+        except OSError as ex:
+            logging.debug('Failed to write the config cache %s: %s', self.cache_path, ex)
+
+    def reload(self, prepare=None):
+        """ Re-reads the configuration file. Returns (the previous config, what prepare returned). prepare is called
+        with the new config before it replaces the previous one, to build whatever the new config is used for; it
+        raises a ValueError if the new config can't be used. If the new config is invalid a ValueError is raised and
+        the previous config is kept. """
+        config = self._load()
+        prepared = prepare(config) if prepare is not None else None
+        previous, self.config = self.config, config
+        return previous, prepared
 
     # def get_config_value(self, configstring: "eg. irc.servers.freenode.host"):
     #   """
@@ -36,11 +250,40 @@ def create_default_config(filename="config.yaml", force=False):
         try:
             with open(filepath, "w") as cfgfile:
                 cfg = {
+                    "core": {
+                        "single_loop": False,
+                        "uvloop": False,
+                        "listener_workers": 4,
+                        "listener_timeout": 10.0,
+                        "irc_shards": 0,
+                        "shard_socket": None,
+                        "headless": False,
+                        "shutdown_timeout": 10
+                    },
                     "irc": {
                         "nick": "pydircbot",
                         "ident": "pydircbot",
                         "realname": "pydircbot",
                         "quitmessage": "Bye.",
+                        "flood": {
+                            "rate": 0.5,
+                            "burst": 4,
+                            "max_queue": 200
+                        },
+                        "split": {
+                            "max_lines": 5,
+                            "overflow": "truncate",
+                            "separator": " | "
+                        },
+                        "membership": {
+                            "enabled": False,
+                            "window": 5,
+                            "max_individual": 3,
+                            "rejoin_window": 900,
+                            "max_tracked": 10000
+                        },
+                        "connections": 1,
+                        "rebalance_interval": 300,
                         "servers": {
                             "freenode": {
                                 "host": "irc.freenode.net",
@@ -56,10 +299,57 @@ def create_default_config(filename="config.yaml", force=False):
                     },
                     "discord": {
                         "token": "put your token here",
+                        "coalesce": {
+                            "window": 0.5,
+                            "max_delay": 1.5
+                        },
                         "webhooks": {
                             9876543210: "https://PUT_THE_WEBHOOK_URL_HERE.com"
                         }
                     },
+                    "commands": {
+                        "prefixes": ["!"],
+                        "user_rate": [5, 10.0],
+                        "channel_rate": [20, 10.0]
+                    },
+                    "spool": {
+                        "directory": "spool",
+                        "max_memory": 500,
+                        "ttl": 3600,
+                        "replay_interval": 0.25
+                    },
+                    "echo": {
+                        "enabled": True,
+                        "window": 30,
+                        "max_hops": 2,
+                        "hop_markers": ["<([^>\\s]+)>\\s+", "\\*\\*<([^>]+)>\\*\\*\\s+"],
+                        "max_entries": 10000
+                    },
+                    "history": {
+                        "enabled": True,
+                        "directory": "history",
+                        "segment_size": 4194304,
+                        "max_segments": 16,
+                        "max_age_days": 30,
+                        "flush_interval": 1.0,
+                        "backlog_lines": 10,
+                        "backlog_max": 25
+                    },
+                    "capture": {
+                        "enabled": False,
+                        "path": "capture.jsonl",
+                        "flush_interval": 1.0
+                    },
+                    "metrics": {
+                        "enabled": False,
+                        "host": "127.0.0.1",
+                        "port": 9464
+                    },
+                    "filters": {
+                        "enabled": True,
+                        "mask": "***",
+                        "rules": []
+                    },
                     "channel_mapping": [{
                         "irc_network": "freenode",
                         "irc_channel": "#pydircbot",
@@ -70,6 +360,7 @@ def create_default_config(filename="config.yaml", force=False):
                         "discord_channel": 1234567890
                     }],
                 }
+                from ruamel.yaml import YAML
                 yaml = YAML()
                 yaml.default_flow_style = False
                 yaml.dump(cfg, cfgfile)
@@ -2,12 +2,28 @@
   Main Discord bot module. It's called disc.py so as to not conflict with discord.py the library.
 """
 
-import logging
 import asyncio
+import logging
+import time
 
+import aiohttp
 import discord
 
 from . import adapters
+from . import coalesce
+from . import eventloop
+from . import formatting
+from . import members
+from . import metrics
+from . import webhooks
+
+#errors that mean Discord can't be reached right now, rather than that the message was rejected
+RETRYABLE_ERRORS = (discord.DiscordServerError, aiohttp.ClientConnectionError, asyncio.TimeoutError)
+
+
+def _as_list(webhook_urls):
+    """ Returns the webhook URLs of a channel in the config, which may be a single URL, as a list. """
+    return [webhook_urls] if isinstance(webhook_urls, str) else list(webhook_urls)
 
 
 class DiscordBot(discord.Client):
@@ -15,52 +31,205 @@ class DiscordBot(discord.Client):
 
     def __init__(self, *args, **kwargs):
         self._adapter = kwargs.pop('adapter')
-        self.webhooks_by_channel = {}
-        self.webhooks_by_id = {}
+        coalesce_window = kwargs.pop('coalesce_window', 0)
+        coalesce_max_delay = kwargs.pop('coalesce_max_delay', 0)
+        self.webhooks_by_channel = {}  #channel id -> webhooks.WebhookPool
+        self.webhooks_by_id = {}  #webhook id -> webhooks.Webhook
+        #the HTTP connection pool all the webhooks post through, created once we've logged in
+        self.webhook_session = None
+        self._shutdown_task = None
+        #ids of the channels the last webhook post to failed, so the adapter can be told once they work again
+        self._failing_channels = set()
+        self.members = members.MemberIndex()
+        self.mentions = formatting.MentionResolver(self._user_name, self._role_name, self._channel_name)
         super().__init__(*args, **kwargs)
+        #bursts of lines relayed via webhooks are merged into fewer posts to stay clear of the rate limits
+        self.webhook_coalescer = coalesce.Coalescer(self._send_via_webhook,
+                                                    coalesce_window,
+                                                    coalesce_max_delay,
+                                                    loop=self.loop,
+                                                    order_key=self._send_order_key)
 
     def run(self, *args, **kwargs):
         """ Runs the bot in a very simple way. Run this in a separate thread.
         You'll need to handle clean shutdown yourself (by calling stop()). """
         self.loop.run_until_complete(self.start(*args, **kwargs))
+        if self._shutdown_task is not None:
+            #start() returns as soon as shutdown() has logged out, let shutdown() finish so its caller gets the result
+            self.loop.run_until_complete(self._shutdown_task)
+
+    async def shutdown(self, timeout):
+        """ Sends the messages waiting to be relayed, giving up on them after timeout seconds, and logs out.
+        Returns the number of lines that weren't sent. """
+        self._shutdown_task = asyncio.current_task()
+        dropped = await self.webhook_coalescer.flush(timeout)
+        await self.close()
+        return dropped
 
-    def stop(self):
-        """ Shuts the bot down cleanly (hopefully). """
-        #we'll just use _do_cleanup for now even though it fucks the entire event loop
-        self._do_cleanup()
+    async def login(self, *args, **kwargs):  #pylint:disable=arguments-differ
+        await super().login(*args, **kwargs)
+        if self.webhook_session is None:
+            #keep-alive connections shared by all the webhooks, so a post doesn't cost a TLS handshake
+            self.webhook_session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(keepalive_timeout=60))
 
-    def add_webhook(self, webhook_url, channel):
+    async def close(self):
+        await super().close()
+        if self.webhook_session is not None:
+            await self.webhook_session.close()
+
+    def add_webhook(self, webhook_urls, channel):
         """
-        Adds a webhook that's attached to the given channel. These can be used for relaying messages to these channels.
+        Adds the webhooks of the given channel, a webhook URL or a list of them. These can be used for relaying messages
+        to these channels. With several webhooks, posts are spread between them, see webhooks.WebhookPool.
         """
-        #pylint:disable=protected-access
-        adapter = discord.AsyncWebhookAdapter(session=self.http._session)
-        webhook = discord.Webhook.from_url(webhook_url, adapter=adapter)
-        self.webhooks_by_channel[channel] = webhook
-        self.webhooks_by_id[webhook.id] = webhook
+        pool = webhooks.WebhookPool(_as_list(webhook_urls))
+        self.webhooks_by_channel[channel] = pool
+        self.webhooks_by_id.update((webhook.id, webhook) for webhook in pool.webhooks)
+
+    def set_webhooks(self, webhook_urls):
+        """ Replaces all the webhooks with the given ones, a dict of channel id -> webhook URL or list of them.
+        Channels whose URLs didn't change keep their pools. The new webhooks all take effect at once. """
+        by_channel = {}
+        for channel, urls in webhook_urls.items():
+            pool = self.webhooks_by_channel.get(channel)
+            if pool is None or pool.urls != tuple(_as_list(urls)):
+                pool = webhooks.WebhookPool(_as_list(urls))
+            by_channel[channel] = pool
+        self.webhooks_by_channel, self.webhooks_by_id = by_channel, {
+            webhook.id: webhook
+            for pool in by_channel.values() for webhook in pool.webhooks
+        }
+
+    def _send_order_key(self, channel_id, sender):
+        """ Posts through a single webhook are kept in order, posts through a pool only per sender, so that
+        different senders can use different webhooks at the same time. """
+        pool = self.webhooks_by_channel.get(channel_id)
+        return (channel_id, sender) if pool is not None and len(pool) > 1 else channel_id
 
-    async def relay_via_webhook(self, channel_id, message):
+    async def relay_via_webhook(self, channel_id, message, webhook=None, channel=None):
         """
-        Relays the given message to the target channel through a webhook. The webhook will be taken from the dict.
-        If no webhook is found, a ValueError is raised.
+        Relays the given message to the target channel through a webhook. If webhook or channel aren't given, they'll
+        be looked up. webhook is the webhooks.WebhookPool of the channel. If no webhook is found, a ValueError is
+        raised.
         channel_id is the integer id of the channel, message is an IMessage object.
+        Consecutive messages from the same sender may be merged into one post, see coalesce.Coalescer.
         """
-        webhook = self.webhooks_by_channel.get(channel_id)
+        text = message.message_as(adapters.IMessage.Protocol.DISCORD)
+        await self.relay_text(channel_id, message.simple_sender, text, webhook, channel)
+
+    async def relay_text(self, channel_id, sender, text, webhook=None, channel=None):
+        """ Like relay_via_webhook(), but takes the sender's name and the text (in Discord markdown) instead
+        of an IMessage. """
         if webhook is None:
-            raise ValueError("The given channel has no known webhook.")
+            webhook = self.webhooks_by_channel.get(channel_id)
+            if webhook is None:
+                raise ValueError("The given channel has no known webhook.")
+        if channel is None:
+            channel = self.get_channel(channel_id)
         #check if there's a user with the same nickname on our server, and if there is, use their avatar
-        channel = self.get_channel(channel_id)
         avatar_url = None
         if isinstance(channel, discord.TextChannel):
-            member = discord.utils.find(lambda m: m.name == message.simple_sender, channel.guild.members)
+            member = self.members.find_by_nick(channel.guild, sender)
             if member is not None:
                 avatar_url = member.avatar_url
-        await webhook.send(str(message), username=message.simple_sender, avatar_url=avatar_url)
+            text = self.members.translate_highlight(channel.guild, text)
+        self.webhook_coalescer.add(channel_id, sender, text, (webhook, avatar_url))
+
+    async def _send_via_webhook(self, channel_id, username, text, extra):
+        """ Posts text through a webhook of a pool. Called by the webhook coalescer with extra being (pool, avatar_url).
+        If Discord can't be reached, the adapter is told so it can try again later, and told again once a post to
+        the channel goes through. """
+        pool, avatar_url = extra
+        try:
+            #the pool times its HTTP posts itself, apart from its waits for the rate limits
+            await pool.send(self.webhook_session, text, username=username, avatar_url=avatar_url)
+        except RETRYABLE_ERRORS as ex:
+            metrics.DISCORD_SEND_ERRORS.inc(method='webhook')
+            logging.warning('Sending through webhook failed (%s), handing the message back.', ex.__class__.__name__)
+            self._failing_channels.add(channel_id)
+            self._adapter.discord_send_failed(channel_id, username, text)
+            return
+        except discord.HTTPException:
+            metrics.DISCORD_SEND_ERRORS.inc(method='webhook')
+            raise
+        if channel_id in self._failing_channels:
+            self._failing_channels.discard(channel_id)
+            self._adapter.discord_send_recovered(channel_id)
+
+    @staticmethod
+    async def send_to_channel(channel, content):
+        """ Sends a message to a channel (or any Messageable), recording how long it took. """
+        try:
+            with metrics.DISCORD_SEND_SECONDS.time(method='channel'):
+                return await channel.send(content=content)
+        except discord.HTTPException:
+            metrics.DISCORD_SEND_ERRORS.inc(method='channel')
+            raise
+
+    def _user_name(self, guild, user_id):
+        member = guild.get_member(user_id) if guild is not None else None
+        if member is not None:
+            return member.display_name
+        user = self.get_user(user_id)
+        return user.name if user is not None else None
+
+    @staticmethod
+    def _role_name(guild, role_id):
+        role = guild.get_role(role_id) if guild is not None else None
+        return role.name if role is not None else None
+
+    def _channel_name(self, guild, channel_id):  #pylint:disable=unused-argument
+        channel = self.get_channel(channel_id)
+        return channel.name if channel is not None else None
 
     ########
     #Events#
     ########
 
+    async def on_ready(self):
+        """ Executed when we've logged in and the guilds have been loaded. """
+        for guild in self.guilds:
+            self.members.rebuild(guild)
+        self._adapter.discord_ready()
+
+    async def on_guild_available(self, guild):
+        """ Executed when a guild becomes available (again). """
+        self.members.rebuild(guild)
+        self._adapter.discord_ready()
+
+    async def on_guild_join(self, guild):
+        """ Executed when we join a guild. """
+        self.members.rebuild(guild)
+
+    async def on_guild_remove(self, guild):
+        """ Executed when we leave a guild or it's deleted. """
+        self.members.forget_guild(guild)
+
+    async def on_member_join(self, member):
+        """ Executed when someone joins a guild. """
+        self.members.add(member)
+
+    async def on_member_update(self, before, after):
+        """ Executed when a member changes eg. their nickname. """
+        self.members.update(before, after)
+        self.mentions.clear()
+
+    async def on_user_update(self, before, after):
+        """ Executed when a user changes eg. their username. """
+        self.mentions.clear()
+
+    async def on_guild_role_update(self, before, after):
+        """ Executed when a role is changed. """
+        self.mentions.clear()
+
+    async def on_guild_channel_update(self, before, after):
+        """ Executed when a channel is changed. """
+        self.mentions.clear()
+
+    async def on_member_remove(self, member):
+        """ Executed when someone leaves a guild. """
+        self.members.remove(member)
+
     async def on_message(self, message):
         """ Executed when a message is received. """
         #this also gets executed for messages *we* send, which we don't want
@@ -70,24 +239,47 @@ class DiscordBot(discord.Client):
         #from the webhooks that we use
         if message.webhook_id in self.webhooks_by_id:
             return
-        discordmessage = DiscordMessage(self, message)
-        coro = self._adapter.message_received(discordmessage)
-        asyncio.run_coroutine_threadsafe(coro, self._adapter.loop)
+        with metrics.RECEIVE_SECONDS.time(protocol='discord'):
+            metrics.MESSAGES_RECEIVED.inc(protocol='discord')
+            discordmessage = DiscordMessage(self, message)
+            coro = self._adapter.message_received(discordmessage)
+            eventloop.submit(coro, self._adapter.loop)
+
 
+class DiscordMessage(adapters.Envelope):
+    """ Pass me along to event handlers as the message. Only the ids of the discord.py objects are kept, they're
+    looked up through the bot when they're asked for. """
 
-class DiscordMessage(adapters.IMessage):
-    """ Pass me along to event handlers as the message. """
+    __slots__ = ('_message_id', '_author_id', '_clean_content', '_attachments', '_from_bot')
 
     def __init__(self, bot, source_message):
-        self._bot = bot
-        self._source_message = source_message
+        guild = source_message.guild
+        clean_content = source_message.clean_content
+        if clean_content == source_message.content:
+            #no mentions to clean up, don't keep the text twice
+            clean_content = source_message.content
+        super().__init__(bot,
+                         guild.id if guild is not None else None,
+                         source_message.channel.id,
+                         source_message.channel.id,
+                         source_message.author.display_name,
+                         source_message.content,
+                         time.perf_counter(),
+                         _message_id=source_message.id,
+                         _author_id=source_message.author.id,
+                         _clean_content=clean_content,
+                         _attachments=tuple(attachment.url for attachment in source_message.attachments),
+                         _from_bot=source_message.author.bot or source_message.webhook_id is not None)
 
     #pylint:disable=arguments-differ
     def reply(self, message, retry=1):
-        channel = self._source_message.channel
+        channel = self.source
+        if channel is None:
+            logging.error('Failed to send Discord message. Reason: the channel is gone.')
+            return
         try:
             coro = channel.send(content=message)
-            asyncio.run_coroutine_threadsafe(coro, self._bot.loop)
+            eventloop.submit(coro, self._origin.loop)
         except discord.HTTPException as ex:
             #if sending fails we'll try again until we're out of retries
             if retry > 0:
@@ -101,8 +293,7 @@ class DiscordMessage(adapters.IMessage):
             logging.error('Invalid attachments for Discord message.')
 
     def reply_with_highlight(self, message):
-        mention = self._source_message.author.mention
-        self.reply(mention + ' ' + message)
+        self.reply(f"<@{self._author_id}> {message}")
 
     @property
     def protocol(self):
@@ -110,26 +301,49 @@ class DiscordMessage(adapters.IMessage):
 
     @property
     def source(self):
-        return self._source_message.channel
+        return self._origin.get_channel(self._channel)
+
+    @property
+    def message_id(self):
+        """ The id of the Discord message. """
+        return self._message_id
+
+    @property
+    def original(self):
+        #discord.py keeps the latest messages around, older ones can be fetched with source.fetch_message(message_id)
+        return discord.utils.get(self._origin.cached_messages, id=self._message_id)
 
     @property
     def sender(self):
-        return self._source_message.author
+        original = self.original
+        if original is not None:
+            return original.author
+        guild = self._origin.get_guild(self._network) if self._network is not None else None
+        member = guild.get_member(self._author_id) if guild is not None else None
+        return member if member is not None else self._origin.get_user(self._author_id)
 
     @property
-    def simple_sender(self):
-        return self._source_message.author.display_name
+    def from_bot(self):
+        return self._from_bot
 
     @property
     def message(self):
-        message_content = self._source_message.clean_content
-        #append attachment URLs to the string representation of the message
-        for attachment in self._source_message.attachments:
-            if message_content == "":  #petty beautifying
-                message_content += f'{attachment.url}'
-            else:
-                message_content += f' {attachment.url}'
-        return message_content
+        return self._with_attachments(self._clean_content)
+
+    def message_as(self, protocol):
+        if protocol is self.Protocol.IRC:
+            guild = self._origin.get_guild(self._network) if self._network is not None else None
+            return self._with_attachments(formatting.discord_to_irc(self._content, self._origin.mentions, guild))
+        return self._with_attachments(self._content)
 
-    def __str__(self):
-        return self.message
+    def with_text(self, text):
+        #the attachment URLs are part of the text already
+        return self._replace(_content=text, _clean_content=text, _attachments=())
+
+    def _with_attachments(self, content):
+        #append attachment URLs to the string representation of the message
+        if not self._attachments:
+            return content
+        if content:  #petty beautifying
+            return ' '.join((content, *self._attachments))
+        return ' '.join(self._attachments)
@@ -0,0 +1,97 @@
+""" Echo suppression, so that several bridges in the same channels don't relay each other's messages in a loop. """
+
+import re
+import time
+
+from . import formatting
+
+#what other relays (and we) put in front of a relayed message: "<nick> message" and "**<nick>** message"
+DEFAULT_HOP_MARKERS = (r'<([^>\s]+)>\s+', r'\*\*<([^>]+)>\*\*\s+')
+
+_NOT_CONTENT = re.compile(r'[\\*_~`|]+')
+_WHITESPACE = re.compile(r'\s+')
+
+
+def _normalize(text):
+    """ Normalizes text so that the same message compares equal no matter how a relay formatted it. """
+    return _WHITESPACE.sub(' ', _NOT_CONTENT.sub('', text)).strip().casefold()
+
+
+class EchoSuppressor():
+    """
+    Recognizes messages we've relayed coming back to us through another relay.
+
+    Every relayed message leaves a fingerprint (a hash of its normalized original sender and content) in a cache of
+    time buckets. A message that looks relayed, because it starts with a hop marker (eg. "<nick> ") or was sent by a bot
+    or a webhook, is an echo if its fingerprint is in the cache. Messages with more than `max_hops` hop markers are
+    taken to be looping no matter what. The cache covers the last `window` seconds and holds at most `max_entries`
+    fingerprints, so its memory use is fixed and checks take constant time.
+    Must only be used from the core event loop's thread.
+    """
+
+    def __init__(self, window=30.0, max_hops=2, hop_markers=DEFAULT_HOP_MARKERS, max_entries=10000, buckets=6,
+                 clock=time.monotonic):
+        self.max_hops = max_hops
+        self._hop_marker = re.compile('|'.join(f"(?:{marker})" for marker in hop_markers)) if hop_markers else None
+        self._bucket_seconds = window / buckets
+        self._bucket_size = max(1, max_entries // buckets)
+        self._buckets = [set() for _ in range(buckets)]
+        self._bucket_numbers = [None] * buckets  #the bucket number each slot currently holds
+        self._clock = clock
+        self.echoes = 0
+        self.loops = 0
+        self.overflows = 0
+
+    def _origin(self, message):
+        """ Returns (original sender, content, number of hops) of an IMessage, peeling off any hop markers. """
+        sender, text = message.simple_sender, formatting.strip_irc(message.message)
+        hops = 0
+        while self._hop_marker is not None:
+            match = self._hop_marker.match(text)
+            if match is None:
+                break
+            sender = next(group for group in match.groups() if group is not None)
+            text = text[match.end():]
+            hops += 1
+        return sender, text, hops
+
+    def _fingerprint(self, sender, text):
+        return hash((_normalize(sender), _normalize(text)))
+
+    def _current_bucket(self):
+        number = int(self._clock() / self._bucket_seconds)
+        slot = number % len(self._buckets)
+        if self._bucket_numbers[slot] != number:
+            #the slot holds an expired bucket, reuse it
+            self._buckets[slot].clear()
+            self._bucket_numbers[slot] = number
+        return self._buckets[slot]
+
+    def _seen(self, fingerprint):
+        oldest = int(self._clock() / self._bucket_seconds) - len(self._buckets) + 1
+        return any(fingerprint in bucket
+                   for bucket, number in zip(self._buckets, self._bucket_numbers)
+                   if number is not None and number >= oldest)
+
+    def check(self, message):
+        """ Returns None if the IMessage may be relayed, 'echo' if it's an echo of something we relayed or 'loop' if
+        it has been relayed too many times. """
+        sender, text, hops = self._origin(message)
+        if hops > self.max_hops:
+            self.loops += 1
+            return 'loop'
+        if hops == 0 and not message.from_bot:
+            return None
+        if self._seen(self._fingerprint(sender, text)):
+            self.echoes += 1
+            return 'echo'
+        return None
+
+    def remember(self, message):
+        """ Remembers a relayed IMessage so that its echoes are recognized. """
+        sender, text, _ = self._origin(message)
+        bucket = self._current_bucket()
+        if len(bucket) >= self._bucket_size:
+            self.overflows += 1
+            return
+        bucket.add(self._fingerprint(sender, text))
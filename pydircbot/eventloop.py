@@ -0,0 +1,110 @@
+""" Event loop setup and helpers for moving work between the core, Discord and Twisted.
+
+In the default (threaded) mode the Twisted reactor, the Discord client and the core each run in their own thread.
+In single-loop mode Twisted runs on the asyncio reactor and all three share one asyncio event loop, which means
+the helpers below can skip the thread-safe handoffs entirely.
+"""
+
+import asyncio
+import concurrent.futures
+import logging
+import sys
+
+from twisted.python.threadable import isInIOThread
+
+
+def install(single_loop=False, use_uvloop=False):
+    """ Creates the core event loop and sets it as the current one. If use_uvloop is True and uvloop is installed,
+    uvloop is used for the loop. If single_loop is True, the Twisted asyncio reactor is installed on top of the loop.
+    This must be called before anything imports twisted.internet.reactor. Returns the event loop. """
+    if use_uvloop:
+        try:
+            import uvloop
+        except ImportError:
+            logging.warning('uvloop was requested but is not installed, using the default event loop.')
+        else:
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+            logging.debug('Using uvloop.')
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    if single_loop:
+        if 'twisted.internet.reactor' in sys.modules:
+            raise RuntimeError('A Twisted reactor has already been installed, cannot switch to single-loop mode.')
+        from twisted.internet import asyncioreactor
+        asyncioreactor.install(eventloop=loop)
+        logging.debug('Installed the Twisted asyncio reactor.')
+    return loop
+
+
+def is_single_loop():
+    """ Returns True if the installed Twisted reactor runs on top of an asyncio event loop. """
+    from twisted.internet import reactor
+    from twisted.internet.asyncioreactor import AsyncioSelectorReactor
+    return isinstance(reactor, AsyncioSelectorReactor)
+
+
+def _running_loop():
+    """ Returns the event loop running in the current thread, or None. """
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        return None
+
+
+def submit(coro, loop):
+    """ Schedules the coroutine on the given loop. If we're already running on that loop, the task is created
+    directly instead of going through run_coroutine_threadsafe. Returns the resulting task or future. """
+    if _running_loop() is loop:
+        return loop.create_task(coro)
+    return asyncio.run_coroutine_threadsafe(coro, loop)
+
+
+def call_in_reactor(func, *args, **kwargs):
+    """ Calls func in the Twisted reactor thread. If we're already in the reactor thread it's called directly. """
+    if isInIOThread():
+        func(*args, **kwargs)
+    else:
+        from twisted.internet import reactor
+        reactor.callFromThread(func, *args, **kwargs)
+
+
+def call_in_loop(loop, func, *args):
+    """ Calls func in the thread of the given event loop. If we're already running on that loop it's called
+    directly. """
+    if _running_loop() is loop:
+        func(*args)
+    else:
+        loop.call_soon_threadsafe(func, *args)
+
+
+async def run_in_loop(coro, loop):
+    """ Runs the coroutine on the given loop and waits for its result on the current one. """
+    future = submit(coro, loop)
+    if isinstance(future, concurrent.futures.Future):
+        future = asyncio.wrap_future(future)
+    return await future
+
+
+async def run_in_reactor(func, *args):
+    """ Calls func in the Twisted reactor thread and waits for its result on the current event loop. """
+    if isInIOThread():
+        return func(*args)
+    from twisted.internet import reactor
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def resolve(setter, value):
+        #the waiter may have given up already
+        if not future.done():
+            setter(value)
+
+    def call():
+        try:
+            result = func(*args)
+        except Exception as ex:  #pylint:disable=broad-except
+            loop.call_soon_threadsafe(resolve, future.set_exception, ex)
+        else:
+            loop.call_soon_threadsafe(resolve, future.set_result, result)
+
+    reactor.callFromThread(call)
+    return await future
@@ -0,0 +1,163 @@
+""" Event listener registration and dispatch. """
+
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from itertools import product
+
+from . import irc
+from . import metrics
+from .adapters import IMessage
+
+#Supported event types that can be registered for
+#MESSAGE_RECEIVED listeners are called with the message, FILTER_MATCHED listeners with the message and the
+#filters.FilterMatches of the content filter rules it matched
+EVENT_TYPES = ("MESSAGE_RECEIVED", "FILTER_MATCHED")
+
+
+class Listener():
+    """ A registered event listener along with its filter and statistics. """
+
+    def __init__(self, callback, timeout):
+        self.callback = callback
+        self.timeout = timeout
+        self.is_coroutine = asyncio.iscoroutinefunction(callback)
+        self.name = getattr(callback, '__qualname__', repr(callback))
+        self.errors = 0
+        self.timeouts = 0
+
+
+class EventDispatcher():
+    """
+    Keeps track of event listeners and fires them without blocking the caller.
+
+    Coroutine listeners are run as tasks on the event loop. Regular functions are run in a bounded thread pool so a
+    slow listener can't stall the loop. Every call gets a timeout; calls that time out or raise are logged and counted.
+    Note that a timed out function keeps running in its worker thread, since threads can't be cancelled.
+
+    Listeners may be registered with a filter (protocol, network, channel), in which case they're only called for
+    messages that match. Listeners are indexed by their filter so finding the ones to call doesn't depend on the
+    number of registered listeners. IRC channel names are compared according to the CASEMAPPING of the network (see
+    set_casemapping()), or the RFC 1459 default for filters that don't name a network.
+    """
+
+    def __init__(self, loop, max_workers=4, max_pending=1000, default_timeout=10.0):
+        self.loop = loop
+        self.default_timeout = default_timeout
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='listener')
+        self._pending = 0  #number of function calls waiting for or running in the thread pool
+        #event type -> {(protocol, network, channel): {callback: Listener}}, where None matches anything
+        self._index = {event_type: {} for event_type in EVENT_TYPES}
+        self._filters = {}  #(event type, callback) -> (filter key, filter as registered), for unregistering
+        self._casemappings = {}  #network -> CASEMAPPING, networks not in here use the RFC 1459 default
+
+    def _normalize_channel(self, protocol, network, channel):
+        if protocol is IMessage.Protocol.IRC and isinstance(channel, str):
+            return irc.irc_lower(channel, self._casemappings.get(network, irc.DEFAULT_CASEMAPPING))
+        return channel
+
+    def set_casemapping(self, network, casemapping):
+        """ Sets the CASEMAPPING the channel names of the given network are compared with, rekeying the listeners
+        registered for its channels. """
+        if self._casemappings.get(network, irc.DEFAULT_CASEMAPPING) == casemapping:
+            return
+        self._casemappings[network] = casemapping
+        for (event_type, callback), (key, registered) in list(self._filters.items()):
+            if registered[1] == network and registered[2] is not None:
+                listener = self._index[event_type][key][callback]
+                self._remove(event_type, callback)
+                self._add(event_type, callback, registered, listener)
+
+    def register(self, event_type, callback, protocol=None, network=None, channel=None, timeout=None):
+        """ Registers a listener for an event. See the class docs for the filter arguments.
+        Registering the same callback again replaces the earlier registration. """
+        if event_type not in self._index:
+            raise ValueError("Invalid event type.")
+        if protocol is not None and not isinstance(protocol, IMessage.Protocol):
+            raise ValueError("Invalid protocol.")
+        self.unregister(event_type, callback)
+        listener = Listener(callback, self.default_timeout if timeout is None else timeout)
+        self._add(event_type, callback, (protocol, network, channel), listener)
+        return listener
+
+    def _add(self, event_type, callback, registered, listener):
+        protocol, network, channel = registered
+        key = (protocol, network, self._normalize_channel(protocol, network, channel))
+        self._index[event_type].setdefault(key, {})[callback] = listener
+        self._filters[(event_type, callback)] = (key, registered)
+
+    def unregister(self, event_type, callback):
+        """ Unregisters a listener from the given event. Does nothing if it isn't registered. """
+        if event_type not in self._index:
+            raise ValueError("Invalid event type.")
+        if (event_type, callback) in self._filters:
+            self._remove(event_type, callback)
+
+    def _remove(self, event_type, callback):
+        key, _ = self._filters.pop((event_type, callback))
+        listeners = self._index[event_type][key]
+        del listeners[callback]
+        if not listeners:
+            del self._index[event_type][key]
+
+    def listeners(self, event_type, message):
+        """ Returns the listeners of the event whose filters match the message. """
+        index = self._index[event_type]
+        if not index:
+            return []
+        protocol, network, channel = message.protocol, message.network, message.channel
+        #filters naming the network were normalized with its CASEMAPPING, the others with the default
+        channels = {(protocol, network): self._normalize_channel(protocol, network, channel),
+                    (protocol, None): self._normalize_channel(protocol, None, channel)}
+        found = []
+        for key_protocol, key_network in product((protocol, None), (network, None)):
+            for key_channel in (channels.get((key_protocol, key_network), channel), None):
+                listeners = index.get((key_protocol, key_network, key_channel))
+                if listeners:
+                    found.extend(listeners.values())
+        return found
+
+    def dispatch(self, event_type, message, *args):
+        """ Fires the listeners of the event that match the message, calling them with the message and args. Returns
+        immediately. Must be called from the event loop's thread. """
+        for listener in self.listeners(event_type, message):
+            if listener.is_coroutine:
+                self.loop.create_task(self._run(listener, listener.callback(message, *args)))
+            elif self._pending >= self.max_pending:
+                logging.warning('Too many listener calls pending, not calling %s.', listener.name)
+                metrics.LISTENER_ERRORS.inc(listener=listener.name, kind='dropped')
+            else:
+                self._pending += 1
+                #count the call as pending until the thread finishes it, even if we stop waiting for it
+                future = self._executor.submit(listener.callback, message, *args)
+                future.add_done_callback(self._call_done)
+                self.loop.create_task(self._run(listener, asyncio.wrap_future(future, loop=self.loop)))
+
+    def _call_done(self, future):
+        #this is called in the worker thread
+        self.loop.call_soon_threadsafe(self._decrement_pending)
+
+    def _decrement_pending(self):
+        self._pending -= 1
+
+    async def _run(self, listener, awaitable):
+        try:
+            with metrics.LISTENER_SECONDS.time(listener=listener.name):
+                await asyncio.wait_for(awaitable, listener.timeout)
+        except asyncio.TimeoutError:
+            listener.timeouts += 1
+            metrics.LISTENER_ERRORS.inc(listener=listener.name, kind='timeout')
+            logging.warning('Listener %s timed out after %.1f seconds.', listener.name, listener.timeout)
+        except Exception:  #pylint:disable=broad-except
+            listener.errors += 1
+            metrics.LISTENER_ERRORS.inc(listener=listener.name, kind='error')
+            logging.exception('Listener %s raised an exception.', listener.name)
+
+    def run_in_worker(self, func, *args):
+        """ Runs func(*args) in the listener thread pool. Returns an awaitable for the result. """
+        return self.loop.run_in_executor(self._executor, func, *args)
+
+    def close(self):
+        """ Stops the thread pool. Calls that are already running are left to finish on their own. """
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,422 @@
+""" Content filtering of received messages: highlight words, spam and link blocking and mute lists, with all the
+rules of a channel run over a message in one pass. """
+
+import logging
+import re
+from collections import namedtuple
+
+from . import formatting
+from . import irc
+from . import metrics
+from .adapters import IMessage
+
+#what can be done to a matching message, strongest first. When several rules match, the strongest action wins, except
+#that redacting and tagging add up.
+ACTIONS = ('drop', 'redact', 'tag', 'notify')
+
+#a namedtuple describing a match of a rule on a message: the name of the rule, its action and where in the message's
+#text it matched. start and end are None for rules that matched the sender.
+FilterMatch = namedtuple('FilterMatch', ['rule', 'action', 'start', 'end'])
+
+#regexes are case-insensitive like the words, use (?-i:...) for case-sensitive parts
+_REGEX_FLAGS = re.IGNORECASE
+#the shortest literal part of a regex that's worth looking for to tell whether the regex can match
+_MIN_LITERAL = 3
+#the most regexes without a literal part a channel's rules may have, as every one of them adds to the cost of every
+#message
+MAX_UNINDEXED_PATTERNS = 256
+#escapes of letters that stand for a single character
+_CHAR_ESCAPES = {'a': '\a', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t', 'v': '\v'}
+_QUANTIFIER = re.compile(r'\{\d*(?:,\d*)?\}')
+
+
+def _fold(text):
+    """ Lowercases text, keeping its length so positions in it are positions in text. """
+    folded = text.lower()
+    if len(folded) == len(text):
+        return folded
+    return ''.join(char if len(char.lower()) != 1 else char.lower() for char in text)
+
+
+def _is_word_char(char):
+    return char.isalnum() or char == '_'
+
+
+def _skip_set(pattern, position):
+    """ Returns the position right after the character set starting at position (at its '['). """
+    position += 1
+    if pattern.startswith('^', position):
+        position += 1
+    if pattern.startswith(']', position):
+        #a ']' right at the start is part of the set
+        position += 1
+    while position < len(pattern) and pattern[position] != ']':
+        position += 2 if pattern[position] == '\\' else 1
+    return position + 1
+
+
+def _skip_group(pattern, position):
+    """ Returns the position right after the group starting at position (at its '('). """
+    depth = 0
+    while position < len(pattern):
+        char = pattern[position]
+        if char == '\\':
+            position += 2
+            continue
+        if char == '[':
+            position = _skip_set(pattern, position)
+            continue
+        if char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+            if not depth:
+                return position + 1
+        position += 1
+    return position
+
+
+def _required_literal(pattern, compiled):
+    """
+    Returns the longest run of characters (folded) every match of the regex must contain, or '' if it has none worth
+    looking for. Reads the pattern itself and errs on the side of finding nothing: only characters outside of groups
+    and character sets count, escapes other than of punctuation and the likes of \\n end a run, a quantifier takes the
+    character before it out of the run and alternatives outside of groups mean there's no literal at all.
+    compiled is the compiled regex, for its flags.
+    """
+    if compiled.flags & re.VERBOSE:
+        #whitespace and comments in the pattern aren't what's matched
+        return ''
+    runs = []
+    run = []
+    position = 0
+    while position < len(pattern):
+        char = pattern[position]
+        step = 1
+        if char == '|':
+            return ''
+        if char == '\\':
+            escaped = pattern[position + 1:position + 2]
+            if escaped and not escaped.isalnum():
+                run.append(escaped)
+            elif escaped in _CHAR_ESCAPES:
+                run.append(_CHAR_ESCAPES[escaped])
+            else:
+                #character classes, anchors, backreferences and numeric escapes
+                runs.append(''.join(run))
+                run.clear()
+            step = 2
+        elif char in '*?{':
+            quantifier = _QUANTIFIER.match(pattern, position) if char == '{' else True
+            if quantifier:
+                #the character before may be there any number of times, including none
+                if run:
+                    run.pop()
+                if char == '{':
+                    step = quantifier.end() - position
+            runs.append(''.join(run))
+            run.clear()
+        elif char == '+':
+            runs.append(''.join(run))
+            run.clear()
+        elif char == '[':
+            runs.append(''.join(run))
+            run.clear()
+            step = _skip_set(pattern, position) - position
+        elif char == '(':
+            #the contents of a group may be optional or alternatives
+            runs.append(''.join(run))
+            run.clear()
+            step = _skip_group(pattern, position) - position
+        elif char in '.^$)':
+            runs.append(''.join(run))
+            run.clear()
+        else:
+            run.append(char)
+        position += step
+    runs.append(''.join(run))
+    best = max(runs, key=len)
+    return _fold(best) if len(best) >= _MIN_LITERAL else ''
+
+
+class Automaton():
+    """
+    An Aho-Corasick automaton: finds all the occurrences of any number of words in a text in one pass over it, in time
+    that depends on the length of the text and the number of occurrences but not on the number of words.
+    Words are added with add() and the automaton is built with build() before it's searched.
+    """
+
+    def __init__(self):
+        self._goto = [{}]  #state -> {character: next state}, state 0 is the root
+        self._fail = [0]  #state -> the state of its longest proper suffix that's a prefix of a word
+        self._output = [()]  #state -> (length, value) of the words ending at it, including through the fail links
+        self.words = 0
+
+    def add(self, word, value):
+        """ Adds a word, reported with value when it's found. """
+        if not word:
+            raise ValueError("Can't look for an empty word.")
+        state = 0
+        for char in word:
+            following = self._goto[state].get(char)
+            if following is None:
+                following = self._goto[state][char] = len(self._goto)
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append(())
+            state = following
+        self._output[state] += ((len(word), value), )
+        self.words += 1
+
+    def build(self):
+        """ Links every state to its fallback, breadth first. """
+        queue = list(self._goto[0].values())
+        for state in queue:
+            for char, following in self._goto[state].items():
+                fallback = self._fail[state]
+                while char not in self._goto[fallback] and fallback:
+                    fallback = self._fail[fallback]
+                fallback = self._goto[fallback].get(char, 0)
+                self._fail[following] = fallback
+                self._output[following] += self._output[fallback]
+                queue.append(following)
+
+    def search(self, text):
+        """ Returns the (start, end, value) of every occurrence of the words in text, overlapping ones included. """
+        goto, fail, output = self._goto, self._fail, self._output
+        found = []
+        state = 0
+        for end, char in enumerate(text, 1):
+            while True:
+                following = goto[state].get(char)
+                if following is not None:
+                    state = following
+                    break
+                if not state:
+                    break
+                state = fail[state]
+            if output[state]:
+                found.extend((end - length, end, value) for length, value in output[state])
+        return found
+
+
+class Rule():
+    """ A filter rule: what it looks for (whole words, regexes and/or senders), where (channel keys, see
+    channel_key(), or None for everywhere) and what's done to the messages it matches. """
+
+    __slots__ = ('name', 'action', 'words', 'patterns', 'senders', 'channels', 'tag')
+
+    def __init__(self, name, action, words=(), patterns=(), senders=(), channels=None, tag=None):
+        if action not in ACTIONS:
+            raise ValueError(f"Invalid action for filter rule {name}: {action}")
+        if not (words or patterns or senders):
+            raise ValueError(f"Filter rule {name} has no words, patterns or senders.")
+        if any(not word for word in words):
+            raise ValueError(f"Filter rule {name} has an empty word.")
+        self.name = name
+        self.action = action
+        self.words = tuple(words)
+        self.patterns = []
+        for pattern in patterns:
+            try:
+                self.patterns.append((pattern, re.compile(pattern, _REGEX_FLAGS)))
+            except re.error as ex:
+                raise ValueError(f"Invalid pattern in filter rule {name}: {pattern} ({ex})") from ex
+        self.senders = tuple(senders)
+        self.channels = frozenset(channels) if channels is not None else None
+        self.tag = tag if tag is not None else f"[{name}]"
+
+
+def channel_key(protocol, network, channel):
+    """ Returns the key rules know a channel by: (network, lowercased channel name) for IRC, the channel id for
+    Discord. """
+    if protocol is IMessage.Protocol.IRC:
+        return (network, irc.irc_lower(channel))
+    return channel
+
+
+class _Matcher():
+    """
+    All the rules of a channel compiled together. Words, and the literal parts of the regexes that have one, go into
+    one Aho-Corasick automaton, and the regexes found to be possible by it are run on their own. The regexes without a
+    literal part are put together into one regex (without groups, which would make it many times slower), and where it
+    matches, they're tried one by one to find out which ones did. It reports non-overlapping matches only, so a regex
+    matching over the match of another may go unnoticed. Unlike the automaton, its cost grows with the number of
+    regexes in it, so there may be at most MAX_UNINDEXED_PATTERNS of them. Senders are looked up in a dict.
+    """
+
+    def __init__(self, rules):
+        self._automaton = Automaton()
+        self._regexes = []  #(compiled regex, rule) of the regexes with a literal part
+        self._alone = []  #(compiled regex, rule) of the regexes that can't be put together with the others
+        self._senders = {}  #lowercased sender -> rules that match them
+        combined = []
+        for rule in rules:
+            for word in rule.words:
+                self._automaton.add(_fold(word), (None, rule))
+            for pattern, compiled in rule.patterns:
+                literal = _required_literal(pattern, compiled)
+                if literal:
+                    self._automaton.add(literal, (len(self._regexes), rule))
+                    self._regexes.append((compiled, rule))
+                elif compiled.groups == 0 and self._combinable(pattern):
+                    combined.append((pattern, compiled, rule))
+                else:
+                    #groups would throw the numbering of backreferences off and global flags must come first
+                    self._alone.append((compiled, rule))
+            for sender in rule.senders:
+                for key in {sender.lower(), irc.irc_lower(sender)}:
+                    rules_of_sender = self._senders.setdefault(key, [])
+                    if rule not in rules_of_sender:
+                        rules_of_sender.append(rule)
+        unindexed = len(combined) + len(self._alone)
+        if unindexed > MAX_UNINDEXED_PATTERNS:
+            raise ValueError(f"The filter rules have {unindexed} patterns without a literal part of at least "
+                             f"{_MIN_LITERAL} characters, at most {MAX_UNINDEXED_PATTERNS} are allowed per channel.")
+        self._automaton.build()
+        self._combined_regexes = [(compiled, rule) for _, compiled, rule in combined]
+        self._combined = None
+        if combined:
+            self._combined = re.compile('|'.join(f"(?:{pattern})" for pattern, _, _ in combined), _REGEX_FLAGS)
+
+    @staticmethod
+    def _combinable(pattern):
+        try:
+            re.compile(f"(?:{pattern})", _REGEX_FLAGS)
+        except re.error:
+            return False
+        return True
+
+    def match(self, text, sender, protocol):
+        """ Returns the (rule, start, end) of every match in a message, start and end being None for senders. """
+        found = []
+        key = irc.irc_lower(sender) if protocol is IMessage.Protocol.IRC else sender.lower()
+        for rule in self._senders.get(key, ()):
+            found.append((rule, None, None))
+        if self._automaton.words:
+            possible = set()
+            for start, end, (regex, rule) in self._automaton.search(_fold(text)):
+                if regex is not None:
+                    possible.add(regex)
+                elif ((start == 0 or not _is_word_char(text[start]) or not _is_word_char(text[start - 1])) and
+                      (end == len(text) or not _is_word_char(text[end - 1]) or not _is_word_char(text[end]))):
+                    #a whole word: not glued to other letters where the word itself has one
+                    found.append((rule, start, end))
+            for regex in sorted(possible):
+                compiled, rule = self._regexes[regex]
+                found.extend((rule, match.start(), match.end()) for match in compiled.finditer(text))
+        for compiled, rule in self._alone:
+            found.extend((rule, match.start(), match.end()) for match in compiled.finditer(text))
+        if self._combined is not None:
+            for match in self._combined.finditer(text):
+                for compiled, rule in self._combined_regexes:
+                    matched = compiled.match(text, match.start())
+                    if matched is not None:
+                        found.append((rule, matched.start(), matched.end()))
+        return found
+
+
+def _redact(text, spans, mask):
+    """ Replaces the parts of text covered by spans (start, end) with mask, overlapping spans being masked once. """
+    out = []
+    position = 0
+    for start, end in sorted(spans):
+        if end <= position:
+            continue
+        if start > position:
+            out.append(text[position:start])
+        out.append(mask)
+        position = max(position, end)
+    out.append(text[position:])
+    return ''.join(out)
+
+
+class ContentFilter():
+    """
+    Runs filter rules over received messages. The rules that apply to a channel (the ones without channels plus the
+    ones listing it) are compiled into one matcher when the filter is built, so a message costs one pass over its
+    text however many rules and words there are. Channels with the same rules share their matcher.
+    Must only be used from the core event loop's thread.
+    """
+
+    def __init__(self, rules, mask='***'):
+        self.rules = list(rules)
+        self.mask = mask
+        names = [rule.name for rule in self.rules]
+        if len(set(names)) != len(names):
+            raise ValueError("Filter rule names must be unique.")
+        shared = [rule for rule in self.rules if rule.channels is None]
+        self._default = _Matcher(shared) if shared else None
+        by_rules = {}  #the rules of a channel -> their matcher
+        self._matchers = {}  #channel key -> matcher, for the channels that have rules of their own
+        for key in {key for rule in self.rules if rule.channels is not None for key in rule.channels}:
+            rules = tuple(rule for rule in self.rules if rule.channels is None or key in rule.channels)
+            if rules not in by_rules:
+                by_rules[rules] = _Matcher(rules)
+            self._matchers[key] = by_rules[rules]
+
+    def apply(self, message, count=True):
+        """
+        Runs the rules of the message's channel over an IMessage. Returns (the message to relay, or None if it's
+        dropped, the FilterMatches). The message to relay is the message itself unless it was redacted or tagged, in
+        which case it's a copy holding the result as plain text. With count False, the matches are left out of the
+        metrics, for running a message through the filter again.
+        """
+        matcher = self._matchers.get(channel_key(message.protocol, message.network, message.channel), self._default)
+        if matcher is None:
+            return message, ()
+        text = message.message
+        found = matcher.match(text, message.simple_sender, message.protocol)
+        if not found:
+            return message, ()
+        matches = tuple(FilterMatch(rule.name, rule.action, start, end) for rule, start, end in found)
+        actions = {rule.action for rule, _, _ in found}
+        if count:
+            for action in actions:
+                metrics.MESSAGES_FILTERED.inc(action=action)
+        if 'drop' in actions:
+            logging.debug('Dropping message from %s, it matched %s.', message.simple_sender,
+                          ', '.join(sorted({match.rule for match in matches if match.action == 'drop'})))
+            return None, matches
+        if 'redact' not in actions and 'tag' not in actions:
+            return message, matches
+        #the text of Discord messages is still markdown, so what we put in it must not be read as markdown
+        escape = formatting.escape_markdown if message.protocol is IMessage.Protocol.DISCORD else str
+        if 'redact' in actions:
+            spans = [(0, len(text)) if start is None else (start, end) for rule, start, end in found
+                     if rule.action == 'redact']
+            text = _redact(text, spans, escape(self.mask))
+        tags = [escape(tag) for tag in dict.fromkeys(rule.tag for rule, _, _ in found if rule.action == 'tag')]
+        return message.with_text(' '.join((*tags, text))), matches
+
+
+def _channel_keys(channels, rule_name):
+    keys = []
+    for channel in channels:
+        if channel.get('discord_channel') is not None:
+            keys.append(channel_key(IMessage.Protocol.DISCORD, None, channel['discord_channel']))
+        elif channel.get('irc_network') is not None and channel.get('irc_channel') is not None:
+            keys.append(channel_key(IMessage.Protocol.IRC, channel['irc_network'], channel['irc_channel']))
+        else:
+            raise ValueError(f"Filter rule {rule_name} has a channel without a discord_channel or an irc_network and "
+                             "irc_channel.")
+    return keys
+
+
+def content_filter(config):
+    """ Builds a ContentFilter from the filters section of the config. Returns None if filtering is disabled or there
+    are no rules. Raises ValueError if a rule is invalid. """
+    if not config or not config.get('enabled', True) or not config.get('rules'):
+        return None
+    rules = []
+    for index, rule in enumerate(config['rules']):
+        name = rule.get('name') or f"rule {index + 1}"
+        channels = rule.get('channels')
+        rules.append(Rule(name,
+                          rule.get('action'),
+                          words=rule.get('words', ()),
+                          patterns=rule.get('patterns', ()),
+                          senders=rule.get('senders', ()),
+                          channels=_channel_keys(channels, name) if channels is not None else None,
+                          tag=rule.get('tag')))
+    return ContentFilter(rules, mask=config.get('mask', '***'))
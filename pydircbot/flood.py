@@ -0,0 +1,217 @@
+""" Outbound flood control for IRC connections. """
+
+import logging
+from collections import OrderedDict, deque, namedtuple
+
+from . import linesplit
+from . import metrics
+
+#a namedtuple holding the flood control settings of a connection
+#rate is the number of lines per second we're allowed to send in the long run, burst is how many we may send at once
+#and max_queue is how many lines may be waiting per target before we start dropping them
+FloodSettings = namedtuple('FloodSettings', ['rate', 'burst', 'max_queue'])
+DEFAULT_FLOOD_SETTINGS = FloodSettings(rate=0.5, burst=4, max_queue=200)
+
+#for splitting lines that don't fit anymore once they're queued
+_NO_PACKING = linesplit.SplitSettings(max_lines=0, overflow='truncate', separator=None)
+
+
+def flood_settings(*configs):
+    """ Builds a FloodSettings from the given config dicts. Later dicts override earlier ones and missing values
+    are taken from the defaults. Dicts may be None. """
+    values = DEFAULT_FLOOD_SETTINGS._asdict()
+    for config in configs:
+        if config:
+            values.update((key, config[key]) for key in FloodSettings._fields if key in config)
+    settings = FloodSettings(**values)
+    if settings.rate <= 0 or settings.burst < 1 or settings.max_queue < 1:
+        raise ValueError(f"Invalid flood settings: {settings}")
+    return settings
+
+
+class TokenBucket():
+    """ A token bucket. Tokens are refilled at `rate` tokens per second up to a maximum of `burst` tokens. """
+
+    def __init__(self, rate, burst, clock):
+        """ clock is an IReactorTime provider (usually the reactor). """
+        self.rate = rate
+        self.burst = burst
+        self._clock = clock
+        self._tokens = burst
+        self._last = clock.seconds()
+
+    def _refill(self):
+        now = self._clock.seconds()
+        self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def reconfigure(self, rate, burst):
+        """ Changes the rate and burst, keeping the tokens there are (but no more than the new burst), so changing the
+        settings doesn't hand out a fresh burst. """
+        self._refill()
+        self.rate = rate
+        self.burst = burst
+        self._tokens = min(burst, self._tokens)
+
+    def consume(self, tokens=1):
+        """ Takes the given amount of tokens if they're available. Returns True if they were. """
+        self._refill()
+        if self._tokens >= tokens:
+            self._tokens -= tokens
+            return True
+        return False
+
+    def delay(self, tokens=1):
+        """ Returns how many seconds it'll take until the given amount of tokens is available. """
+        self._refill()
+        return max(0.0, (tokens - self._tokens) / self.rate)
+
+
+class OutboundQueue():
+    """
+    Paces the outgoing messages of an IRC connection. Every target (channel or user) gets its own queue and the queues
+    are served round-robin, one line at a time, as fast as the token bucket allows. This way a busy channel can't
+    starve the quiet ones, and we never send faster than the server tolerates. Targets the bot can't send to yet are
+    skipped until resume() is called.
+    Must only be used from the reactor thread.
+    """
+
+    def __init__(self, settings=DEFAULT_FLOOD_SETTINGS, clock=None, name='',
+                 split_settings=linesplit.DEFAULT_SPLIT_SETTINGS):
+        """ name is the name of the network, used in the metrics. """
+        if clock is None:
+            from twisted.internet import reactor
+            clock = reactor
+        self.settings = settings
+        self.split_settings = split_settings
+        #our nick!user@host as the server shows it, which limits how long our lines can be. None if we don't know it.
+        self.hostmask = None
+        self.name = name
+        self._clock = clock
+        self._bucket = TokenBucket(settings.rate, settings.burst, clock)
+        #target -> deque of (line, time queued, prefix of the line). The order of the keys is the round-robin order.
+        self._queues = OrderedDict()
+        self._bot = None
+        self._call = None  #the pending delayed call to _send_pending, if any
+        self.dropped = 0
+
+    def attach(self, bot):
+        """ Starts sending queued messages through the given IRCBot. """
+        self._bot = bot
+        self._schedule()
+
+    def set_settings(self, settings):
+        """ Switches to new flood control settings. The tokens left in the bucket carry over, so that a reload in the
+        middle of a flood doesn't let a whole new burst through. """
+        self.settings = settings
+        self._bucket.reconfigure(settings.rate, settings.burst)
+        if self._call is not None:
+            #the wait for the next token was worked out at the old rate
+            self._call.cancel()
+            self._call = None
+            self._schedule()
+
+    @property
+    def attached(self):
+        """ True if the queue is attached to a connected IRCBot. """
+        return self._bot is not None
+
+    def detach(self):
+        """ Stops sending. Queued messages are kept until the next attach(). """
+        self._bot = None
+        if self._call is not None:
+            self._call.cancel()
+            self._call = None
+
+    def line_width(self, target):
+        """ Returns how many bytes of text fit on a line to target. """
+        hostmask = self.hostmask
+        if hostmask is None:
+            #assume the worst: the longest nick, ident and host there can be
+            hostmask = linesplit.estimated_hostmask('x' * 30, 'x' * 10)
+        return linesplit.line_width(hostmask, target)
+
+    def enqueue(self, target, message, prefix=''):
+        """ Queues a message to target. The message is split into as few lines as it fits on, each starting with
+        prefix and costing one token. """
+        lines, overflowed = linesplit.split_message(message, self.line_width(target), prefix, self.split_settings)
+        if overflowed:
+            logging.warning('Message to %s is too long for %d lines, %s it.', target, self.split_settings.max_lines,
+                            'truncating' if lines else 'dropping')
+            metrics.IRC_MESSAGES_OVERFLOWED.inc(network=self.name, action=self.split_settings.overflow)
+        if not lines:
+            return
+        queue = self._queues.get(target)
+        if queue is None:
+            queue = self._queues[target] = deque()
+        now = self._clock.seconds()
+        for line in lines:
+            if len(queue) >= self.settings.max_queue:
+                self.dropped += 1
+                logging.warning('Outbound queue for %s is full, dropping line.', target)
+                continue
+            queue.append((line, now, prefix))
+        if not queue:
+            del self._queues[target]
+        self._schedule()
+
+    def take(self, target):
+        """ Removes and returns the lines waiting to be sent to target, as a list of (line, time queued, prefix). """
+        return list(self._queues.pop(target, ()))
+
+    def adopt(self, target, lines):
+        """ Queues lines taken from another queue with take() to target, ahead of the lines already queued to it. """
+        if not lines:
+            return
+        queue = self._queues.get(target)
+        if queue is None:
+            queue = self._queues[target] = deque()
+        queue.extendleft(reversed(lines))
+        self._schedule()
+
+    def queue_depth(self, target=None):
+        """ Returns the number of lines waiting to be sent to target, or to all targets if target is None. """
+        if target is None:
+            return sum(len(queue) for queue in self._queues.values())
+        queue = self._queues.get(target)
+        return len(queue) if queue is not None else 0
+
+    def queue_depths(self):
+        """ Returns a dict of target -> number of lines waiting to be sent. """
+        return {target: len(queue) for target, queue in self._queues.items()}
+
+    def resume(self):
+        """ Starts sending again after the bot became able to send to a target it couldn't send to. """
+        self._schedule()
+
+    def _next_target(self):
+        """ Returns the first target in round-robin order that the bot can send to right now, or None. """
+        return next((target for target in self._queues if self._bot.can_send(target)), None)
+
+    def _schedule(self):
+        if self._call is not None or self._bot is None or self._next_target() is None:
+            return
+        self._call = self._clock.callLater(self._bucket.delay(), self._send_pending)
+
+    def _send_pending(self):
+        self._call = None
+        while self._queues and self._bot is not None:
+            #targets the bot can't send to yet (channels it's still joining) keep their lines and their turn
+            target = self._next_target()
+            if target is None or not self._bucket.consume():
+                break
+            queue = self._queues[target]
+            line, queued, prefix = queue.popleft()
+            width = self.line_width(target)
+            if len(line.encode('utf-8')) > width:
+                #split before our nick got longer, or taken over from a connection with a shorter nick
+                line, *rest = linesplit.split_message(line[len(prefix):], width, prefix, _NO_PACKING)[0]
+                queue.extendleft((chunk, queued, prefix) for chunk in reversed(rest))
+            if queue:
+                self._queues.move_to_end(target)
+            else:
+                del self._queues[target]
+            self._bot.send_privmsg(target, line)
+            metrics.IRC_SEND_DELAY_SECONDS.observe(self._clock.seconds() - queued, network=self.name)
+            metrics.IRC_LINES_SENT.inc(network=self.name)
+        self._schedule()
@@ -0,0 +1,210 @@
+"""
+Translates message formatting between IRC control codes and Discord markdown.
+
+Every translation is a single pass over the message with one compiled regex, so the cost is linear in the length of
+the message, no matter how much formatting it has.
+"""
+
+import re
+
+#IRC formatting control codes
+BOLD = '\x02'
+COLOR = '\x03'
+HEX_COLOR = '\x04'
+RESET = '\x0f'
+MONOSPACE = '\x11'
+REVERSE = '\x16'
+ITALIC = '\x1d'
+STRIKETHROUGH = '\x1e'
+UNDERLINE = '\x1f'
+
+#the IRC styles that have a markdown equivalent, in the order the markdown markers are opened
+_STYLES = (BOLD, UNDERLINE, ITALIC, STRIKETHROUGH, MONOSPACE)
+_MARKDOWN = {BOLD: '**', UNDERLINE: '__', ITALIC: '*', STRIKETHROUGH: '~~', MONOSPACE: '`'}
+
+#a link, which Discord shows as it is, markdown characters and all (like discord.py's escape_markdown(ignore_links=True)
+#finds them). IRC control codes end it.
+_URL = r'<[^: >\x00-\x1f]+:/[^ >\x00-\x1f]+>|(?:https?|steam)://[^\s<\x00-\x1f]+[^<.,:;"\'\]\s\x00-\x1f]'
+
+#control codes, links, markdown specials and line starts (for quotes) in IRC text. Only a double | is a spoiler marker.
+_IRC_TOKENS = re.compile(r'(?P<color>\x03(?:\d{1,2}(?:,\d{1,2})?)?|\x04(?:[0-9a-fA-F]{6}(?:,[0-9a-fA-F]{6})?)?)'
+                         r'|(?P<style>[\x02\x1d\x1f\x1e\x11])'
+                         r'|(?P<reset>\x0f)'
+                         r'|(?P<reverse>\x16)'
+                         rf'|(?P<url>{_URL})'
+                         r'|(?P<special>[\\*_~`]|\|\|)'
+                         r'|(?P<quote>^>)', re.MULTILINE)
+
+#markdown, links, mentions, escapes and stray IRC control codes in Discord text
+_DISCORD_TOKENS = re.compile(r'(?P<escape>\\[^\w\s])'
+                             r'|(?P<control>[\x02-\x04\x0f\x11\x16\x1d-\x1f])'
+                             rf'|(?P<url>{_URL})'
+                             r'|(?P<codeblock>```(?:[\w+-]*\n)?(?P<codeblock_body>[\s\S]*?)```)'
+                             r'|(?P<code>`(?P<code_body>[^`]+)`)'
+                             r'|(?P<user><@!?(?P<user_id>\d+)>)'
+                             r'|(?P<role><@&(?P<role_id>\d+)>)'
+                             r'|(?P<channel><#(?P<channel_id>\d+)>)'
+                             r'|(?P<emoji><a?:(?P<emoji_name>\w+):\d+>)'
+                             r'|(?P<marker>\*\*|__|~~|\|\||\*|_)')
+
+_DISCORD_MARKERS = {'**': BOLD, '__': UNDERLINE, '*': ITALIC, '_': ITALIC, '~~': STRIKETHROUGH}
+#IRC has no spoilers, so they're shown black on black, which most clients can reveal by selecting the text
+_SPOILER_START = COLOR + '01,01'
+_SPOILER_END = COLOR
+
+#matches any formatting control code, for stripping them
+_IRC_CONTROL = re.compile(r'\x03(?:\d{1,2}(?:,\d{1,2})?)?|\x04(?:[0-9a-fA-F]{6}(?:,[0-9a-fA-F]{6})?)?'
+                          r'|[\x02\x0f\x11\x16\x1d\x1e\x1f]')
+_MARKDOWN_SPECIAL = re.compile(rf'(?P<url>{_URL})|[\\*_~`>]|\|\|')
+
+
+def strip_irc(text):
+    """ Removes all IRC formatting control codes from text. """
+    return _IRC_CONTROL.sub('', text)
+
+
+def escape_markdown(text):
+    """ Escapes the characters in text that Discord would take as markdown. Links are left as they are. """
+    return _MARKDOWN_SPECIAL.sub(_escape_special, text)
+
+
+def _escape_special(match):
+    if match.lastgroup == 'url':
+        return match.group()
+    return ''.join('\\' + char for char in match.group())
+
+
+def irc_to_discord(text):
+    """ Translates IRC formatting in text to Discord markdown. Markdown special characters in the text are escaped
+    and formatting without a markdown equivalent (colors, reverse) is dropped. """
+    out = []
+    wanted = set()  #styles that should be on for the next bit of text
+    opened = []  #styles whose markdown markers are currently open, in the order they were opened
+    position = 0
+
+    def sync_styles():
+        #markdown markers must nest, so on any change close everything and reopen what's wanted
+        if set(opened) == wanted:
+            return
+        for style in reversed(opened):
+            out.append(_MARKDOWN[style])
+        opened.clear()
+        for style in _STYLES:
+            if style in wanted:
+                out.append(_MARKDOWN[style])
+                opened.append(style)
+
+    for match in _IRC_TOKENS.finditer(text):
+        kind = match.lastgroup
+        if match.start() > position:
+            sync_styles()
+            out.append(text[position:match.start()])
+        position = match.end()
+        if kind == 'style':
+            wanted.symmetric_difference_update(match.group())
+        elif kind == 'reset':
+            wanted.clear()
+        elif kind in ('special', 'quote', 'url'):
+            sync_styles()
+            chars = match.group()
+            #nothing can be escaped inside a code span, so just leave backticks out there
+            if MONOSPACE in opened:
+                out.append(chars.replace('`', ''))
+            elif kind == 'url':
+                out.append(chars)
+            else:
+                out.append(''.join('\\' + char for char in chars))
+        #colors and reverse have no markdown equivalent and are dropped
+    if position < len(text):
+        sync_styles()
+        out.append(text[position:])
+    for style in reversed(opened):
+        out.append(_MARKDOWN[style])
+    return ''.join(out)
+
+
+class MentionResolver():
+    """
+    Resolves the ids in Discord mentions to names, caching the results. Call clear() when names may have changed.
+    """
+
+    def __init__(self, user_lookup, role_lookup, channel_lookup, max_size=4096):
+        """ The lookups are called as lookup(guild, id) and return the name or None. """
+        self._lookups = {'user': user_lookup, 'role': role_lookup, 'channel': channel_lookup}
+        self._cache = {}
+        self.max_size = max_size
+
+    def resolve(self, kind, entity_id, guild=None):
+        """ Returns the name of the user, role or channel (kind) with the given id as seen in guild, or None. """
+        key = (kind, entity_id, guild)
+        try:
+            return self._cache[key]
+        except KeyError:
+            pass
+        name = self._lookups[kind](guild, entity_id)
+        if len(self._cache) >= self.max_size:
+            self._cache.clear()
+        self._cache[key] = name
+        return name
+
+    def clear(self):
+        """ Forgets all cached names. """
+        self._cache.clear()
+
+
+def discord_to_irc(text, resolver=None, guild=None):
+    """ Translates Discord markdown in text to IRC formatting, and mentions in guild to plain names using resolver
+    (a MentionResolver). Markers that aren't closed are left as they are, like Discord does. Any IRC control codes
+    already in the text are removed. """
+    out = []
+    open_at = {}  #IRC style (or the spoiler marker) -> (index in out of the code that opened it, markdown marker)
+    position = 0
+    for match in _DISCORD_TOKENS.finditer(text):
+        kind = match.lastgroup
+        start = match.start()
+        out.append(text[position:start])
+        position = match.end()
+        if kind == 'escape':
+            out.append(match.group()[1])
+        elif kind == 'control':
+            continue
+        elif kind == 'url':
+            out.append(match.group())
+        elif kind == 'codeblock':
+            out.append(match.group('codeblock_body').strip('\n'))
+        elif kind == 'code':
+            out.append(MONOSPACE + match.group('code_body') + MONOSPACE)
+        elif kind in ('user', 'role', 'channel'):
+            name = resolver.resolve(kind, int(match.group(kind + '_id')), guild) if resolver is not None else None
+            if name is None:
+                out.append(match.group())
+            else:
+                out.append(('#' if kind == 'channel' else '@') + name)
+        elif kind == 'emoji':
+            out.append(f":{match.group('emoji_name')}:")
+        else:
+            marker = match.group()
+            closing = open_at.get(ITALIC, (None, None))[1] == '_'
+            if marker == '_' and not _is_underscore_marker(text, start, closing):
+                out.append(marker)
+                continue
+            style = _DISCORD_MARKERS.get(marker, marker)
+            if style in open_at:
+                del open_at[style]
+                out.append(_SPOILER_END if marker == '||' else style)
+            else:
+                open_at[style] = (len(out), marker)
+                out.append(_SPOILER_START if marker == '||' else style)
+    out.append(text[position:])
+    #markers that were never closed weren't formatting after all, put them back
+    for index, marker in open_at.values():
+        out[index] = marker
+    return ''.join(out)
+
+
+def _is_underscore_marker(text, index, closing):
+    """ Single underscores only mean italics at word boundaries, so snake_case stays as is. """
+    if closing:
+        return index + 1 >= len(text) or not text[index + 1].isalnum()
+    return index == 0 or not text[index - 1].isalnum()
+
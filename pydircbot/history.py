@@ -0,0 +1,338 @@
+""" Scrollback: a per-channel history of the messages seen in bridged channels. """
+
+import heapq
+import json
+import logging
+import mmap
+import os
+import struct
+import time
+from collections import namedtuple
+from urllib.parse import quote, unquote
+
+#a namedtuple holding a message from the history. time is a UNIX timestamp and protocol is 'irc' or 'discord'
+HistoryEntry = namedtuple('HistoryEntry', ['time', 'protocol', 'network', 'channel', 'sender', 'text'])
+
+#an index entry is the time of a message and the offset of its record in the segment's data file
+_INDEX_ENTRY = struct.Struct('<dQ')
+
+#how often the retention limits are applied to every channel, in seconds
+PRUNE_INTERVAL = 3600
+
+
+def log_name(route_key):
+    """ Returns the name of the log of the channel with the given routing key (see IMessage.route_key). """
+    if isinstance(route_key, tuple):
+        return 'irc-{}-{}'.format(*route_key)
+    return f"discord-{route_key}"
+
+
+class _Segment():
+    """
+    A segment of a channel's log: a data file of newline separated JSON records and an index file of fixed-size
+    (time, offset) entries, one per record. Reads go through memory maps of the files.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.data_path = path + '.log'
+        self.index_path = path + '.idx'
+        self._data = None  #(mmap, size when mapped)
+        self._index = None
+        self._writers = None  #(data file, index file) while this is the active segment
+        self.count = os.path.getsize(self.index_path) // _INDEX_ENTRY.size if os.path.exists(self.index_path) else 0
+        self.size = os.path.getsize(self.data_path) if os.path.exists(self.data_path) else 0
+
+    def open_for_writing(self):
+        """ Opens the segment for appending, first dropping anything a crash left half written. """
+        with open(self.index_path, 'ab') as index:
+            index.truncate(self.count * _INDEX_ENTRY.size)
+        end = 0
+        if self.count:
+            _, last = _INDEX_ENTRY.unpack(self._read_index_entry(self.count - 1))
+            with open(self.data_path, 'rb') as data:
+                data.seek(last)
+                end = last + len(data.readline())
+        with open(self.data_path, 'ab') as data:
+            data.truncate(end)
+        self.size = end
+        self._writers = (open(self.data_path, 'ab'), open(self.index_path, 'ab'))
+
+    def _read_index_entry(self, position):
+        with open(self.index_path, 'rb') as index:
+            index.seek(position * _INDEX_ENTRY.size)
+            return index.read(_INDEX_ENTRY.size)
+
+    def append(self, timestamp, record):
+        """ Appends a record (bytes ending with a newline). It's buffered until flush() is called. """
+        data, index = self._writers
+        data.write(record)
+        index.write(_INDEX_ENTRY.pack(timestamp, self.size))
+        self.size += len(record)
+        self.count += 1
+
+    def flush(self):
+        """ Writes out the buffered records. """
+        if self._writers is not None:
+            for writer in self._writers:
+                writer.flush()
+
+    def seal(self):
+        """ Closes the files once the segment is no longer written to. """
+        if self._writers is not None:
+            for writer in self._writers:
+                writer.close()
+            self._writers = None
+
+    def _map(self, which, path, size):
+        mapped = getattr(self, which)
+        if mapped is not None and mapped[1] == size:
+            return mapped[0]
+        if mapped is not None:
+            mapped[0].close()
+        with open(path, 'rb') as mapfile:
+            view = mmap.mmap(mapfile.fileno(), size, access=mmap.ACCESS_READ)
+        setattr(self, which, (view, size))
+        return view
+
+    def entry(self, position):
+        """ Returns the (time, offset) index entry of the record at position. """
+        index = self._map('_index', self.index_path, self.count * _INDEX_ENTRY.size)
+        return _INDEX_ENTRY.unpack_from(index, position * _INDEX_ENTRY.size)
+
+    def record(self, position):
+        """ Returns the record at position as a HistoryEntry. """
+        data = self._map('_data', self.data_path, self.size)
+        start = self.entry(position)[1]
+        end = self.entry(position + 1)[1] if position + 1 < self.count else self.size
+        return HistoryEntry(*json.loads(data[start:end]))
+
+    def bisect(self, timestamp):
+        """ Returns the position of the first record at or after timestamp. """
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.entry(middle)[0] < timestamp:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    @property
+    def last_time(self):
+        """ The time of the last record, or None if the segment is empty. """
+        return self.entry(self.count - 1)[0] if self.count else None
+
+    def close(self):
+        """ Closes the files and memory maps. """
+        self.seal()
+        for which in ('_data', '_index'):
+            mapped = getattr(self, which)
+            if mapped is not None:
+                mapped[0].close()
+                setattr(self, which, None)
+
+    def remove(self):
+        """ Closes and deletes the segment. """
+        self.close()
+        for path in (self.data_path, self.index_path):
+            try:
+                os.remove(path)
+            except OSError as ex:
+                logging.error('Failed to remove history segment %s: %s', path, ex)
+
+
+class ChannelLog():
+    """ The history of one channel, as a series of segments of which only the last one is written to. """
+
+    def __init__(self, directory, segment_size, max_segments, max_age):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_segments = max_segments
+        self.max_age = max_age
+        os.makedirs(directory, exist_ok=True)
+        numbers = sorted({int(name.split('.')[0]) for name in os.listdir(directory) if name.split('.')[0].isdigit()})
+        self._segments = [_Segment(self._segment_path(number)) for number in numbers]
+        self._next_number = numbers[-1] + 1 if numbers else 0
+        if not self._segments:
+            self._rotate()
+        else:
+            self._segments[-1].open_for_writing()
+            self.prune()
+
+    def _segment_path(self, number):
+        return os.path.join(self.directory, f"{number:08d}")
+
+    def _rotate(self):
+        """ Seals the active segment, starts a new one and applies the retention limits. """
+        if self._segments:
+            self._segments[-1].flush()
+            self._segments[-1].seal()
+        segment = _Segment(self._segment_path(self._next_number))
+        self._next_number += 1
+        segment.open_for_writing()
+        self._segments.append(segment)
+        self._remove_old()
+
+    def _expired(self, segment):
+        return bool(self.max_age) and (segment.last_time or 0) < time.time() - self.max_age
+
+    def _remove_old(self):
+        while len(self._segments) > 1 and (len(self._segments) > self.max_segments or
+                                           self._expired(self._segments[0])):
+            self._segments.pop(0).remove()
+
+    def prune(self):
+        """ Applies the retention limits. The active segment is replaced by an empty one once everything in it is older
+        than max_age, so quiet channels don't keep their history forever. """
+        self.flush()
+        active = self._segments[-1]
+        if active.count and self._expired(active):
+            self._rotate()
+        else:
+            self._remove_old()
+
+    def append(self, entry):
+        """ Appends a HistoryEntry. """
+        record = json.dumps(entry, ensure_ascii=False, separators=(',', ':')).encode('utf-8') + b'\n'
+        if self._segments[-1].size + len(record) > self.segment_size and self._segments[-1].count:
+            self._rotate()
+        self._segments[-1].append(entry.time, record)
+
+    def flush(self):
+        """ Writes out the buffered entries. """
+        self._segments[-1].flush()
+
+    def last(self, count):
+        """ Returns the last count entries, newest first. """
+        self.flush()
+        found = []
+        for segment in reversed(self._segments):
+            for position in range(segment.count - 1, -1, -1):
+                if len(found) >= count:
+                    return found
+                found.append(segment.record(position))
+        return found
+
+    def between(self, start, end):
+        """ Yields the entries from start to end (UNIX timestamps, end exclusive), oldest first. """
+        self.flush()
+        for segment in self._segments:
+            last_time = segment.last_time
+            if last_time is None or last_time < start:
+                continue
+            position = segment.bisect(start)
+            while position < segment.count:
+                if segment.entry(position)[0] >= end:
+                    return
+                yield segment.record(position)
+                position += 1
+
+    def close(self):
+        """ Closes all the segments, writing out the buffered entries. """
+        self.flush()
+        for segment in self._segments:
+            segment.close()
+
+
+class HistoryStore():
+    """
+    Keeps the history of every channel in append-only segment files under a directory, one subdirectory per channel.
+    Every segment has an index of fixed-size entries, so the last N messages or the messages in a time range are found
+    without reading anything else. Segments are rotated once they grow past `segment_size` bytes; at most
+    `max_segments` are kept per channel and segments older than `max_age` seconds are deleted, when the store is
+    opened and every PRUNE_INTERVAL seconds after that.
+    Writes are buffered and flushed `flush_interval` seconds after the first unflushed one (and before every read), so
+    recording doesn't cost a system call per message. Without a loop, every write is flushed right away and the limits
+    are only applied on opening and rotation.
+    Must only be used from the core event loop's thread.
+    """
+
+    def __init__(self, directory, segment_size=4 * 1024 * 1024, max_segments=16, max_age=30 * 24 * 3600,
+                 flush_interval=1.0, loop=None):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_segments = max(1, max_segments)
+        self.max_age = max_age
+        self.flush_interval = flush_interval
+        self._loop = loop
+        self._logs = {}  #log name -> ChannelLog
+        self._unflushed = set()  #the ChannelLogs with buffered entries
+        self._flush_timer = None
+        self._prune_timer = None
+        self.prune()
+
+    def _log(self, name, create=True):
+        log = self._logs.get(name)
+        if log is None:
+            directory = os.path.join(self.directory, quote(name, safe=''))
+            if not create and not os.path.isdir(directory):
+                return None
+            log = self._logs[name] = ChannelLog(directory, self.segment_size, self.max_segments, self.max_age)
+        return log
+
+    def _logs_of(self, route_keys):
+        logs = (self._log(log_name(key), create=False) for key in route_keys)
+        return [log for log in logs if log is not None]
+
+    def record(self, message):
+        """ Adds an IMessage to the history of the channel it was sent on. """
+        entry = HistoryEntry(time.time(), message.protocol.name.lower(), message.network, message.channel,
+                             message.simple_sender, message.message)
+        log = self._log(log_name(message.route_key))
+        log.append(entry)
+        if self._loop is None:
+            log.flush()
+            return
+        self._unflushed.add(log)
+        if self._flush_timer is None:
+            self._flush_timer = self._loop.call_later(self.flush_interval, self.flush)
+
+    def flush(self):
+        """ Writes out the buffered entries of every channel. """
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            self._flush_timer = None
+        for log in self._unflushed:
+            log.flush()
+        self._unflushed.clear()
+
+    def prune(self):
+        """ Applies the retention limits to every channel, including the ones not seen since the bot started. """
+        if os.path.isdir(self.directory):
+            for name in os.listdir(self.directory):
+                if os.path.isdir(os.path.join(self.directory, name)):
+                    self._log(unquote(name)).prune()
+        if self._loop is not None:
+            self._prune_timer = self._loop.call_later(PRUNE_INTERVAL, self.prune)
+
+    def last(self, route_keys, count):
+        """ Returns the last count messages seen in the channels with the given routing keys, oldest first. """
+        if count <= 0:
+            return []
+        newest_first = heapq.merge(*(log.last(count) for log in self._logs_of(route_keys)),
+                                   key=lambda entry: entry.time,
+                                   reverse=True)
+        found = [entry for _, entry in zip(range(count), newest_first)]
+        found.reverse()
+        return found
+
+    def between(self, route_keys, start, end=None):
+        """ Returns the messages seen in the channels with the given routing keys from start to end (UNIX timestamps,
+        end exclusive, None for now), oldest first. """
+        if end is None:
+            end = time.time()
+        return list(
+            heapq.merge(*(log.between(start, end) for log in self._logs_of(route_keys)),
+                        key=lambda entry: entry.time))
+
+    def close(self):
+        """ Closes all the logs, writing out the buffered entries. """
+        for timer in (self._flush_timer, self._prune_timer):
+            if timer is not None:
+                timer.cancel()
+        self._flush_timer = self._prune_timer = None
+        self._unflushed.clear()
+        for log in self._logs.values():
+            log.close()
+        self._logs.clear()
@@ -1,17 +1,41 @@
 """ Main IRC bot module. """
 
-import logging
-from collections import namedtuple
 import asyncio
+import logging
+import sys
+import time
+from collections import Counter, namedtuple
 
 from twisted.words.protocols import irc
-from twisted.internet import protocol, reactor
+from twisted.internet import protocol
 
 from . import adapters
+from . import eventloop
+from . import flood
+from . import formatting
+from . import linesplit
+from . import membership
+from . import metrics
+from .roster import Roster
 
 #a namedtuple used to pass around common info about bots
 IRCBotInfo = namedtuple('IRCBotInfo', ['nickname', 'ident', 'realname'])
 
+#translation tables for the CASEMAPPINGs servers may use, see irc_lower()
+_CASEMAPPINGS = {
+    'ascii': str.maketrans('ABCDEFGHIJKLMNOPQRSTUVWXYZ', 'abcdefghijklmnopqrstuvwxyz'),
+    'rfc1459': str.maketrans('ABCDEFGHIJKLMNOPQRSTUVWXYZ[]\\~', 'abcdefghijklmnopqrstuvwxyz{}|^'),
+    'strict-rfc1459': str.maketrans('ABCDEFGHIJKLMNOPQRSTUVWXYZ[]\\', 'abcdefghijklmnopqrstuvwxyz{}|'),
+}
+#servers that don't advertise a CASEMAPPING are assumed to use this one
+DEFAULT_CASEMAPPING = 'rfc1459'
+
+
+def irc_lower(name, casemapping=DEFAULT_CASEMAPPING):
+    """ Lowercases an IRC nick or channel name according to the given CASEMAPPING, so that names the server considers
+    equal are also equal here. Unknown casemappings are treated as rfc1459. """
+    return name.translate(_CASEMAPPINGS.get(casemapping, _CASEMAPPINGS[DEFAULT_CASEMAPPING]))
+
 
 #Disable pylint warning for unimplemented methods because Twisted has decided to keep some funny
 #forever unimplemented placeholder methods.
@@ -26,76 +50,607 @@ class IRCBot(irc.IRCClient):
         self.channels = channels
         self.network_name = network_name
         self._adapter = adapter
+        self._joining = {}  #lowercased name -> name of the channels we've sent a JOIN for and haven't joined yet
 
     def connectionMade(self):
         logging.info("Connection made to %s.", self.network_name)
         super().connectionMade()
 
+    @property
+    def casemapping(self):
+        """ The CASEMAPPING the server told us it uses. """
+        return self.supported.getFeature('CASEMAPPING', (DEFAULT_CASEMAPPING, ))[0]
+
+    def irc_lower(self, name):
+        """ Lowercases a nick or channel name according to the server's CASEMAPPING. """
+        return irc_lower(name, self.casemapping)
+
+    @property
+    def hostmask(self):
+        """ Our nick!user@host as the server shows it to others, as far as we know it. """
+        return self.factory.outbound.hostmask
+
+    @hostmask.setter
+    def hostmask(self, hostmask):
+        self.factory.outbound.hostmask = hostmask
+
+    def send_privmsg(self, target, line):
+        """ Sends a line that already fits in a PRIVMSG as is. msg() would split it again to fit its own estimate
+        of how long lines may be. """
+        self.sendLine(f"PRIVMSG {target} :{line}")
+
+    @property
+    def roster(self):
+        """ The Roster of the network. """
+        return self.factory.roster
+
+    @property
+    def membership(self):
+        """ The MembershipRelay of the network, or None if this connection doesn't relay membership events. """
+        return self.factory.membership
+
+    def join(self, channel, key=None):
+        self._joining[self.irc_lower(channel)] = channel
+        super().join(channel, key)
+
+    def in_channel(self, channel):
+        """ True if we're on channel or about to be. """
+        return self.irc_lower(channel) in self._joining or self.roster.is_on(channel)
+
+    def can_send(self, target):
+        """ False while we're joining target, so what's queued to it waits until we can actually send it. """
+        return self.irc_lower(target) not in self._joining
+
+    def _not_on(self, channel):
+        """ Forgets a channel we aren't on (anymore), along with the lines queued to it. Returns how many lines were
+        dropped. """
+        key = self.irc_lower(channel)
+        self._joining.pop(key, None)
+        self.roster.left(channel, self.factory)
+        dropped = sum(len(self.factory.outbound.take(target))
+                      for target in list(self.factory.outbound.queue_depths()) if self.irc_lower(target) == key)
+        #the lines we held back for the channel may have been all that was queued
+        self.factory.outbound.resume()
+        return dropped
+
     def signedOn(self):
+        #until the server shows us our host, assume the longest one there can be
+        self.hostmask = linesplit.estimated_hostmask(self.nickname, self.ident)
+        self.roster.set_prefixes(self.supported.getFeature('PREFIX'))
         for channel in self.channels:
             self.join(channel)
+        self.factory.outbound.attach(self)
+        self._adapter.irc_signed_on(self.network_name, self.factory)
+
+    def isupport(self, options):
+        if any(option.startswith('CASEMAPPING=') for option in options):
+            self._joining = {self.irc_lower(channel): channel for channel in self._joining.values()}
+            self._adapter.irc_casemapping_changed(self.network_name, self.casemapping)
+        if any(option.startswith('PREFIX=') for option in options):
+            self.roster.set_prefixes(self.supported.getFeature('PREFIX'))
+
+    #roster tracking
+    def joined(self, channel):
+        self._joining.pop(self.irc_lower(channel), None)
+        self.roster.joined(channel, self.factory)
+        self.factory.outbound.resume()
+
+    def left(self, channel):
+        #we parted, so whatever is still queued to the channel was queued after we were told to leave it
+        dropped = self._not_on(channel)
+        if dropped:
+            logging.info('Left %s on %s, dropping %d queued lines.', channel, self.network_name, dropped)
+
+    def kickedFrom(self, channel, kicker, message):
+        dropped = self._not_on(channel)
+        logging.warning('Kicked from %s on %s by %s (%s), dropping %d queued lines.', channel, self.network_name,
+                        kicker, message, dropped)
+
+    def _join_failed(self, prefix, params):
+        dropped = self._not_on(params[1])
+        logging.warning("Couldn't join %s on %s (%s), dropping %d queued lines.", params[1], self.network_name,
+                        params[-1], dropped)
+
+    irc_ERR_NOSUCHCHANNEL = irc_ERR_TOOMANYCHANNELS = irc_ERR_CHANNELISFULL = _join_failed
+    irc_ERR_INVITEONLYCHAN = irc_ERR_BANNEDFROMCHAN = irc_ERR_BADCHANNELKEY = _join_failed
+    irc_477 = _join_failed  #ERR_NEEDREGGEDNICK, which Twisted doesn't know
+
+    def irc_RPL_NAMREPLY(self, prefix, params):
+        self.roster.names(params[2], params[3].split())
+
+    def irc_RPL_ENDOFNAMES(self, prefix, params):
+        self.roster.end_of_names(params[1])
+
+    def userJoined(self, user, channel):
+        self.roster.add(channel, user)
+        if self.membership is not None:
+            self.membership.joined(channel, user)
+
+    def userLeft(self, user, channel):
+        self.roster.remove(channel, user)
+
+    def irc_PART(self, prefix, params):
+        super().irc_PART(prefix, params)
+        #Twisted doesn't pass the part message on to userLeft
+        nick = prefix.split('!', 1)[0]
+        if nick != self.nickname and self.membership is not None:
+            self.membership.parted(params[0], nick, params[1] if len(params) > 1 else '')
+
+    def userKicked(self, kickee, channel, kicker, message):
+        self.roster.remove(channel, kickee)
+
+    def userQuit(self, user, quitMessage):
+        #when several of our connections see the quit, only the first one gets the channels
+        channels = self.roster.quit(user)
+        if self.membership is not None:
+            self.membership.quit(channels, user, quitMessage)
+
+    def userRenamed(self, oldname, newname):
+        channels = self.roster.rename(oldname, newname)
+        if self.membership is not None:
+            self.membership.renamed(channels, oldname, newname)
+
+    def modeChanged(self, user, channel, on, modes, args):
+        for mode, arg in zip(modes, args):
+            if arg is not None:
+                self.roster.set_mode(channel, mode, arg, on)
+
+    def irc_RPL_WELCOME(self, prefix, params):
+        #the welcome message often ends with our nick!user@host
+        mask = params[-1].rsplit(' ', 1)[-1]
+        super().irc_RPL_WELCOME(prefix, params)
+        if mask.startswith(self.nickname + '!') and '@' in mask:
+            self.hostmask = mask
+
+    def irc_JOIN(self, prefix, params):
+        #the server echoes our own joins with our hostmask as the prefix
+        if prefix.split('!', 1)[0] == self.nickname and '@' in prefix:
+            self.hostmask = prefix
+        super().irc_JOIN(prefix, params)
+
+    def irc_396(self, prefix, params):
+        #RPL_HOSTHIDDEN, which Twisted doesn't know: the server changed the host it shows for us, eg. to a cloak
+        if len(params) > 1:
+            self.hostmask = self.hostmask.split('@', 1)[0] + '@' + params[1]
+
+    def nickChanged(self, nick):
+        self.roster.rename(self.nickname, nick)
+        super().nickChanged(nick)
+        if self.hostmask is not None:
+            self.hostmask = nick + '!' + self.hostmask.split('!', 1)[-1]
+
+    def connectionLost(self, reason):
+        self.factory.outbound.detach()
+        self.roster.left_all(self.factory)
+        self._joining.clear()
+        self._adapter.irc_disconnected(self.network_name)
+        super().connectionLost(reason)
 
     def privmsg(self, user, channel, message):
-        #call the adapter's event thing in a new thread
-        ircmessage = IRCMessage(self, user, channel, message)
-        coro = self._adapter.message_received(ircmessage)
-        asyncio.run_coroutine_threadsafe(coro, self._adapter.loop)
+        #call the adapter's event thing on the core loop (directly if we share it in single-loop mode)
+        with metrics.RECEIVE_SECONDS.time(protocol='irc'):
+            metrics.MESSAGES_RECEIVED.inc(protocol='irc')
+            ircmessage = IRCMessage(self, user, channel, message)
+            coro = self._adapter.message_received(ircmessage)
+            eventloop.submit(coro, self._adapter.loop)
 
 
 class IRCBotFactory(protocol.ReconnectingClientFactory):
     """ The factory class for IRC bots. """
 
-    def __init__(self, bot_info: IRCBotInfo, channels: "List of channels", network_name, adapter):
-        """ Creates a new factory for the given network. """
+    def __init__(self,
+                 bot_info: IRCBotInfo,
+                 channels: "List of channels",
+                 network_name,
+                 adapter,
+                 flood_settings=flood.DEFAULT_FLOOD_SETTINGS,
+                 split_settings=linesplit.DEFAULT_SPLIT_SETTINGS,
+                 roster=None,
+                 membership_relay=None):
+        """ Creates a new factory for the given network. Connections to the same network may share a roster and a
+        membership.MembershipRelay. Membership events aren't relayed if membership_relay is None. """
         self.bot_info = bot_info
+        self.roster = roster if roster is not None else Roster(irc_lower)
+        self.membership = membership_relay
         self.channels = channels
         self.network_name = network_name
         self._adapter = adapter
         self._bot = None
+        #the outbound queue outlives the individual connections so nothing queued is lost on reconnect
+        self.outbound = flood.OutboundQueue(flood_settings, name=network_name, split_settings=split_settings)
+        self.outbound.hostmask = linesplit.estimated_hostmask(bot_info.nickname, bot_info.ident)
 
     def buildProtocol(self, addr):
         self._bot = IRCBot(self.bot_info, self.channels, self.network_name, self._adapter)
+        self._bot.factory = self
         self.resetDelay()  #resets the reconnection delay
         return self._bot
 
+    def send(self, target, message, prefix=''):
+        """ Queues a message to target for sending on this connection, with prefix (eg. the relayed sender) at the
+        start of each line. Thread-safe. """
+        eventloop.call_in_reactor(self.outbound.enqueue, target, message, prefix)
+
+    def join(self, channel):
+        """ Adds a channel the bot should be on, joining it right away if we're connected. Must be called from the
+        reactor thread. """
+        self.channels.append(channel)
+        if self.connected:
+            self._bot.join(channel)
+
+    def part(self, channel):
+        """ Removes a channel the bot should be on, parting it right away if we're connected. Must be called from the
+        reactor thread. """
+        self.channels.remove(channel)
+        if self.connected:
+            self._bot.part(channel)
+
     @property
     def bot(self):
         """ Returns the last IRCBot this factory built. """
         return self._bot
 
+    @property
+    def connected(self):
+        """ True if we're connected and signed on to the network. """
+        return self.outbound.attached
+
+    @property
+    def flood_settings(self):
+        """ The flood control settings of the connection. """
+        return self.outbound.settings
+
     def startedConnecting(self, connector):
         logging.info("Started connecting to %s.", self.network_name)
         super().startedConnecting(connector)
 
     def clientConnectionFailed(self, connector, reason):
         logging.error("Connection to %s failed. Reason: %s", self.network_name, reason)
+        metrics.IRC_RECONNECTS.inc(network=self.network_name)
         super().clientConnectionFailed(connector, reason)
 
     def clientConnectionLost(self, connector, reason):
+        if not self.continueTrying:
+            #we quit
+            logging.info("Disconnected from %s.", self.network_name)
+            return
         logging.error("Connection to %s lost. Reason: %s", self.network_name, reason)
+        metrics.IRC_RECONNECTS.inc(network=self.network_name)
         super().clientConnectionLost(connector, reason)
 
 
-class IRCMessage(adapters.IMessage):
-    """ Pass me along to event handlers as the message. """
+class IRCNetwork():
+    """
+    The connections to an IRC network. There's a pool of `connections` connections, each with its own socket and flood
+    control budget, and each channel is joined by just one of them. New channels go to the connection with the least
+    traffic, and every `rebalance_interval` seconds the observed outbound traffic of the channels is used to move the
+    channel that best evens out the load from the busiest connection to the quietest one. When a connection drops, its
+    channels fail over to the remaining connections along with the lines queued to them.
+    Stands in for the adapter of its connections, passing their events on to the real adapter.
+    Must be used from the reactor thread, except for send().
+    """
+
+    #weight of the latest interval in the traffic estimates
+    SMOOTHING = 0.5
+    #how much a move must lower the load of the busiest connection for the channel to be moved, as a fraction
+    MIN_GAIN = 0.1
+
+    def __init__(self,
+                 bot_info,
+                 channels,
+                 network_name,
+                 adapter,
+                 flood_settings=flood.DEFAULT_FLOOD_SETTINGS,
+                 split_settings=linesplit.DEFAULT_SPLIT_SETTINGS,
+                 membership_settings=membership.DEFAULT_MEMBERSHIP_SETTINGS,
+                 connections=1,
+                 rebalance_interval=300.0):
+        self.network_name = network_name
+        self.channels = []
+        self.rebalance_interval = rebalance_interval
+        self.casemapping = DEFAULT_CASEMAPPING
+        self._adapter = adapter
+        self.roster = Roster(self.irc_lower)
+        self.membership = membership.MembershipRelay(self._membership_notice, self.irc_lower, membership_settings)
+        self.connections = []
+        for index in range(max(1, connections)):
+            #every connection needs a nick of its own
+            nickname = bot_info.nickname if index == 0 else f"{bot_info.nickname}{index + 1}"
+            self.connections.append(
+                IRCBotFactory(bot_info._replace(nickname=nickname), [], network_name, self, flood_settings,
+                              split_settings, self.roster, self.membership))
+        self._connectors = []
+        self._rebalancer = None
+        self._assignment = {}  #lowercased channel -> the IRCBotFactory of the connection that joins it
+        self._load = {}  #lowercased channel -> estimated lines sent per rebalance interval
+        self._sent = Counter()  #lowercased channel -> lines sent during this interval
+        self.set_channels(channels)
+
+    def connect(self, host, port):
+        """ Starts connecting to the network. The connections won't *actually* connect until the reactor runs. """
+        from twisted.internet import reactor, task
+        self._connectors = [reactor.connectTCP(host, port, factory) for factory in self.connections]
+        if len(self.connections) > 1 and self.rebalance_interval:
+            self._rebalancer = task.LoopingCall(self.rebalance)
+            self._rebalancer.start(self.rebalance_interval, now=False)
+
+    def disconnect(self, quitmessage):
+        """ Quits from the network and closes the connections for good. """
+        if self._rebalancer is not None and self._rebalancer.running:
+            self._rebalancer.stop()
+        for factory, connector in zip(self.connections, self._connectors):
+            factory.stopTrying()
+            if factory.connected:
+                factory.bot.quit(quitmessage)
+            connector.disconnect()
+
+    @property
+    def loop(self):
+        """ The event loop of the adapter. """
+        return self._adapter.loop
+
+    @property
+    def connected(self):
+        """ True if at least one of the connections is signed on to the network. """
+        return any(factory.connected for factory in self.connections)
+
+    @property
+    def bot(self):
+        """ The IRCBot of a signed on connection, or of the first connection if none are. """
+        return self._primary().bot
+
+    @property
+    def flood_settings(self):
+        """ The flood control settings of each of the connections. """
+        return self.connections[0].flood_settings
+
+    def set_flood_settings(self, settings):
+        """ Switches all the connections to new flood control settings. """
+        for factory in self.connections:
+            factory.outbound.set_settings(settings)
+
+    @property
+    def split_settings(self):
+        """ The line splitting settings of the network. """
+        return self.connections[0].outbound.split_settings
+
+    def set_split_settings(self, settings):
+        """ Switches all the connections to new line splitting settings. """
+        for factory in self.connections:
+            factory.outbound.split_settings = settings
+
+    @property
+    def membership_settings(self):
+        """ The membership relay settings of the network. """
+        return self.membership.settings
+
+    def set_membership_settings(self, settings):
+        """ Switches to new membership relay settings. """
+        self.membership.set_settings(settings)
+
+    def queue_depths(self):
+        """ Returns a dict of target -> number of lines waiting to be sent, over all the connections. """
+        depths = Counter()
+        for factory in self.connections:
+            depths.update(factory.outbound.queue_depths())
+        return dict(depths)
+
+    def irc_lower(self, name):
+        """ Lowercases a nick or channel name according to the network's CASEMAPPING. """
+        return irc_lower(name, self.casemapping)
+
+    def send(self, target, message, prefix=''):
+        """ Queues a message to target for sending on the connection that joined it, with prefix at the start of
+        each line. Thread-safe. """
+        eventloop.call_in_reactor(self._send, target, message, prefix)
+
+    def _send(self, target, message, prefix=''):
+        key = self.irc_lower(target)
+        factory = self._assignment.get(key)
+        if factory is None:
+            #not one of our channels, any connection will do
+            factory = self._primary()
+        else:
+            if not factory.connected:
+                failover = self._primary()
+                if failover.connected:
+                    self._move(key, failover)
+                    factory = failover
+            self._sent[key] += 1
+        if factory.connected and target[:1] in factory.bot.supported.getFeature('CHANTYPES'):
+            if not factory.bot.in_channel(target):
+                #we were kicked, couldn't join or never meant to be there
+                logging.debug('Not on %s on %s, dropping message.', target, self.network_name)
+                metrics.RELAYS_DROPPED.inc(protocol='irc')
+                return
+            message = self.roster.highlight(target, message)
+        factory.outbound.enqueue(target, message, prefix)
+
+    def _primary(self):
+        return next((factory for factory in self.connections if factory.connected), self.connections[0])
+
+    def _loads(self, factories):
+        """ Returns a dict of factory -> estimated load for the given connections. """
+        loads = {factory: 0.0 for factory in factories}
+        for key, factory in self._assignment.items():
+            if factory in loads:
+                loads[factory] += self._load.get(key, 0.0)
+        return loads
+
+    def _quietest(self):
+        """ Returns the signed on connection (or any connection if none are) with the least load and channels. """
+        candidates = [factory for factory in self.connections if factory.connected] or self.connections
+        loads = self._loads(candidates)
+        return min(candidates, key=lambda factory: (loads[factory], len(factory.channels)))
+
+    def _move(self, key, destination):
+        """ Moves a channel and the lines queued to it to another connection. """
+        source = self._assignment[key]
+        channel = next(channel for channel in source.channels if self.irc_lower(channel) == key)
+        logging.info('Moving %s on %s from %s to %s.', channel, self.network_name, source.bot_info.nickname,
+                     destination.bot_info.nickname)
+        source.part(channel)
+        destination.join(channel)
+        self._assignment[key] = destination
+        for target in list(source.outbound.queue_depths()):
+            if self.irc_lower(target) == key:
+                destination.outbound.adopt(target, source.outbound.take(target))
+
+    def set_channels(self, channels):
+        """ Changes the channels we should be on, joining and parting channels right away where we're connected. """
+        keys = {self.irc_lower(channel) for channel in channels}
+        for key in [key for key in self._assignment if key not in keys]:
+            factory = self._assignment.pop(key)
+            factory.part(next(channel for channel in factory.channels if self.irc_lower(channel) == key))
+            self._load.pop(key, None)
+            self._sent.pop(key, None)
+        for channel in channels:
+            key = self.irc_lower(channel)
+            if key not in self._assignment:
+                factory = self._assignment[key] = self._quietest()
+                factory.join(channel)
+        self.channels = list(channels)
+
+    def rebalance(self):
+        """ Updates the traffic estimates and moves at most one channel from the busiest connection to the quietest
+        one, if that evens out the load enough. """
+        for key in self._assignment:
+            self._load[key] = (1 - self.SMOOTHING) * self._load.get(key, 0.0) + self.SMOOTHING * self._sent[key]
+        self._sent.clear()
+        connected = [factory for factory in self.connections if factory.connected]
+        if len(connected) < 2:
+            return
+        loads = self._loads(connected)
+        busiest = max(connected, key=loads.get)
+        quietest = min(connected, key=loads.get)
+        gap = loads[busiest] - loads[quietest]
+        candidates = [(self._load.get(key, 0.0), key)
+                      for key, factory in self._assignment.items()
+                      if factory is busiest and 0 < self._load.get(key, 0.0) < gap]
+        if not candidates:
+            return
+        #the channel whose load is closest to half the gap evens things out the most
+        load, key = min(candidates, key=lambda candidate: abs(gap / 2 - candidate[0]))
+        if max(loads[busiest] - load, loads[quietest] + load) <= (1 - self.MIN_GAIN) * loads[busiest]:
+            self._move(key, quietest)
+
+    #adapter methods called by the connections
+    def message_received(self, message):
+        """ Passes a message on to the adapter. """
+        return self._adapter.message_received(message)
+
+    def irc_signed_on(self, network, factory):
+        """ Tells the adapter the network is available. """
+        self._adapter.irc_signed_on(network, self)
+
+    def irc_disconnected(self, network):
+        """ Fails the channels of the connections that are down over to the ones that are up. Tells the adapter if
+        the whole network is down. """
+        if not self.connected:
+            self._adapter.irc_disconnected(network)
+            return
+        for key, factory in list(self._assignment.items()):
+            if not factory.connected:
+                self._move(key, self._quietest())
+
+    def _membership_notice(self, channel, text):
+        """ Passes the membership events the MembershipRelay put together for a channel on to the adapter. """
+        self._adapter.irc_membership(self.network_name, channel, text)
+
+    def irc_casemapping_changed(self, network, casemapping):
+        """ Relowercases our channels and tells the adapter. """
+        if casemapping != self.casemapping:
+            self.casemapping = casemapping
+            self._assignment = {
+                self.irc_lower(channel): factory
+                for factory in self.connections for channel in factory.channels
+            }
+            self._load.clear()
+            self._sent.clear()
+            self.roster.rekey()
+        self._adapter.irc_casemapping_changed(network, casemapping)
+
+
+def connection_settings(irc_config, server_info):
+    """ Returns the (host, port, number of connections) of a server in the irc section of the config. """
+    return (server_info['host'], server_info['port'],
+            server_info.get('connections', irc_config.get('connections', 1)))
+
+
+def make_network(irc_config, server, server_info, adapter):
+    """ Creates the IRCNetwork of a server in the irc section of the config. """
+    bot_info = IRCBotInfo(nickname=irc_config['nick'], ident=irc_config['ident'], realname=irc_config['realname'])
+    return IRCNetwork(bot_info,
+                      server_info['channels'],
+                      server,
+                      adapter,
+                      flood_settings=flood.flood_settings(irc_config.get('flood'), server_info.get('flood')),
+                      split_settings=linesplit.split_settings(irc_config.get('split'), server_info.get('split')),
+                      membership_settings=membership.membership_settings(irc_config.get('membership'),
+                                                                         server_info.get('membership')),
+                      connections=connection_settings(irc_config, server_info)[2],
+                      rebalance_interval=irc_config.get('rebalance_interval', 300.0))
+
+
+async def shutdown(networks, quitmessage, drain_timeout, quit_timeout):
+    """
+    Shuts IRCNetworks down: waits up to drain_timeout seconds for their outbound queues to empty, then quits from all
+    of them at once and waits for the connections to close until drain_timeout + quit_timeout seconds after the call,
+    however long quitting took. Returns a dict of network name -> number of lines that were still queued when we quit.
+    The networks are only touched in the reactor thread, so this can be awaited on any event loop.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + drain_timeout
+    end = deadline + quit_timeout
+
+    def queued():
+        return {network.network_name: sum(network.queue_depths().values()) for network in networks}
+
+    def quit_all():
+        for network in networks:
+            network.disconnect(quitmessage)
+
+    pending = await eventloop.run_in_reactor(queued)
+    while any(pending.values()) and loop.time() < deadline:
+        await asyncio.sleep(0.05)
+        pending = await eventloop.run_in_reactor(queued)
+    await eventloop.run_in_reactor(quit_all)
+    while loop.time() < end and await eventloop.run_in_reactor(
+            lambda: any(network.connected for network in networks)):
+        await asyncio.sleep(0.05)
+    return {name: lines for name, lines in pending.items() if lines}
+
+
+class IRCMessage(adapters.Envelope):
+    """ Pass me along to event handlers as the message. The bot it came through is kept for replying. """
+
+    __slots__ = ('_sender_full', '_message')
 
     def __init__(self, bot, sender, channel, message_text):
-        self._bot = bot
-        self._sender_full = sender  #this seems to be nick!user@host
-        self._sender_nick = sender.split('!', 1)[0]
-        self._channel = channel
-        self._message_text = message_text
+        #the same few senders and channels come up again and again, so their strings are shared between the messages
+        channel = sys.intern(channel)
+        #the plain text is read by the filter, echo suppression, history and commands, so it's stripped only once.
+        #Without any formatting in the message, it's the content itself rather than a copy
+        super().__init__(bot,
+                         bot.network_name,
+                         channel,
+                         (bot.network_name, sys.intern(bot.irc_lower(channel))),
+                         sys.intern(sender.split('!', 1)[0]),
+                         message_text,
+                         time.perf_counter(),
+                         _sender_full=sys.intern(sender),  #this seems to be nick!user@host
+                         _message=formatting.strip_irc(message_text))
 
     def reply(self, message_text):
         #if this is a private message
-        if self._channel == self._bot.nickname:
-            reactor.callFromThread(self._bot.msg, self._sender_nick, message_text)
+        if self._channel == self._origin.nickname:
+            self._origin.factory.send(self._simple_sender, message_text)
         #otherwise send in the channel
         else:
-            reactor.callFromThread(self._bot.msg, self._channel, message_text)
+            self._origin.factory.send(self._channel, message_text)
 
     def reply_with_highlight(self, message_text):
-        self.reply(self._sender_nick + ': ' + message_text)
+        self.reply(self._simple_sender + ': ' + message_text)
 
     @property
     def protocol(self):
@@ -103,19 +658,20 @@ class IRCMessage(adapters.IMessage):
 
     @property
     def source(self):
-        return (self._bot.network_name, self._channel)
+        return (self._network, self._channel)
 
     @property
     def sender(self):
         return self._sender_full
 
-    @property
-    def simple_sender(self):
-        return self._sender_nick
-
     @property
     def message(self):
-        return self._message_text
+        return self._message
+
+    def message_as(self, protocol):
+        if protocol is self.Protocol.DISCORD:
+            return formatting.irc_to_discord(self._content)
+        return self._content
 
-    def __str__(self):
-        return self.message
+    def with_text(self, text):
+        return self._replace(_content=text, _message=text)
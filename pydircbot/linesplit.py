@@ -0,0 +1,115 @@
+""" Splits relayed messages into IRC lines that fit in what the server lets us send. """
+
+import re
+from collections import namedtuple
+
+#the longest line a server accepts, including the CR LF at the end
+MAX_LINE_BYTES = 512
+#the longest hostname there can be. Used in place of our host until the server tells us what it is
+MAX_HOST_LENGTH = 63
+#appended to the last line of a truncated message
+ELLIPSIS = ' [...]'
+#the smallest payload we split to, so that every character fits on a line of its own
+MIN_WIDTH = 4
+
+#a namedtuple holding the line splitting settings of a network
+#max_lines is the most lines a message may take (0 for no limit), overflow is what to do with messages that would take
+#more: 'truncate' them or 'drop' them, and separator is what short lines are packed together with (None to not pack)
+SplitSettings = namedtuple('SplitSettings', ['max_lines', 'overflow', 'separator'])
+DEFAULT_SPLIT_SETTINGS = SplitSettings(max_lines=5, overflow='truncate', separator=' | ')
+OVERFLOW_ACTIONS = ('truncate', 'drop')
+
+_LINE_BREAK = re.compile(r'\r\n|[\r\n]')
+
+
+def split_settings(*configs):
+    """ Builds a SplitSettings from the given config dicts. Later dicts override earlier ones and missing values are
+    taken from the defaults. Dicts may be None. """
+    values = DEFAULT_SPLIT_SETTINGS._asdict()
+    for config in configs:
+        if config:
+            values.update((key, config[key]) for key in SplitSettings._fields if key in config)
+    settings = SplitSettings(**values)
+    if settings.max_lines < 0 or settings.overflow not in OVERFLOW_ACTIONS:
+        raise ValueError(f"Invalid line splitting settings: {settings}")
+    return settings
+
+
+def estimated_hostmask(nickname, ident):
+    """ Returns the longest nick!user@host the server could show for us. The server may prefix the ident with ~. """
+    return f"{nickname}!~{ident}@{'x' * MAX_HOST_LENGTH}"
+
+
+def line_width(hostmask, target):
+    """ Returns how many bytes of text fit in a PRIVMSG to target, when the server relays it with our hostmask as the
+    prefix. """
+    return MAX_LINE_BYTES - len(f":{hostmask} PRIVMSG {target} :\r\n".encode('utf-8'))
+
+
+def _byte_length(text):
+    return len(text.encode('utf-8'))
+
+
+def wrap(text, width):
+    """ Splits a line into chunks of at most width UTF-8 bytes. Breaks at spaces where possible and never inside a
+    character. """
+    width = max(width, MIN_WIDTH)
+    data = text.encode('utf-8')
+    chunks = []
+    while len(data) > width:
+        cut = data.rfind(b' ', 0, width + 1)
+        if cut > 0:
+            chunks.append(data[:cut])
+            data = data[cut + 1:].lstrip(b' ')
+            continue
+        #no space to break at, so break before the character that doesn't fit. Continuation bytes are 10xxxxxx.
+        cut = width
+        while data[cut] & 0xC0 == 0x80:
+            cut -= 1
+        chunks.append(data[:cut])
+        data = data[cut:]
+    if data:
+        chunks.append(data)
+    return [chunk.decode('utf-8') for chunk in chunks]
+
+
+def split(text, width, separator=DEFAULT_SPLIT_SETTINGS.separator):
+    """ Splits a possibly multi-line text into lines of at most width UTF-8 bytes. Consecutive short lines are packed
+    onto one line, joined with separator, unless separator is None. Blank lines are left out. """
+    lines = []
+    current = None
+    for line in _LINE_BREAK.split(text.replace('\0', '')):
+        line = line.strip()
+        if not line:
+            continue
+        if current is not None and separator is not None:
+            packed = current + separator + line
+            if _byte_length(packed) <= width:
+                current = packed
+                continue
+        if current is not None:
+            lines.append(current)
+        chunks = wrap(line, width)
+        #the tail of a wrapped line can still have lines packed onto it
+        lines.extend(chunks[:-1])
+        current = chunks[-1]
+    if current is not None:
+        lines.append(current)
+    return lines
+
+
+def split_message(message, width, prefix='', settings=DEFAULT_SPLIT_SETTINGS):
+    """
+    Splits a message into lines of at most width UTF-8 bytes, each starting with prefix. Returns (lines, whether the
+    message was too long). A message that would take more than settings.max_lines lines is truncated to that many
+    lines, the last one ending in an ellipsis, or dropped altogether (leaving no lines) if settings.overflow is 'drop'.
+    """
+    text_width = width - _byte_length(prefix)
+    lines = split(message, text_width, settings.separator)
+    overflowed = 0 < settings.max_lines < len(lines)
+    if overflowed:
+        if settings.overflow == 'drop':
+            return [], True
+        lines = lines[:settings.max_lines]
+        lines[-1] = wrap(lines[-1], text_width - _byte_length(ELLIPSIS))[0] + ELLIPSIS
+    return [prefix + line for line in lines], overflowed
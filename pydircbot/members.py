@@ -0,0 +1,109 @@
+""" Fast lookups of Discord guild members by name. """
+
+import re
+
+#an IRC-style highlight at the start of a message, eg. "nick: hello" or "nick, hello"
+_HIGHLIGHT = re.compile(r'^([^\s:,]+)([:,])(?=\s|$)')
+
+#characters IRC users commonly tack onto their nick when their usual one is taken or to signal status,
+#eg. nick_, nick`, nick|away, nick^
+_NICK_DECORATION = re.compile(r'(?:[|\[].*|[_`^\-]+|\d+)$')
+
+
+def normalize_name(name):
+    """ Returns the case-insensitive lookup key for a name. """
+    return name.casefold()
+
+
+def nick_variations(nick):
+    """ Yields the lookup keys to try for an IRC nick, most specific first: the nick itself and then the nick with
+    common decorations (trailing underscores, backticks, |away suffixes and such) removed. """
+    key = normalize_name(nick)
+    yield key
+    while True:
+        stripped = _NICK_DECORATION.sub('', key)
+        if not stripped or stripped == key:
+            return
+        key = stripped
+        yield key
+
+
+class MemberIndex():
+    """
+    An index of guild members by name and display name, so members can be found in O(1) instead of
+    scanning the whole member list. Keep it up to date by calling add/update/remove from the member events.
+    Names are case-insensitive. If several members share a name, names take precedence over display names.
+    """
+
+    def __init__(self):
+        self._guilds = {}  #guild id -> {name key: {member id: member}}
+
+    def rebuild(self, guild):
+        """ (Re)builds the index for the whole guild. """
+        self._guilds[guild.id] = {}
+        for member in guild.members:
+            self.add(member)
+
+    def forget_guild(self, guild):
+        """ Drops the index of the given guild. """
+        self._guilds.pop(guild.id, None)
+
+    def add(self, member):
+        """ Adds a member to the index. """
+        names = self._guilds.setdefault(member.guild.id, {})
+        for key in {normalize_name(member.name), normalize_name(member.display_name)}:
+            names.setdefault(key, {})[member.id] = member
+
+    def remove(self, member):
+        """ Removes a member from the index. """
+        names = self._guilds.get(member.guild.id)
+        if names is None:
+            return
+        for key in {normalize_name(member.name), normalize_name(member.display_name)}:
+            members = names.get(key)
+            if members is not None:
+                members.pop(member.id, None)
+                if not members:
+                    del names[key]
+
+    def update(self, before, after):
+        """ Updates a member whose name or nickname may have changed. """
+        self.remove(before)
+        self.add(after)
+
+    def find(self, guild, name):
+        """ Returns the member of the guild with the given name or display name, or None. """
+        names = self._guilds.get(guild.id)
+        if names is None:
+            return None
+        members = names.get(normalize_name(name))
+        if not members:
+            return None
+        if len(members) > 1:
+            #prefer an exact username match over a display name match
+            for member in members.values():
+                if normalize_name(member.name) == normalize_name(name):
+                    return member
+        return next(iter(members.values()))
+
+    def find_by_nick(self, guild, nick):
+        """ Like find(), but also tries common variations of the given IRC nick. """
+        names = self._guilds.get(guild.id)
+        if names is None:
+            return None
+        for key in nick_variations(nick):
+            if key in names:
+                return self.find(guild, key)
+        return None
+
+    def translate_highlight(self, guild, text):
+        """ Turns an IRC-style highlight at the start of text ("nick: hello") into a Discord mention
+        ("<@1234>: hello") if the nick belongs to a member of the guild. Returns the text. """
+        match = _HIGHLIGHT.match(text)
+        if match is None:
+            return text
+        #the nick may have had markdown escaped in it
+        member = self.find_by_nick(guild, match.group(1).replace('\\', ''))
+        if member is None:
+            return text
+        return member.mention + text[match.end(1):]
@@ -0,0 +1,206 @@
+""" Relaying of IRC membership events (joins, parts, quits and nick changes), with netsplits and floods of them summed
+up. """
+
+import re
+from collections import OrderedDict, namedtuple
+
+#a namedtuple holding the membership relay settings of a network
+#enabled turns relaying membership events on, window is how many seconds of events are put together in one notice per
+#channel, max_individual is how many events of a kind a notice spells out before it just counts them, rejoin_window is
+#how many seconds after a netsplit returning users are counted as rejoining, and max_tracked is how many split users
+#are remembered for that
+MembershipSettings = namedtuple('MembershipSettings',
+                                ['enabled', 'window', 'max_individual', 'rejoin_window', 'max_tracked'])
+DEFAULT_MEMBERSHIP_SETTINGS = MembershipSettings(enabled=False, window=5.0, max_individual=3, rejoin_window=900.0,
+                                                 max_tracked=10000)
+
+#the quit message of the users lost in a netsplit: the names of the two servers that split apart. Some networks hide
+#them as "*.net *.split". Quits the users write themselves are prefixed by the server (eg. "Quit: ..."), so they can't
+#pass for one.
+_NETSPLIT = re.compile(r'^([\w*-]+(?:\.[\w*-]+)+) ([\w*-]+(?:\.[\w*-]+)+)$')
+
+
+def membership_settings(*configs):
+    """ Builds a MembershipSettings from the given config dicts. Later dicts override earlier ones and missing values
+    are taken from the defaults. Dicts may be None. """
+    values = DEFAULT_MEMBERSHIP_SETTINGS._asdict()
+    for config in configs:
+        if config:
+            values.update((key, config[key]) for key in MembershipSettings._fields if key in config)
+    settings = MembershipSettings(**values)
+    if settings.window <= 0 or settings.max_individual < 0 or settings.rejoin_window < 0 or settings.max_tracked < 0:
+        raise ValueError(f"Invalid membership relay settings: {settings}")
+    return settings
+
+
+def netsplit_servers(message):
+    """ Returns the (server, server) that split apart if message is the quit message of a user lost in a netsplit,
+    otherwise None. """
+    match = _NETSPLIT.match(message or '')
+    return match.groups() if match else None
+
+
+def _users(count):
+    return f"{count} user{'' if count == 1 else 's'}"
+
+
+class _Burst():
+    """ The events of one kind on a channel during a window: how many there were and the first few of them. """
+
+    __slots__ = ('count', 'samples')
+
+    def __init__(self):
+        self.count = 0
+        self.samples = []  #(nick, detail) of the first max_individual events
+
+    def describe(self, kind, servers):
+        """ Returns the lines of a notice about the events. """
+        if kind in ('split', 'rejoin'):
+            who = ', '.join(nick for nick, _ in self.samples) if self.count == len(self.samples) else _users(self.count)
+            return [f"{who} {'split' if kind == 'split' else 'rejoined'}: {servers[0]} ↔ {servers[1]}"]
+        if self.count > len(self.samples):
+            verb = {'join': 'joined', 'part': 'left', 'quit': 'quit', 'nick': 'changed their nicks'}[kind]
+            return [f"{_users(self.count)} {verb}"]
+        lines = []
+        for nick, detail in self.samples:
+            if kind == 'join':
+                lines.append(f"{nick} joined")
+            elif kind == 'nick':
+                lines.append(f"{nick} is now known as {detail}")
+            else:
+                lines.append(f"{nick} {'left' if kind == 'part' else 'quit'}" + (f" ({detail})" if detail else ''))
+        return lines
+
+
+class _Window():
+    """ The events of a channel waiting to be relayed. """
+
+    __slots__ = ('name', 'bursts', 'call')
+
+    def __init__(self, name):
+        self.name = name
+        self.bursts = OrderedDict()  #(kind, servers) -> _Burst, in the order they started
+        self.call = None  #the delayed call to flush the window
+
+
+class MembershipRelay():
+    """
+    Collects the membership events of the channels we're on in an IRC network and passes them on as one notice per
+    channel per `window` seconds, by calling emit(channel, text). Up to `max_individual` events of a kind are spelled
+    out one per line, more are just counted, so that a flood of joins or parts costs one relayed message. Quits with a
+    netsplit quit message are grouped by the servers that split ("312 users split: hub.a ↔ hub.b"), and so are the
+    joins of split users that come back within `rejoin_window` seconds. Memory stays bounded however big a burst gets:
+    a burst is a count and its first few events, and at most `max_tracked` split users are remembered.
+    Nicks are compared after lowercasing them with lower, the network's irc_lower(). Must only be used from the reactor
+    thread.
+    """
+
+    def __init__(self, emit, lower, settings=DEFAULT_MEMBERSHIP_SETTINGS, clock=None):
+        if clock is None:
+            from twisted.internet import reactor
+            clock = reactor
+        self.settings = settings
+        self._emit = emit
+        self._lower = lower
+        self._clock = clock
+        self._windows = {}  #lowercased channel name -> _Window
+        #lowercased nick -> (servers, expiry time) of the users lost in netsplits, in the order they split
+        self._split = OrderedDict()
+
+    @property
+    def enabled(self):
+        """ True if membership events are relayed. """
+        return self.settings.enabled
+
+    def set_settings(self, settings):
+        """ Switches to new settings. Events collected so far are relayed right away if relaying was turned off. """
+        self.settings = settings
+        if not settings.enabled:
+            self.flush()
+            self._split.clear()
+
+    def joined(self, channel, nick):
+        """ Records that nick joined channel. """
+        if self.enabled:
+            servers = self._rejoined(nick)
+            if servers is not None:
+                self._add(channel, 'rejoin', servers, nick)
+            else:
+                self._add(channel, 'join', None, nick)
+
+    def parted(self, channel, nick, reason):
+        """ Records that nick left channel. """
+        if self.enabled:
+            self._add(channel, 'part', None, nick, reason)
+
+    def quit(self, channels, nick, message):
+        """ Records that nick, who was on channels, quit the network. """
+        if not self.enabled or not channels:
+            return
+        servers = netsplit_servers(message)
+        if servers is not None:
+            self._remember_split(nick, servers)
+            for channel in channels:
+                self._add(channel, 'split', servers, nick)
+        else:
+            for channel in channels:
+                self._add(channel, 'quit', None, nick, message)
+
+    def renamed(self, channels, old, new):
+        """ Records that old, who is on channels, is now known as new. """
+        if self.enabled:
+            for channel in channels:
+                self._add(channel, 'nick', None, old, new)
+
+    def flush(self):
+        """ Relays all the events collected so far. """
+        for key in list(self._windows):
+            self._flush(key)
+
+    def _add(self, channel, kind, servers, nick, detail=None):
+        key = self._lower(channel)
+        window = self._windows.get(key)
+        if window is None:
+            window = self._windows[key] = _Window(channel)
+            window.call = self._clock.callLater(self.settings.window, self._flush, key)
+        burst = window.bursts.get((kind, servers))
+        if burst is None:
+            burst = window.bursts[(kind, servers)] = _Burst()
+        burst.count += 1
+        if len(burst.samples) < self.settings.max_individual:
+            burst.samples.append((nick, detail))
+
+    def _flush(self, key):
+        window = self._windows.pop(key, None)
+        if window is None:
+            return
+        if window.call.active():
+            window.call.cancel()
+        lines = [line for (kind, servers), burst in window.bursts.items() for line in burst.describe(kind, servers)]
+        self._emit(window.name, '\n'.join(lines))
+
+    def _remember_split(self, nick, servers):
+        if self.settings.max_tracked == 0:
+            return
+        key = self._lower(nick)
+        self._split.pop(key, None)
+        while len(self._split) >= self.settings.max_tracked:
+            self._split.popitem(last=False)
+        self._split[key] = (servers, self._clock.seconds() + self.settings.rejoin_window)
+
+    def _rejoined(self, nick):
+        """ Returns the servers that split if nick is a split user coming back, otherwise None. """
+        now = self._clock.seconds()
+        while self._split:
+            _, (_, expiry) = next(iter(self._split.items()))
+            if expiry > now:
+                break
+            self._split.popitem(last=False)
+        key = self._lower(nick)
+        entry = self._split.get(key)
+        if entry is None or entry[1] <= now:
+            return None
+        servers, expiry = entry
+        #their joins to the rest of their channels come with the same burst, later ones are their own
+        self._split[key] = (servers, min(expiry, now + self.settings.window))
+        return servers
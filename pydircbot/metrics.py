@@ -0,0 +1,308 @@
+""" Counters, gauges and latency histograms, exposed in the Prometheus text format over HTTP. """
+
+import logging
+import threading
+import time
+
+#upper bounds of the default histogram buckets, in seconds
+DEFAULT_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labelnames, labelvalues, extra=None):
+    pairs = list(zip(labelnames, labelvalues))
+    if extra is not None:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class _Metric():
+    """ The common parts of all metrics. Values are kept per combination of label values.
+    Metrics may be updated from any thread. """
+
+    metric_type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}  #tuple of label values -> value
+
+    def _key(self, labels):
+        if len(labels) != len(self.labelnames):
+            raise ValueError(f"{self.name} expects the labels {self.labelnames}, got {tuple(labels)}.")
+        return tuple(labels[name] for name in self.labelnames)
+
+    def _samples(self):
+        """ Yields (suffix, label string, value) for every sample of this metric. """
+        raise NotImplementedError
+
+    def render(self):
+        """ Returns the metric in the Prometheus text format. """
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.metric_type}']
+        for suffix, labels, value in self._samples():
+            lines.append(f'{self.name}{suffix}{labels} {_format_value(value)}')
+        return '\n'.join(lines)
+
+
+class Counter(_Metric):
+    """ A value that only goes up. """
+
+    metric_type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        """ Increments the counter for the given labels. """
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        """ Returns the current value for the given labels. """
+        return self._values.get(self._key(labels), 0)
+
+    def _samples(self):
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in values:
+            yield '', _format_labels(self.labelnames, key), value
+
+
+class Gauge(_Metric):
+    """
+    A value that can go up and down. Instead of setting the values, a callback that returns
+    {tuple of label values: value} may be given, in which case it's called whenever the metric is rendered.
+    """
+
+    metric_type = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), callback=None):
+        super().__init__(name, documentation, labelnames)
+        self.callback = callback
+
+    def set(self, value, **labels):
+        """ Sets the gauge for the given labels. """
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        """ Increments the gauge for the given labels. """
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        """ Decrements the gauge for the given labels. """
+        self.inc(-amount, **labels)
+
+    def _samples(self):
+        if self.callback is not None:
+            try:
+                values = list(self.callback().items())
+            except Exception:  #pylint:disable=broad-except
+                logging.exception('Failed to collect the values of %s.', self.name)
+                values = []
+        else:
+            with self._lock:
+                values = list(self._values.items())
+        for key, value in values:
+            yield '', _format_labels(self.labelnames, key), value
+
+
+class Histogram(_Metric):
+    """ Counts observations (usually durations in seconds) into buckets. """
+
+    metric_type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'), )
+
+    def observe(self, value, **labels):
+        """ Records an observation for the given labels. """
+        key = self._key(labels)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                #one count per bucket, then the sum and the total count
+                counts = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            counts[-2] += value
+            counts[-1] += 1
+
+    def time(self, **labels):
+        """ Returns a context manager that observes how long its block took. """
+        return _Timer(self, labels)
+
+    def _samples(self):
+        with self._lock:
+            values = [(key, list(counts)) for key, counts in self._values.items()]
+        for key, counts in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                yield '_bucket', _format_labels(self.labelnames, key, ('le', _format_value(float(bound)))), cumulative
+            yield '_sum', _format_labels(self.labelnames, key), counts[-2]
+            yield '_count', _format_labels(self.labelnames, key), counts[-1]
+
+
+class _Timer():
+    """ Context manager returned by Histogram.time(). """
+
+    def __init__(self, histogram, labels):
+        self._histogram = histogram
+        self._labels = labels
+        self._start = None
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._histogram.observe(time.perf_counter() - self._start, **self._labels)
+
+
+class Registry():
+    """ A collection of metrics that are rendered together. """
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        """ Adds a metric to the registry and returns it. """
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        """ Returns all the metrics in the Prometheus text format. """
+        return '\n'.join(metric.render() for metric in self._metrics) + '\n'
+
+
+def listen(host, port, registry=None):
+    """ Starts serving the metrics over HTTP on the given address. Returns the listening port. """
+    #twisted.web is slow to import, so it's only imported if the metrics are served
+    from twisted.internet import reactor
+    from twisted.web import resource, server
+
+    class MetricsResource(resource.Resource):
+        """ A Twisted web resource that serves a registry in the Prometheus text format. """
+
+        isLeaf = True
+
+        def __init__(self, registry):
+            super().__init__()
+            self._registry = registry
+
+        def render_GET(self, request):  #pylint:disable=invalid-name
+            """ Renders the metrics. """
+            request.setHeader(b'Content-Type', b'text/plain; version=0.0.4; charset=utf-8')
+            return self._registry.render().encode('utf-8')
+
+    site = server.Site(MetricsResource(registry if registry is not None else REGISTRY))
+    return reactor.listenTCP(port, site, interface=host)
+
+
+class RateLimitLogHandler(logging.Handler):
+    """
+    discord.py only tells about rate limits by logging them, so we count them by listening to its log records.
+    Records with a "Retrying in %.2f seconds" style message are counted as rate limit waits.
+    """
+
+    def emit(self, record):
+        if not isinstance(record.msg, str) or 'rate limit' not in record.msg:
+            return
+        for arg in record.args or ():
+            if isinstance(arg, float):
+                DISCORD_RATE_LIMIT_WAIT.observe(arg, logger=record.name)
+                break
+        DISCORD_RATE_LIMITS.inc(logger=record.name)
+
+
+def install_discord_rate_limit_handler():
+    """ Starts counting discord.py's rate limit waits. """
+    handler = RateLimitLogHandler(level=logging.WARNING)
+    for name in ('discord.http', 'discord.webhook'):
+        logging.getLogger(name).addHandler(handler)
+
+
+#############
+#The metrics#
+#############
+
+REGISTRY = Registry()
+
+MESSAGES_RECEIVED = REGISTRY.register(
+    Counter('pydircbot_messages_received_total', 'Messages received.', ('protocol', )))
+RECEIVE_SECONDS = REGISTRY.register(
+    Histogram('pydircbot_receive_seconds', 'Time spent handling an incoming message before handing it to the core.',
+              ('protocol', )))
+DISPATCH_DELAY_SECONDS = REGISTRY.register(
+    Histogram('pydircbot_dispatch_delay_seconds', 'Time from receiving a message until the core starts handling it.',
+              ('protocol', )))
+DISPATCH_SECONDS = REGISTRY.register(
+    Histogram('pydircbot_dispatch_seconds', 'Time spent in message_received (relaying and listeners).',
+              ('protocol', )))
+MESSAGES_RELAYED = REGISTRY.register(
+    Counter('pydircbot_messages_relayed_total', 'Messages relayed, per destination protocol.', ('protocol', )))
+RELAYS_DROPPED = REGISTRY.register(
+    Counter('pydircbot_relays_dropped_total', 'Relays dropped because the destination was unavailable.',
+            ('protocol', )))
+ECHOES_DROPPED = REGISTRY.register(
+    Counter('pydircbot_echoes_dropped_total', 'Messages not relayed because they were echoes or relay loops.',
+            ('reason', )))
+MESSAGES_FILTERED = REGISTRY.register(
+    Counter('pydircbot_messages_filtered_total', 'Messages matched by content filter rules, per action.',
+            ('action', )))
+SPOOL_MESSAGES = REGISTRY.register(
+    Counter('pydircbot_spool_messages_total', 'Relayed messages spooled, replayed, expired or dropped by the spools.',
+            ('outcome', )))
+IRC_SEND_DELAY_SECONDS = REGISTRY.register(
+    Histogram('pydircbot_irc_send_delay_seconds', 'Time IRC lines spend in the outbound queue.', ('network', )))
+IRC_LINES_SENT = REGISTRY.register(Counter('pydircbot_irc_lines_sent_total', 'IRC lines sent.', ('network', )))
+IRC_MESSAGES_OVERFLOWED = REGISTRY.register(
+    Counter('pydircbot_irc_messages_overflowed_total',
+            'Messages relayed to IRC that were too long for irc.split.max_lines, by what was done with them.',
+            ('network', 'action')))
+IRC_QUEUE_DEPTH = REGISTRY.register(
+    Gauge('pydircbot_irc_queue_depth', 'IRC lines waiting in the outbound queues.', ('network', 'target')))
+IRC_RECONNECTS = REGISTRY.register(
+    Counter('pydircbot_irc_reconnects_total', 'Lost or failed IRC connections, each followed by a reconnect attempt.',
+            ('network', )))
+SHARD_RESTARTS = REGISTRY.register(
+    Counter('pydircbot_shard_restarts_total', 'IRC shard worker processes that died and were restarted.', ('shard', )))
+DISCORD_SEND_SECONDS = REGISTRY.register(
+    Histogram('pydircbot_discord_send_seconds', 'HTTP round trip of sending a Discord message.', ('method', )))
+DISCORD_SEND_ERRORS = REGISTRY.register(
+    Counter('pydircbot_discord_send_errors_total', 'Failed Discord sends.', ('method', )))
+DISCORD_RATE_LIMITS = REGISTRY.register(
+    Counter('pydircbot_discord_rate_limits_total', 'Discord rate limit waits.', ('logger', )))
+DISCORD_RATE_LIMIT_WAIT = REGISTRY.register(
+    Histogram('pydircbot_discord_rate_limit_wait_seconds', 'How long Discord rate limits made us wait.', ('logger', ),
+              buckets=(.1, .25, .5, 1, 2.5, 5, 10, 30, 60)))
+DISCORD_WEBHOOK_WAIT_SECONDS = REGISTRY.register(
+    Histogram('pydircbot_discord_webhook_wait_seconds',
+              'How long posts through webhook pools waited for a webhook with requests left, per attempt.',
+              buckets=(.001, .01, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)))
+LISTENER_SECONDS = REGISTRY.register(
+    Histogram('pydircbot_listener_seconds', 'Time event listener calls took, including waiting for a worker.',
+              ('listener', )))
+LISTENER_ERRORS = REGISTRY.register(
+    Counter('pydircbot_listener_errors_total', 'Event listener calls that raised, timed out or were dropped.',
+            ('listener', 'kind')))
@@ -0,0 +1,285 @@
+""" Who is on the IRC channels we're on. """
+
+import re
+import sys
+
+from .members import nick_variations
+
+#a Discord-style @mention of an IRC nick in relayed text, eg. "@nick: hello"
+_MENTION = re.compile(r'(?<![\w@])@([A-Za-z0-9_\-\[\]\\`^{}|]+)')
+
+
+def _base(nick):
+    """ Returns the lookup key of a nick without its decorations (see members.nick_variations). """
+    *_, base = nick_variations(nick)
+    return base
+
+
+class _User():
+    """ A user we share a channel with. """
+
+    __slots__ = ('nick', 'channels')
+
+    def __init__(self, nick):
+        self.nick = nick
+        self.channels = set()  #lowercased names of the channels they're on
+
+
+class _Channel():
+    """ A channel we're on. """
+
+    __slots__ = ('name', 'members', 'ours', 'names')
+
+    def __init__(self, name):
+        self.name = name
+        self.members = {}  #lowercased nick -> their prefixes (eg. '@+'), highest first
+        self.ours = set()  #our connections that are on the channel
+        self.names = None  #members collected from a NAMES reply that hasn't ended yet
+
+
+class Roster():
+    """
+    The members of the channels we're on in an IRC network, kept up to date from the server's events and rebuilt from
+    NAMES whenever we join. Nicks are interned and kept once per network however many channels they're on, every
+    channel has a dict of its members, and every nick is also indexed without its decorations (nick_, nick|away...),
+    so finding out whether someone or we are on a channel takes constant time however big it is.
+    Names are compared after lowercasing them with lower, the network's irc_lower(). Several connections to the same
+    network can share a roster. Must only be used from the reactor thread.
+    """
+
+    def __init__(self, lower):
+        self._lower = lower
+        self._channels = {}  #lowercased channel name -> _Channel
+        self._users = {}  #lowercased nick -> _User
+        self._bases = {}  #nick without decorations -> set of lowercased nicks
+        self._prefixes = {'o': '@', 'v': '+'}  #prefix mode -> prefix
+        self._ranks = {'@': 0, '+': 1}  #prefix -> rank, 0 is the highest
+
+    def set_prefixes(self, prefixes):
+        """ Sets the channel membership prefixes of the network, as a dict of mode -> (prefix, rank), like Twisted's
+        parsing of the PREFIX ISUPPORT token. """
+        self._prefixes = {mode: prefix for mode, (prefix, _) in prefixes.items()}
+        self._ranks = {prefix: rank for prefix, rank in prefixes.values()}
+
+    def rekey(self):
+        """ Lowercases everything again, after the network's CASEMAPPING changed. """
+        channels, users = self._channels, self._users
+        self._channels, self._users, self._bases = {}, {}, {}
+        for channel in channels.values():
+            key = self._lower(channel.name)
+            self._channels[key] = channel
+            members, channel.members = channel.members, {}
+            for member, prefixes in members.items():
+                nick = users[member].nick
+                nick_key = self._lower(nick)
+                channel.members[nick_key] = prefixes
+                self._user(nick, nick_key).channels.add(key)
+
+    def _user(self, nick, key=None):
+        """ Returns the _User of nick, adding it if we didn't know them yet. """
+        if key is None:
+            key = self._lower(nick)
+        user = self._users.get(key)
+        if user is None:
+            user = self._users[key] = _User(sys.intern(nick))
+            self._bases.setdefault(_base(nick), set()).add(key)
+        return user
+
+    def _forget_if_gone(self, key):
+        user = self._users.get(key)
+        if user is not None and not user.channels:
+            del self._users[key]
+            base = _base(user.nick)
+            keys = self._bases.get(base)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._bases[base]
+
+    def _split_prefixes(self, entry):
+        """ Splits a NAMES entry into its prefixes (highest first) and nick. Handles multi-prefix and
+        userhost-in-names. """
+        position = 0
+        while position < len(entry) and entry[position] in self._ranks:
+            position += 1
+        prefixes = ''.join(sorted(entry[:position], key=self._ranks.get))
+        return prefixes, entry[position:].split('!', 1)[0]
+
+    #our own presence
+
+    def joined(self, channel, by):
+        """ Records that our connection by (eg. its factory) joined channel. """
+        key = self._lower(channel)
+        entry = self._channels.get(key)
+        if entry is None:
+            entry = self._channels[key] = _Channel(channel)
+        entry.ours.add(by)
+
+    def left(self, channel, by):
+        """ Records that our connection by left channel (parted, was kicked or disconnected). Returns True if none of
+        our connections are on it anymore. """
+        key = self._lower(channel)
+        entry = self._channels.get(key)
+        if entry is None:
+            return True
+        entry.ours.discard(by)
+        if entry.ours:
+            return False
+        del self._channels[key]
+        for member in entry.members:
+            user = self._users.get(member)
+            if user is not None:
+                user.channels.discard(key)
+                self._forget_if_gone(member)
+        return True
+
+    def left_all(self, by):
+        """ Records that our connection by left all its channels. Returns their names. """
+        channels = [entry.name for entry in self._channels.values() if by in entry.ours]
+        for channel in channels:
+            self.left(channel, by)
+        return channels
+
+    def is_on(self, channel):
+        """ True if any of our connections is on channel. """
+        return self._lower(channel) in self._channels
+
+    #NAMES
+
+    def names(self, channel, entries):
+        """ Collects the entries of a NAMES reply (RPL_NAMREPLY) for a channel we're on. """
+        entry = self._channels.get(self._lower(channel))
+        if entry is None:
+            return
+        if entry.names is None:
+            entry.names = {}
+        for name in entries:
+            prefixes, nick = self._split_prefixes(name)
+            if nick:
+                entry.names[nick] = prefixes
+
+    def end_of_names(self, channel):
+        """ Replaces the members of a channel with the ones collected since the last RPL_ENDOFNAMES. """
+        key = self._lower(channel)
+        entry = self._channels.get(key)
+        if entry is None or entry.names is None:
+            return
+        names, entry.names = entry.names, None
+        members, entry.members = entry.members, {}
+        for nick, prefixes in names.items():
+            nick_key = self._lower(nick)
+            self._user(nick, nick_key).channels.add(key)
+            entry.members[nick_key] = prefixes
+        for member in members:
+            if member not in entry.members:
+                self._users[member].channels.discard(key)
+                self._forget_if_gone(member)
+
+    #other people
+
+    def add(self, channel, nick, prefixes=''):
+        """ Records that nick joined a channel we're on. """
+        key = self._lower(channel)
+        entry = self._channels.get(key)
+        if entry is None:
+            return
+        nick_key = self._lower(nick)
+        self._user(nick, nick_key).channels.add(key)
+        entry.members[nick_key] = prefixes
+
+    def remove(self, channel, nick):
+        """ Records that nick left (or was kicked from) a channel we're on. """
+        key = self._lower(channel)
+        nick_key = self._lower(nick)
+        entry = self._channels.get(key)
+        if entry is not None:
+            entry.members.pop(nick_key, None)
+        user = self._users.get(nick_key)
+        if user is not None:
+            user.channels.discard(key)
+            self._forget_if_gone(nick_key)
+
+    def quit(self, nick):
+        """ Records that nick quit the network. Returns the names of the channels we saw them on. """
+        nick_key = self._lower(nick)
+        user = self._users.get(nick_key)
+        if user is None:
+            return []
+        channels = []
+        for key in user.channels:
+            entry = self._channels.get(key)
+            if entry is not None:
+                entry.members.pop(nick_key, None)
+                channels.append(entry.name)
+        user.channels.clear()
+        self._forget_if_gone(nick_key)
+        return channels
+
+    def rename(self, old, new):
+        """ Records a nick change. Returns the names of the channels we saw them on. """
+        old_key, new_key = self._lower(old), self._lower(new)
+        user = self._users.get(old_key)
+        if user is None:
+            return []
+        channel_keys = set(user.channels)
+        prefixes = {key: self._channels[key].members.pop(old_key, '') for key in channel_keys if key in self._channels}
+        user.channels.clear()
+        self._forget_if_gone(old_key)
+        renamed = self._user(new, new_key)
+        for key, member_prefixes in prefixes.items():
+            self._channels[key].members[new_key] = member_prefixes
+            renamed.channels.add(key)
+        return [self._channels[key].name for key in prefixes]
+
+    def set_mode(self, channel, mode, nick, on):
+        """ Applies a channel mode change. Only membership prefix modes (+o, +v...) matter to us. """
+        prefix = self._prefixes.get(mode)
+        entry = self._channels.get(self._lower(channel))
+        if prefix is None or entry is None:
+            return
+        nick_key = self._lower(nick)
+        prefixes = entry.members.get(nick_key)
+        if prefixes is None:
+            return
+        prefixes = prefixes.replace(prefix, '')
+        if on:
+            prefixes = ''.join(sorted(prefixes + prefix, key=self._ranks.get))
+        entry.members[nick_key] = prefixes
+
+    #lookups
+
+    def member_count(self, channel):
+        """ Returns how many members a channel we're on has. """
+        entry = self._channels.get(self._lower(channel))
+        return len(entry.members) if entry is not None else 0
+
+    def prefixes(self, channel, nick):
+        """ Returns the prefixes (eg. '@') of nick on channel, or None if they aren't on it. """
+        entry = self._channels.get(self._lower(channel))
+        if entry is None:
+            return None
+        return entry.members.get(self._lower(nick))
+
+    def find(self, channel, name):
+        """ Returns the nick of the member of channel called name, as the server spells it. Nicks with decorations
+        (name_, name|away...) are found too. Returns None if there's no such member. """
+        entry = self._channels.get(self._lower(channel))
+        if entry is None:
+            return None
+        key = self._lower(name)
+        if key in entry.members:
+            return self._users[key].nick
+        for key in self._bases.get(_base(name), ()):
+            if key in entry.members:
+                return self._users[key].nick
+        return None
+
+    def highlight(self, channel, text):
+        """ Turns @mentions of members of channel in text into their nicks, so IRC clients highlight them. """
+        if '@' not in text or self._lower(channel) not in self._channels:
+            return text
+
+        def replace(match):
+            return self.find(channel, match.group(1)) or match.group()
+
+        return _MENTION.sub(replace, text)
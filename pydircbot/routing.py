@@ -0,0 +1,328 @@
+""" The relay routing table. Compiles the channel mapping from the config into routes that know how to send. """
+
+import logging
+
+import discord
+
+from . import disc
+from . import eventloop
+from . import formatting
+from . import irc
+from . import metrics
+from .adapters import IMessage
+
+#after a send fails, sending to the destination is held off for this long, doubling with every failure in a row
+RETRY_DELAY = 1.0
+MAX_RETRY_DELAY = 60.0
+
+
+class _Route():
+    """ The spooling shared by the route types. Messages relayed while the destination is unavailable, or while
+    earlier messages are still spooled, go to the spool and are replayed once the destination is back. """
+
+    protocol = ''
+    message_protocol = None
+
+    def __init__(self, spool=None, loop=None, replay_interval=0.25):
+        self.spool = spool
+        self.replay_interval = replay_interval
+        self._loop = loop
+        self._failures = 0  #failed sends in a row that started a backoff
+        self._retry_at = 0.0  #loop time the backoff ends at
+        self._retry_handle = None
+
+    @property
+    def available(self):
+        """ True if messages can be sent to the destination right now. """
+        raise NotImplementedError
+
+    def relay(self, message):
+        """ Relays an IMessage to the destination. Returns True if the message was sent (or queued or spooled for
+        sending). Must be called from the core event loop's thread. """
+        return self.relay_text(message.simple_sender, message.message_as(self.message_protocol))
+
+    def relay_text(self, sender, text):
+        """ Relays text already formatted for the destination's protocol as sent by sender. Otherwise the same as
+        relay(). """
+        if self.spool is not None and (self.spool or self.spool.replaying or not self.available):
+            if not self.spool.append([sender, text]):
+                metrics.RELAYS_DROPPED.inc(protocol=self.protocol)
+                return False
+            self.replay()
+            return True
+        if not self.available:
+            logging.warning('%s is not available, dropping relayed message.', self)
+            metrics.RELAYS_DROPPED.inc(protocol=self.protocol)
+            return False
+        self.send(sender, text)
+        metrics.MESSAGES_RELAYED.inc(protocol=self.protocol)
+        return True
+
+    def send(self, sender, text):
+        """ Sends text formatted for the destination's protocol as sent by sender. """
+        raise NotImplementedError
+
+    @property
+    def backing_off(self):
+        """ True while sending is held off after a failed send. """
+        return self._retry_at > 0 and self._loop.time() < self._retry_at
+
+    def respool(self, sender, text):
+        """ Puts a message whose sending failed back at the head of the spool, so it's sent again before anything
+        relayed after it, and holds off sending to the destination for a while. Thread-safe. """
+        if self.spool is not None:
+            self._loop.call_soon_threadsafe(self._requeue, [sender, text])
+        else:
+            metrics.RELAYS_DROPPED.inc(protocol=self.protocol)
+
+    def _requeue(self, record):
+        self.spool.requeue(record)
+        if self.backing_off:
+            #a message sent before the backoff started, failing for the same reason
+            return
+        self._failures += 1
+        delay = min(MAX_RETRY_DELAY, RETRY_DELAY * 2 ** (self._failures - 1))
+        logging.warning('Holding off sending to %s for %.0f seconds.', self, delay)
+        self._retry_at = self._loop.time() + delay
+        self._retry_handle = self._loop.call_later(delay, self._retry)
+
+    def _retry(self):
+        self._retry_handle = None
+        self._retry_at = 0.0
+        self._start_replay()
+
+    def recovered(self):
+        """ Ends the backoff, as the destination can be reached again. Thread-safe. """
+        if self._failures and self._loop is not None:
+            self._loop.call_soon_threadsafe(self._end_backoff)
+
+    def _end_backoff(self):
+        self._failures = 0
+        self._retry_at = 0.0
+        if self._retry_handle is not None:
+            self._retry_handle.cancel()
+            self._retry_handle = None
+        self._start_replay()
+
+    def replay(self):
+        """ Starts replaying the spool if there's anything in it and the destination is available. Thread-safe. """
+        if self.spool is not None and self._loop is not None:
+            self._loop.call_soon_threadsafe(self._start_replay)
+
+    def _start_replay(self):
+        if self.spool and not self.spool.replaying and self.available:
+            self._loop.create_task(self.spool.replay(self._send_record, self.replay_interval, lambda: self.available))
+
+    def _send_record(self, record):
+        sender, text = record
+        self.send(sender, text)
+        metrics.MESSAGES_RELAYED.inc(protocol=self.protocol)
+
+
+class DiscordRoute(_Route):
+    """ A route to a Discord channel. Holds the resolved channel and webhook once bound. """
+
+    protocol = 'discord'
+    message_protocol = IMessage.Protocol.DISCORD
+
+    def __init__(self, channel_id, **kwargs):
+        super().__init__(**kwargs)
+        self.channel_id = channel_id
+        self.channel = None
+        self.webhook = None
+        self._discordbot = None
+
+    def __str__(self):
+        return f"Discord channel {self.channel_id}"
+
+    @property
+    def target(self):
+        """ The target of this route in the format send_message() understands. """
+        return self.channel_id
+
+    @property
+    def available(self):
+        return (self._discordbot is not None and not self._discordbot.is_closed() and not self.backing_off
+                and (self.webhook is not None or isinstance(self.channel, discord.TextChannel)))
+
+    def bind(self, discordbot):
+        """ Resolves the channel and webhook of this route. Call again whenever they may have changed. """
+        self._discordbot = discordbot
+        self.channel = discordbot.get_channel(self.channel_id)
+        self.webhook = discordbot.webhooks_by_channel.get(self.channel_id)
+        #(re)connecting ends any backoff, replaying right away
+        self.recovered()
+        self.replay()
+
+    def send(self, sender, text):
+        if self.webhook is not None:
+            #there's a webhook so we'll use that for nicer formatting
+            coro = self._discordbot.relay_text(self.channel_id, sender, text, self.webhook, self.channel)
+        else:
+            #there's no webhook, fall back to regular message
+            coro = self._send_to_channel(self.channel, sender, text)
+        eventloop.submit(coro, self._discordbot.loop)
+
+    async def _send_to_channel(self, channel, sender, text):
+        content = self._discordbot.members.translate_highlight(channel.guild, text)
+        try:
+            await self._discordbot.send_to_channel(channel, f"**<{formatting.escape_markdown(sender)}>** {content}")
+        except disc.RETRYABLE_ERRORS as ex:
+            logging.warning('Sending to %s failed (%s), spooling the message.', self, ex.__class__.__name__)
+            self.respool(sender, text)
+        else:
+            self.recovered()
+
+
+class IRCRoute(_Route):
+    """ A route to an IRC channel. Holds the factory of the network's connection (or the shard.RemoteNetwork in sharded
+    mode) once bound. """
+
+    protocol = 'irc'
+    message_protocol = IMessage.Protocol.IRC
+
+    def __init__(self, network, channel, **kwargs):
+        super().__init__(**kwargs)
+        self.network = network
+        self.channel = channel
+        self.factory = None
+
+    def __str__(self):
+        return f"IRC channel {self.channel} on {self.network}"
+
+    @property
+    def target(self):
+        """ The target of this route in the format send_message() understands. """
+        return (self.network, self.channel)
+
+    @property
+    def available(self):
+        #without a spool the outbound queue keeps the messages while we're disconnected
+        return self.factory is not None and (self.spool is None or self.factory.connected)
+
+    def bind(self, factory):
+        """ Binds the route to the connection of its network, or unbinds it if factory is None. """
+        self.factory = factory
+        if factory is None:
+            return
+        #don't outpace the flood control, or replayed messages would just pile up in the outbound queue
+        self.replay_interval = max(self.replay_interval, 1 / factory.flood_settings.rate)
+        self.replay()
+
+    def send(self, sender, text):
+        #the sender goes on every line in case the message takes several
+        self.factory.send(self.channel, text, prefix=f"<{sender}> ")
+
+
+class RoutingTable():
+    """
+    Maps message sources to the routes their messages are relayed to.
+    IRC channels are keyed by (network, channel) with the channel name normalized according to the network's
+    CASEMAPPING, so #Foo and #foo are the same source. Discord channels are keyed by their id.
+    """
+
+    def __init__(self, channel_mapping, spooler=None, loop=None):
+        """ channel_mapping is the channel_mapping list from the config. If spooler (a spool.Spooler) is given,
+        every route gets a spool, which must be used from loop. """
+        self._spooler = spooler
+        self._loop = loop
+        self._casemappings = {}  #network -> CASEMAPPING, networks not in here use the RFC 1459 default
+        self.discord_routes = {}  #channel id -> DiscordRoute
+        self.irc_routes = {}  #(network, channel as configured) -> IRCRoute
+        self._links = []  #(IRCRoute, DiscordRoute) for each mapping
+        self._routes = {}
+        self.update(channel_mapping)
+
+    def update(self, channel_mapping):
+        """ Replaces the channel mapping. Routes in both the old and the new mapping are kept as they are, bound and
+        with their spools, while new ones must be bound by the caller. Returns (added routes, removed routes). """
+        irc_routes = {}
+        discord_routes = {}
+        links = []
+        for mapping in channel_mapping:
+            network, channel = mapping['irc_network'], mapping['irc_channel']
+            discord_id = mapping['discord_channel']
+            irc_route = irc_routes.get((network, channel)) or self.irc_routes.get((network, channel))
+            if irc_route is None:
+                irc_route = IRCRoute(network, channel, **self._spool_args(f"irc-{network}-{channel}"))
+            irc_routes[(network, channel)] = irc_route
+            discord_route = discord_routes.get(discord_id) or self.discord_routes.get(discord_id)
+            if discord_route is None:
+                discord_route = DiscordRoute(discord_id, **self._spool_args(f"discord-{discord_id}"))
+            discord_routes[discord_id] = discord_route
+            links.append((irc_route, discord_route))
+        old = set(self.irc_routes.values()) | set(self.discord_routes.values())
+        new = set(irc_routes.values()) | set(discord_routes.values())
+        self.irc_routes, self.discord_routes, self._links = irc_routes, discord_routes, links
+        self._compile()
+        return new - old, old - new
+
+    def _spool_args(self, name):
+        if self._spooler is None:
+            return {}
+        return {
+            'spool': self._spooler.spool(name),
+            'loop': self._loop,
+            'replay_interval': self._spooler.replay_interval
+        }
+
+    def _compile(self):
+        routes = {}
+        for irc_route, discord_route in self._links:
+            irc_key = self.irc_key(irc_route.network, irc_route.channel)
+            irc_recipients = routes.setdefault(irc_key, [])
+            if discord_route not in irc_recipients:
+                irc_recipients.append(discord_route)
+            discord_recipients = routes.setdefault(discord_route.channel_id, [])
+            if irc_route not in discord_recipients:
+                discord_recipients.append(irc_route)
+        #swap the whole table at once so readers on other threads never see a half-built one
+        self._routes = {key: tuple(recipients) for key, recipients in routes.items()}
+
+    def irc_key(self, network, channel):
+        """ Returns the routing key of the given IRC channel. """
+        return (network, irc.irc_lower(channel, self._casemappings.get(network, irc.DEFAULT_CASEMAPPING)))
+
+    def set_casemapping(self, network, casemapping):
+        """ Sets the CASEMAPPING used for the channel names of the given network. """
+        if self._casemappings.get(network, irc.DEFAULT_CASEMAPPING) != casemapping:
+            self._casemappings[network] = casemapping
+            self._compile()
+
+    def routes(self, key):
+        """ Returns the routes for the given routing key (see IMessage.route_key). """
+        return self._routes.get(key, ())
+
+    def key_for_target(self, target):
+        """ Returns the routing key of a target in any of the formats send_message() supports. """
+        if isinstance(target, discord.abc.GuildChannel):
+            return target.id
+        if isinstance(target, tuple):
+            return self.irc_key(*target)
+        return target
+
+    def routes_for_target(self, target):
+        """ Returns the routes for a target in any of the formats send_message() supports. """
+        return self.routes(self.key_for_target(target))
+
+    def bridged_keys(self, key):
+        """ Returns the routing keys of the channels bridged with the channel with the given key,
+        including the key itself. """
+        keys = [key]
+        for route in self.routes(key):
+            if isinstance(route, IRCRoute):
+                keys.append(self.irc_key(route.network, route.channel))
+            else:
+                keys.append(route.channel_id)
+        return keys
+
+    def bind_discord(self, discordbot):
+        """ (Re)binds all the Discord routes. """
+        for route in self.discord_routes.values():
+            route.bind(discordbot)
+
+    def bind_irc(self, network, factory):
+        """ (Re)binds the routes of an IRC network to the given factory, or unbinds them if factory is None. """
+        for route in self.irc_routes.values():
+            if route.network == network:
+                route.bind(factory)
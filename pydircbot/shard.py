@@ -0,0 +1,394 @@
+"""
+Sharded mode: the IRC networks are split between worker processes, each running its own Twisted reactor, while the
+main process (the hub) runs the Discord side and the routing.
+
+Workers and the hub talk over a Unix socket in frames of a 4-byte payload length and a 1-byte frame type, followed by
+the payload: a sequence of UTF-8 strings, each prefixed with its 4-byte length.
+
+This module is imported by the worker processes before they install their reactor, so it must not import anything
+that imports the Twisted reactor (like pydircbot.irc) at module level.
+"""
+
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+import struct
+import time
+from collections import deque
+
+from . import eventloop
+from . import metrics
+
+#frame types
+HELLO = 1  #worker -> hub: shard number
+MESSAGE = 2  #worker -> hub: network, channel, sender (nick!user@host), text
+SIGNED_ON = 3  #worker -> hub: network, our nickname
+DISCONNECTED = 4  #worker -> hub: network
+CASEMAPPING = 5  #worker -> hub: network, casemapping
+SEND = 6  #hub -> worker: network, target, text, prefix of each line
+MEMBERSHIP = 7  #worker -> hub: network, channel, notice of the membership events on the channel
+
+_HEADER = struct.Struct('!IB')
+_FIELD = struct.Struct('!I')
+#frames bigger than this are taken to mean the stream is corrupt
+MAX_FRAME_SIZE = 1024 * 1024
+
+
+def encode_frame(kind, *fields):
+    """ Encodes a frame of the given type with the given string fields. """
+    parts = []
+    for field in fields:
+        data = field.encode('utf-8')
+        parts.append(_FIELD.pack(len(data)))
+        parts.append(data)
+    payload = b''.join(parts)
+    return _HEADER.pack(len(payload), kind) + payload
+
+
+def decode_fields(payload):
+    """ Decodes the string fields of a frame's payload. """
+    fields = []
+    offset = 0
+    while offset < len(payload):
+        (length, ) = _FIELD.unpack_from(payload, offset)
+        offset += _FIELD.size
+        fields.append(payload[offset:offset + length].decode('utf-8'))
+        offset += length
+    return fields
+
+
+async def read_frame(reader):
+    """ Reads a frame from an asyncio StreamReader. Returns (frame type, fields). """
+    length, kind = _HEADER.unpack(await reader.readexactly(_HEADER.size))
+    if length > MAX_FRAME_SIZE:
+        raise ValueError(f"Frame of {length} bytes is too big.")
+    return kind, decode_fields(await reader.readexactly(length))
+
+
+def assign_shards(servers, shard_count):
+    """ Splits the IRC servers between the shards. Returns a list of {server: server config} per shard. """
+    shards = [{} for _ in range(shard_count)]
+    for index, server in enumerate(sorted(servers)):
+        shards[index % shard_count][server] = servers[server]
+    return shards
+
+
+#########
+#Workers#
+#########
+
+
+def run_worker(socket_path, shard, irc_config, servers, log_level, shutdown_timeout):
+    """ The entry point of a worker process. Connects to the hub at socket_path and then to the given servers.
+    On SIGTERM the worker gets shutdown_timeout seconds to send what it has queued and quit. """
+    logging.basicConfig(level=log_level, format=f"[shard {shard}] %(levelname)s:%(name)s:%(message)s")
+    #the hub decides when we stop, so leave Ctrl-C to it
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    loop = eventloop.install(single_loop=True)
+    from twisted.internet import reactor
+    worker = _Worker(loop, shard, irc_config, servers, shutdown_timeout)
+    loop.add_signal_handler(signal.SIGTERM, worker.quit)
+    loop.create_task(worker.run(socket_path))
+    reactor.run(installSignalHandlers=False)
+
+
+class _Worker():
+    """ Runs the IRC connections of one shard and acts as their adapter, passing everything on to the hub. """
+
+    def __init__(self, loop, shard, irc_config, servers, shutdown_timeout=5.0):
+        self.loop = loop
+        self.shard = shard
+        self.irc_config = irc_config
+        self.servers = servers
+        self.shutdown_timeout = shutdown_timeout
+        self.networks = {}
+        self._writer = None
+        self._quitting = False
+
+    async def run(self, socket_path):
+        """ Connects to the hub and the IRC servers, and handles frames from the hub until it goes away. """
+        from twisted.internet import reactor
+        from . import irc
+        try:
+            reader, self._writer = await asyncio.open_unix_connection(socket_path)
+        except OSError as ex:
+            logging.error('Failed to connect to the hub: %s', ex)
+            reactor.stop()
+            return
+        self._send(HELLO, str(self.shard))
+        for server, server_info in self.servers.items():
+            network = irc.make_network(self.irc_config, server, server_info, self)
+            network.connect(server_info['host'], server_info['port'])
+            self.networks[server] = network
+        try:
+            while True:
+                kind, fields = await read_frame(reader)
+                if kind == SEND:
+                    network, target, text, prefix = fields
+                    if network in self.networks:
+                        self.networks[network].send(target, text, prefix)
+                else:
+                    logging.warning('Unknown frame type %d from the hub.', kind)
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError) as ex:
+            logging.info('Lost the connection to the hub (%s), quitting.', ex.__class__.__name__)
+        self.quit()
+
+    def quit(self):
+        """ Sends what's queued, quits from all the networks and stops the worker. """
+        if not self._quitting:
+            self._quitting = True
+            self.loop.create_task(self._shutdown())
+
+    async def _shutdown(self):
+        from twisted.internet import reactor
+        from . import irc
+        quit_timeout = min(1.0, self.shutdown_timeout / 4)
+        dropped = await irc.shutdown(list(self.networks.values()), self.irc_config.get('quitmessage', ''),
+                                     self.shutdown_timeout - quit_timeout, quit_timeout)
+        for network, lines in dropped.items():
+            logging.warning('Dropped %d unsent lines to %s on shutdown.', lines, network)
+        reactor.stop()
+
+    def _send(self, kind, *fields):
+        if self._writer is not None and not self._writer.is_closing():
+            self._writer.write(encode_frame(kind, *fields))
+
+    #adapter methods called by the IRC bots
+    async def message_received(self, message):
+        """ Passes a message on to the hub. """
+        self._send(MESSAGE, message.network, message.channel, message.sender, message.content)
+
+    def irc_signed_on(self, network, factory):
+        """ Tells the hub we've signed on to a network. """
+        self._send(SIGNED_ON, network, factory.bot.nickname)
+
+    def irc_disconnected(self, network):
+        """ Tells the hub we've lost a network. """
+        self._send(DISCONNECTED, network)
+
+    def irc_casemapping_changed(self, network, casemapping):
+        """ Tells the hub which CASEMAPPING a network uses. """
+        self._send(CASEMAPPING, network, casemapping)
+
+    def irc_membership(self, network, channel, text):
+        """ Passes the membership events of a channel on to the hub. """
+        self._send(MEMBERSHIP, network, channel, text)
+
+
+#####
+#Hub#
+#####
+
+
+class RemoteNetwork():
+    """
+    An IRC network whose connection lives in a worker process. Stands in for the network's IRCBotFactory for the
+    routes and send_message(), and for its IRCBot in the IRCMessages received from it.
+    """
+
+    def __init__(self, hub, shard, network_name, nickname, flood_settings):
+        from . import irc
+        self._hub = hub
+        self._irc_lower = irc.irc_lower
+        self.shard = shard
+        self.network_name = network_name
+        self.nickname = nickname
+        self.flood_settings = flood_settings
+        self.casemapping = irc.DEFAULT_CASEMAPPING
+        self.connected = False
+
+    @property
+    def factory(self):
+        """ IRCMessage sends its replies through its bot's factory, which is us. """
+        return self
+
+    def irc_lower(self, name):
+        """ Lowercases a nick or channel name according to the network's CASEMAPPING. """
+        return self._irc_lower(name, self.casemapping)
+
+    def send(self, target, message, prefix=''):
+        """ Queues a message to target for sending, with prefix at the start of each line. Thread-safe. """
+        self._hub.send(self.shard, SEND, self.network_name, target, message, prefix)
+
+
+class ShardHub():
+    """
+    Starts and supervises the worker processes and relays between them and the adapter (the PyDIRCBot).
+    A worker that dies is restarted, with a growing delay if it keeps dying; the other workers and their connections
+    aren't affected. Frames to a worker that is down are kept (up to `max_pending`) until it's back.
+    Must be used from the core event loop's thread, except for send().
+    """
+
+    #how long we wait on shutdown for the workers to take what we've written to them, and how much of the shutdown
+    #timeout is left for a worker to exit after it has quit from its networks
+    EXIT_SLACK = 1.0
+
+    def __init__(self, loop, irc_config, shard_count, socket_path, adapter, max_pending=1000, shutdown_timeout=10.0):
+        from . import flood
+        self.loop = loop
+        self.irc_config = irc_config
+        self.socket_path = socket_path
+        self.shutdown_timeout = shutdown_timeout
+        self._adapter = adapter
+        self._assignments = assign_shards(irc_config['servers'], shard_count)
+        self.networks = {}  #network name -> RemoteNetwork
+        for shard, servers in enumerate(self._assignments):
+            for server, server_info in servers.items():
+                settings = flood.flood_settings(irc_config.get('flood'), server_info.get('flood'))
+                self.networks[server] = RemoteNetwork(self, shard, server, irc_config['nick'], settings)
+        self._processes = {}  #shard -> multiprocessing.Process, or None while waiting to restart
+        self._writers = {}  #shard -> StreamWriter of its connection
+        self._pending = {shard: deque(maxlen=max_pending) for shard in range(shard_count)}
+        self._restarts = {shard: 0 for shard in range(shard_count)}
+        self._started = {}  #shard -> time.monotonic() the process was started
+        self._server = None
+        self._supervisor = None
+        self._stopping = False
+
+    async def start(self):
+        """ Starts listening for the workers and starts them. """
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        self._server = await asyncio.start_unix_server(self._handle_worker, path=self.socket_path)
+        for shard in range(len(self._assignments)):
+            self._spawn(shard)
+        self._supervisor = self.loop.call_later(1, self._supervise)
+
+    def _spawn(self, shard):
+        if self._stopping:
+            return
+        #the plain config dicts are passed instead of the YAML ones so they pickle cleanly
+        irc_config = {key: value for key, value in self.irc_config.items() if key != 'servers'}
+        servers = {server: dict(info) for server, info in self._assignments[shard].items()}
+        process = multiprocessing.get_context('spawn').Process(target=run_worker,
+                                                               args=(self.socket_path, shard, irc_config, servers,
+                                                                     logging.getLogger().level,
+                                                                     max(0.5, self.shutdown_timeout - 2 * self.EXIT_SLACK)),
+                                                               name=f"irc-shard-{shard}",
+                                                               daemon=True)
+        process.start()
+        self._processes[shard] = process
+        self._started[shard] = time.monotonic()
+        logging.info('Started IRC shard %d (pid %d) for %s.', shard, process.pid, ', '.join(servers))
+
+    def _supervise(self):
+        for shard, process in self._processes.items():
+            if process is None or process.is_alive():
+                continue
+            logging.error('IRC shard %d died with exit code %s.', shard, process.exitcode)
+            metrics.SHARD_RESTARTS.inc(shard=str(shard))
+            self._shard_down(shard)
+            #a shard that keeps dying right away gets restarted less and less often
+            if time.monotonic() - self._started[shard] > 60:
+                self._restarts[shard] = 0
+            delay = min(60, 2**self._restarts[shard] - 1)
+            self._restarts[shard] += 1
+            self._processes[shard] = None
+            self.loop.call_later(delay, self._spawn, shard)
+        self._supervisor = self.loop.call_later(1, self._supervise)
+
+    def _shard_down(self, shard):
+        self._writers.pop(shard, None)
+        for network in self.networks.values():
+            if network.shard == shard and network.connected:
+                network.connected = False
+                self._adapter.irc_disconnected(network.network_name)
+
+    async def _handle_worker(self, reader, writer):
+        try:
+            kind, fields = await read_frame(reader)
+            if kind != HELLO:
+                raise ValueError(f"Expected HELLO, got frame type {kind}.")
+            shard = int(fields[0])
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError, IndexError) as ex:
+            logging.error('Bad handshake from an IRC shard: %s', ex)
+            writer.close()
+            return
+        self._writers[shard] = writer
+        pending = self._pending[shard]
+        while pending:
+            writer.write(pending.popleft())
+        try:
+            while True:
+                kind, fields = await read_frame(reader)
+                await self._handle_frame(kind, fields)
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError) as ex:
+            if not self._stopping:
+                logging.warning('Lost the connection to IRC shard %d (%s).', shard, ex.__class__.__name__)
+        if self._writers.get(shard) is writer:
+            self._shard_down(shard)
+        writer.close()
+
+    async def _handle_frame(self, kind, fields):
+        from . import irc
+        network = self.networks.get(fields[0]) if fields else None
+        if network is None:
+            logging.warning('Frame type %d for an unknown network from an IRC shard.', kind)
+        elif kind == MESSAGE:
+            _, channel, sender, text = fields
+            metrics.MESSAGES_RECEIVED.inc(protocol='irc')
+            await self._adapter.message_received(irc.IRCMessage(network, sender, channel, text))
+        elif kind == SIGNED_ON:
+            network.nickname = fields[1]
+            network.connected = True
+            self._adapter.irc_signed_on(network.network_name, network)
+        elif kind == DISCONNECTED:
+            network.connected = False
+            self._adapter.irc_disconnected(network.network_name)
+        elif kind == CASEMAPPING:
+            network.casemapping = fields[1]
+            self._adapter.irc_casemapping_changed(network.network_name, network.casemapping)
+        elif kind == MEMBERSHIP:
+            self._adapter.irc_membership(network.network_name, fields[1], fields[2])
+        else:
+            logging.warning('Unknown frame type %d from an IRC shard.', kind)
+
+    def send(self, shard, kind, *fields):
+        """ Sends a frame to a shard, or keeps it until the shard is back if it's down. Thread-safe. """
+        eventloop.call_in_loop(self.loop, self._write, shard, encode_frame(kind, *fields))
+
+    def _write(self, shard, frame):
+        writer = self._writers.get(shard)
+        if writer is None or writer.is_closing():
+            pending = self._pending[shard]
+            if len(pending) == pending.maxlen:
+                logging.warning('IRC shard %d is down and its queue is full, dropping the oldest message.', shard)
+            pending.append(frame)
+        else:
+            writer.write(frame)
+
+    async def stop(self, deadline=None):
+        """ Stops the workers, giving them until deadline (a time of the loop, shutdown_timeout seconds from now by
+        default) to send what they have queued and quit from their networks. The ones still running then are killed,
+        and so are all of them if stopping is cancelled. Returns the number of frames that were waiting for a worker
+        that was down. """
+        if deadline is None:
+            deadline = self.loop.time() + self.shutdown_timeout
+        self._stopping = True
+        if self._supervisor is not None:
+            self._supervisor.cancel()
+        processes = [process for process in self._processes.values() if process is not None]
+        try:
+            #hand the workers what we've written to them before telling them to stop
+            writers = [writer.drain() for writer in self._writers.values() if not writer.is_closing()]
+            if writers:
+                await asyncio.wait([asyncio.ensure_future(writer) for writer in writers],
+                                   timeout=max(0.0, min(self.EXIT_SLACK, deadline - self.loop.time())))
+            for process in processes:
+                if process.is_alive():
+                    process.terminate()
+            while any(process.is_alive() for process in processes) and self.loop.time() < deadline:
+                await asyncio.sleep(0.05)
+        finally:
+            for process in processes:
+                if process.is_alive():
+                    logging.warning('IRC shard %s did not stop in time, killing it.', process.name)
+                    process.kill()
+                    process.join(0.1)
+            if self._server is not None:
+                self._server.close()
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+        return sum(len(pending) for pending in self._pending.values())
@@ -0,0 +1,194 @@
+""" Durable outbound spools that hold relayed messages while their destination is unavailable. """
+
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import deque
+from urllib.parse import quote
+
+from . import metrics
+
+
+class Spool():
+    """
+    Holds the messages for one destination until they can be sent.
+
+    Up to `max_memory` messages are kept in memory. Once that fills up, further messages are appended to a log file
+    (if the spool has a path) until the spool has been drained, so the order is always memory first, then the log.
+    Messages older than `ttl` seconds are dropped when they come up. A log left behind by an earlier run is picked up
+    again, so messages spilled to disk survive restarts.
+    Records are JSON serializable objects. Must only be used from the core event loop's thread.
+    """
+
+    def __init__(self, name, path=None, max_memory=500, ttl=3600.0, clock=time.time):
+        self.name = name
+        self.path = path
+        self.max_memory = max_memory
+        self.ttl = ttl
+        self.replaying = False
+        self._clock = clock
+        self._memory = deque()  #(time spooled, record)
+        self._requeued = 0  #number of records at the head of _memory put back by requeue()
+        self._on_disk = 0  #number of unread lines in the log
+        self._reader = None
+        self._writer = None
+        if path is not None and os.path.exists(path):
+            with open(path, 'rb') as log:
+                self._on_disk = sum(1 for _ in log)
+            if self._on_disk:
+                logging.info('Spool %s has %d messages left from an earlier run.', name, self._on_disk)
+
+    def __len__(self):
+        return len(self._memory) + self._on_disk
+
+    def append(self, record):
+        """ Spools a record. Returns False if it had to be dropped because the spool is full. """
+        now = self._clock()
+        if not self._on_disk and len(self._memory) < self.max_memory:
+            self._memory.append((now, record))
+        elif self.path is not None:
+            if self._writer is None:
+                self._writer = open(self.path, 'a', encoding='utf-8')
+            self._writer.write(json.dumps([now, record]) + '\n')
+            self._writer.flush()
+            self._on_disk += 1
+        else:
+            logging.warning('Spool %s is full, dropping message.', self.name)
+            metrics.SPOOL_MESSAGES.inc(outcome='dropped')
+            return False
+        metrics.SPOOL_MESSAGES.inc(outcome='spooled')
+        return True
+
+    def requeue(self, record):
+        """ Puts back a record whose sending failed, ahead of everything spooled so far but behind the records
+        requeued before it, so records that failed in a row are sent again in the order they were sent in.
+        May go over max_memory, as the record was taken from the spool to begin with. """
+        self._memory.insert(self._requeued, (self._clock(), record))
+        self._requeued += 1
+        metrics.SPOOL_MESSAGES.inc(outcome='spooled')
+
+    def pop(self):
+        """ Removes and returns the oldest record that hasn't expired, or None if there are none. """
+        while self:
+            if self._memory:
+                spooled, record = self._memory.popleft()
+                self._requeued = max(0, self._requeued - 1)
+            else:
+                spooled, record = self._read()
+            if record is None:
+                continue
+            if self._clock() - spooled > self.ttl:
+                metrics.SPOOL_MESSAGES.inc(outcome='expired')
+                continue
+            return record
+        return None
+
+    def _read(self):
+        """ Reads the next entry of the log. Returns (time spooled, None) for unreadable entries. """
+        if self._reader is None:
+            if self._writer is not None:
+                self._writer.flush()
+            self._reader = open(self.path, 'r', encoding='utf-8')
+        line = self._reader.readline()
+        self._on_disk -= 1
+        if not line.endswith('\n'):
+            #a partial line written when we crashed, or the log was changed behind our back
+            self._on_disk = 0
+        if not self._on_disk:
+            self._truncate()
+        try:
+            spooled, record = json.loads(line)
+        except ValueError:
+            logging.warning('Skipping unreadable entry in spool %s.', self.name)
+            return 0.0, None
+        return spooled, record
+
+    def _truncate(self):
+        """ Removes the log once everything in it has been read. """
+        for log in (self._reader, self._writer):
+            if log is not None:
+                log.close()
+        self._reader = self._writer = None
+        try:
+            os.remove(self.path)
+        except OSError as ex:
+            logging.error('Failed to remove spool log %s: %s', self.path, ex)
+
+    async def replay(self, send, interval, available):
+        """ Sends the spooled records in order by calling send(record), one every interval seconds, for as long as
+        available() returns True. Records spooled meanwhile are sent too. Does nothing if already replaying. """
+        if self.replaying:
+            return
+        self.replaying = True
+        try:
+            replayed = 0
+            while available():
+                record = self.pop()
+                if record is None:
+                    break
+                send(record)
+                replayed += 1
+                metrics.SPOOL_MESSAGES.inc(outcome='replayed')
+                await asyncio.sleep(interval)
+            if replayed:
+                logging.info('Replayed %d spooled messages to %s.', replayed, self.name)
+        finally:
+            self.replaying = False
+
+    def close(self):
+        """ Closes the log. Messages still in memory are saved to the log first and entries already read are
+        removed from it, so the next run picks up exactly what's left. Returns the number of messages lost because
+        the spool has no log. """
+        lost = len(self._memory) if self.path is None else 0
+        if self.path is not None and (self._memory or (self._reader is not None and self._on_disk)):
+            remaining = []
+            if self._on_disk:
+                if self._writer is not None:
+                    self._writer.flush()
+                if self._reader is None:
+                    self._reader = open(self.path, 'r', encoding='utf-8')
+                remaining = self._reader.readlines()
+            temp_path = self.path + '.tmp'
+            with open(temp_path, 'w', encoding='utf-8') as log:
+                for entry in self._memory:
+                    log.write(json.dumps(list(entry)) + '\n')
+                log.writelines(remaining)
+            os.replace(temp_path, self.path)
+            self._on_disk += len(self._memory)
+            self._memory.clear()
+            self._requeued = 0
+        for log in (self._reader, self._writer):
+            if log is not None:
+                log.close()
+        self._reader = self._writer = None
+        return lost
+
+
+class Spooler():
+    """ Creates the spools of the destinations, keeping their logs in one directory. """
+
+    def __init__(self, directory=None, max_memory=500, ttl=3600.0, replay_interval=0.25):
+        """ If directory is None, spools are memory only. """
+        self.directory = directory
+        self.max_memory = max_memory
+        self.ttl = ttl
+        self.replay_interval = replay_interval
+        self.spools = {}
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def spool(self, name):
+        """ Returns the spool with the given name, creating it if needed. """
+        spool = self.spools.get(name)
+        if spool is None:
+            path = None
+            if self.directory is not None:
+                path = os.path.join(self.directory, quote(name, safe='') + '.log')
+            spool = self.spools[name] = Spool(name, path, self.max_memory, self.ttl)
+        return spool
+
+    def close(self):
+        """ Closes all the spools. Returns the number of messages lost because they were only kept in memory. """
+        return sum(spool.close() for spool in self.spools.values())
@@ -0,0 +1,76 @@
+""" Startup profiling, for finding out where the time goes before the bot is up. """
+
+import builtins
+import logging
+import sys
+import time
+
+
+class StartupProfiler():
+    """
+    Measures how long each phase of starting the bot takes, and how much of that went to importing modules. Phases are
+    sequential: starting one ends the previous one. Imports are timed by wrapping __import__ while the profiler is
+    running, counting only the outermost import of each import chain so that nothing is counted twice. Milestones
+    such as connections becoming ready can be marked with mark(). A disabled profiler does nothing, so the bot can use
+    one unconditionally.
+    """
+
+    def __init__(self, enabled=True, clock=time.perf_counter):
+        self.enabled = enabled
+        self._clock = clock
+        self._started = clock()
+        self.phases = []  #(name, seconds, seconds spent importing, modules imported)
+        self._current = None  #(name, start time, import time at start, modules at start)
+        self.marks = {}  #milestone -> seconds since the profiler was created
+        self._import_time = 0.0
+        self._import_depth = 0
+        self._original_import = None
+        if enabled:
+            self._original_import = builtins.__import__
+            builtins.__import__ = self._timed_import
+
+    def _timed_import(self, *args, **kwargs):
+        if self._import_depth:
+            return self._original_import(*args, **kwargs)
+        self._import_depth += 1
+        start = self._clock()
+        try:
+            return self._original_import(*args, **kwargs)
+        finally:
+            self._import_time += self._clock() - start
+            self._import_depth -= 1
+
+    def phase(self, name):
+        """ Ends the current phase, if any, and starts the named one. """
+        if not self.enabled:
+            return
+        self.end_phase()
+        self._current = (name, self._clock(), self._import_time, len(sys.modules))
+
+    def end_phase(self):
+        """ Ends the current phase. """
+        if self._current is not None:
+            name, start, import_time, modules = self._current
+            self.phases.append((name, self._clock() - start, self._import_time - import_time,
+                                len(sys.modules) - modules))
+            self._current = None
+
+    def mark(self, milestone):
+        """ Records the time a milestone was first reached. """
+        if self.enabled and milestone not in self.marks:
+            self.marks[milestone] = self._clock() - self._started
+            logging.info('Startup: %s after %.1f ms.', milestone, self.marks[milestone] * 1000)
+
+    def finish(self):
+        """ Stops timing imports and logs the phases measured so far. """
+        if not self.enabled:
+            return
+        self.end_phase()
+        if self._original_import is not None:
+            builtins.__import__ = self._original_import
+            self._original_import = None
+        lines = [f"{'phase':<24}{'total ms':>10}{'import ms':>11}{'modules':>9}"]
+        for name, seconds, import_seconds, modules in self.phases:
+            lines.append(f"{name:<24}{seconds * 1000:>10.1f}{import_seconds * 1000:>11.1f}{modules:>9}")
+        lines.append(f"{'since start':<24}{(self._clock() - self._started) * 1000:>10.1f}")
+        logging.info('Startup profile:\n%s', '\n'.join(lines))
@@ -0,0 +1,168 @@
+""" Pools of Discord webhooks: several webhooks per channel, each used as far as its own rate limit allows. """
+
+import asyncio
+import json
+import logging
+import re
+
+import discord
+
+from . import metrics
+
+#the id and token of a webhook in its URL, like discord.py reads them
+_WEBHOOK_URL = re.compile(r'discord(?:app)?\.com/api/webhooks/(?P<id>[0-9]{17,20})/(?P<token>[A-Za-z0-9.\-_]{60,68})')
+#how many times a message is tried when Discord answers that we're rate limited
+MAX_TRIES = 5
+#the label the pools' rate limits are counted under in the metrics
+_METRICS_LABEL = 'webhook_pool'
+
+
+class Webhook():
+    """ A webhook and the state of its rate limit, as Discord's response headers tell it. """
+
+    __slots__ = ('id', 'token', 'url', 'limit', 'remaining', 'reset_at', 'in_flight')
+
+    def __init__(self, url):
+        match = _WEBHOOK_URL.search(url)
+        if match is None:
+            raise ValueError(f"Invalid webhook URL: {url}")
+        self.id = int(match.group('id'))
+        self.token = match.group('token')
+        self.url = url
+        #until Discord tells us the limit, only one request is sent at a time
+        self.limit = 1
+        self.remaining = 1  #requests left in the current rate limit window
+        self.reset_at = None  #loop time the window ends at, if known
+        self.in_flight = 0
+
+    def available(self, now):
+        """ Returns how many more requests can be sent through the webhook right now. """
+        if self.reset_at is not None and now >= self.reset_at:
+            self.remaining, self.reset_at = self.limit, None
+        return self.remaining - self.in_flight
+
+    def update(self, headers, now):
+        """ Updates the rate limit state from the headers of a response. """
+        if 'X-RateLimit-Limit' in headers:
+            self.limit = int(headers['X-RateLimit-Limit'])
+        if 'X-RateLimit-Reset-After' not in headers:
+            #without a reset time we'd never know when to send again, so there's no rate limit as far as we know
+            self.remaining, self.reset_at = self.limit, None
+            return
+        self.remaining = int(headers.get('X-RateLimit-Remaining', self.limit))
+        self.reset_at = now + float(headers['X-RateLimit-Reset-After'])
+
+
+class WebhookPool():
+    """
+    The webhooks of a Discord channel. Discord rate-limits every webhook on its own, so every webhook added multiplies
+    how fast we can post to the channel. Each post goes through the webhook with the most requests left in its rate
+    limit window, and when they're all used up, it waits for the first window to end instead of getting a 429. Posts
+    that get one anyway are retried through another webhook.
+    The pool doesn't keep posts in order, posts that must stay in order have to be sent one after another (see
+    coalesce.Coalescer). Must only be used from the Discord event loop's thread.
+    """
+
+    def __init__(self, urls):
+        self.urls = tuple(urls)
+        if not self.urls:
+            raise ValueError("A webhook pool needs at least one webhook.")
+        self.webhooks = [Webhook(url) for url in self.urls]
+        self._changed = None  #asyncio.Event set whenever a request finishes
+
+    def __len__(self):
+        return len(self.webhooks)
+
+    @property
+    def ids(self):
+        """ The ids of the webhooks. """
+        return [webhook.id for webhook in self.webhooks]
+
+    def _pick(self, now):
+        """ Returns the webhook with the most requests left, or None if they're all used up. """
+        best, best_available = None, 0
+        for webhook in self.webhooks:
+            available = webhook.available(now)
+            if available > best_available:
+                best, best_available = webhook, available
+        return best
+
+    async def _acquire(self, loop):
+        if self._changed is None:
+            self._changed = asyncio.Event()
+        started = loop.time()
+        while True:
+            now = loop.time()
+            webhook = self._pick(now)
+            if webhook is not None:
+                webhook.in_flight += 1
+                metrics.DISCORD_WEBHOOK_WAIT_SECONDS.observe(now - started)
+                return webhook
+            resets = [webhook.reset_at for webhook in self.webhooks if webhook.reset_at is not None]
+            delay = max(0.0, min(resets) - now) if resets else None
+            if delay is not None:
+                metrics.DISCORD_RATE_LIMIT_WAIT.observe(delay, logger=_METRICS_LABEL)
+            self._changed.clear()
+            try:
+                await asyncio.wait_for(self._changed.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def _release(self, webhook):
+        webhook.in_flight -= 1
+        self._changed.set()
+
+    async def send(self, session, content, username=None, avatar_url=None):
+        """
+        Posts a message through one of the webhooks, using the aiohttp session's connection pool. Raises
+        discord.DiscordServerError if Discord couldn't handle it and discord.HTTPException if it rejected it, like
+        discord.Webhook.send(). Only the HTTP posts count towards the send time metric, waiting for the rate limits
+        has a metric of its own.
+        """
+        loop = asyncio.get_running_loop()
+        payload = {'content': content}
+        if username is not None:
+            payload['username'] = username
+        if avatar_url is not None:
+            payload['avatar_url'] = str(avatar_url)
+        data = json.dumps(payload)
+        for _ in range(MAX_TRIES):
+            webhook = await self._acquire(loop)
+            try:
+                with metrics.DISCORD_SEND_SECONDS.time(method='webhook'):
+                    async with session.post(f"{discord.http.Route.BASE}/webhooks/{webhook.id}/{webhook.token}",
+                                            data=data,
+                                            headers={'Content-Type': 'application/json'}) as response:
+                        body = await response.text(encoding='utf-8')
+                now = loop.time()
+                webhook.update(response.headers, now)
+                if 200 <= response.status < 300:
+                    return
+                if response.status != 429:
+                    if response.status == 403:
+                        raise discord.Forbidden(response, body)
+                    if response.status == 404:
+                        raise discord.NotFound(response, body)
+                    if response.status >= 500:
+                        raise discord.DiscordServerError(response, body)
+                    raise discord.HTTPException(response, body)
+                self._rate_limited(webhook, response, body, now)
+            finally:
+                self._release(webhook)
+        raise discord.HTTPException(response, body)
+
+    def _rate_limited(self, webhook, response, body, now):
+        """ Handles a 429: the webhook (or with a global rate limit, all of them) can't be used until it's over. """
+        if 'X-RateLimit-Reset-After' in response.headers:
+            retry_after = float(response.headers['X-RateLimit-Reset-After'])
+        else:
+            try:
+                #the v7 API gives it in milliseconds
+                retry_after = json.loads(body)['retry_after'] / 1000.0
+            except (ValueError, KeyError, TypeError):
+                retry_after = 1.0
+        hit = self.webhooks if response.headers.get('X-RateLimit-Global') else [webhook]
+        for limited in hit:
+            limited.remaining, limited.reset_at = 0, now + retry_after
+        metrics.DISCORD_RATE_LIMITS.inc(logger=_METRICS_LABEL)
+        logging.warning('Webhook %d is rate limited for %.2f seconds, trying again.', webhook.id, retry_after)